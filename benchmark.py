@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import numpy as np
+from ete3 import Tree
+
+import code.distances as distances
+from code.distances import DistanceMatrixIO, DistanceMatrix, Bipartitions
+
+# Timings of tree parsing, the distance engines, matrix I/O and the
+# DistanceMatrix statistics on random trees, written as JSON. With
+# --baseline, cases slower than the baseline by more than --threshold are
+# reported and the exit status is 1
+
+
+ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+metrics = ["rf", "gq"]
+
+
+def random_trees(num_taxa, num_trees, seed):
+    random.seed(seed)
+    names = ["taxon" + str(i) for i in range(num_taxa)]
+    trees = []
+    for i in range(num_trees):
+        tree = Tree()
+        tree.populate(num_taxa, names_library=names, random_branches=True)
+        trees.append(tree.write())
+    return trees
+
+def timed(function, repeats):
+    # Best of repeats, the result of the last run
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        res = function()
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+def sample_pairs(num_trees, num_pairs, seed):
+    rng = random.Random(seed)
+    return [tuple(rng.sample(range(num_trees), 2)) for _ in range(num_pairs)]
+
+def matrix_cost(num_taxa, num_trees):
+    # Rough number of operations of all pairwise GQ distances
+    return num_trees * (num_trees + 1) // 2 * num_taxa * num_taxa
+
+
+def run_case(num_taxa, num_trees, args, tmp_dir):
+    newicks = random_trees(num_taxa, num_trees, args.seed + num_taxa * 1000 + num_trees)
+    res = {}
+
+    def record(name, seconds, count, unit):
+        res[name] = {"taxa": num_taxa, "trees": num_trees, "seconds": seconds, "count": count, "unit": unit,
+                     "per_unit": seconds / max(1, count)}
+
+    (seconds, trees) = timed(lambda: [Tree(newick) for newick in newicks], args.repeats)
+    record("parse_newick", seconds, num_trees, "tree")
+    pairs = sample_pairs(num_trees, args.pairs, args.seed)
+    (seconds, _) = timed(lambda: [distances.rf_distance(trees[i], trees[j]) for (i, j) in pairs], args.repeats)
+    record("rf_distance", seconds, len(pairs), "pair")
+    (seconds, _) = timed(lambda: [distances.gq_distance(trees[i], trees[j]) for (i, j) in pairs], args.repeats)
+    record("gq_distance", seconds, len(pairs), "pair")
+    case_dir = os.path.join(tmp_dir, str(num_taxa) + "_" + str(num_trees))
+    tree_dir = os.path.join(case_dir, "trees")
+    os.makedirs(tree_dir)
+    tree_paths = []
+    for (i, newick) in enumerate(newicks):
+        tree_paths.append(os.path.join(tree_dir, str(i) + ".tre"))
+        with open(tree_paths[-1], "w+") as tree_file:
+            tree_file.write(newick)
+    if args.qdist:
+        qdist_pairs = pairs[:args.qdist_pairs]
+        (seconds, _) = timed(lambda: [distances.qdist_distance(tree_paths[i], tree_paths[j]) for (i, j) in qdist_pairs], args.repeats)
+        record("qdist_distance", seconds, len(qdist_pairs), "pair")
+        paths = [(tree_paths[i], tree_paths[j]) for (i, j) in qdist_pairs]
+        (seconds, _) = timed(lambda: distances.qdist_distances(paths, args.qdist_jobs), args.repeats)
+        record("qdist_distances", seconds, len(qdist_pairs), "pair")
+    (seconds, _) = timed(lambda: Bipartitions(trees).rf_matrix(), args.repeats)
+    record("rf_matrix", seconds, num_trees * (num_trees + 1) // 2, "pair")
+    if num_trees <= len(ref_tree_names) or matrix_cost(num_taxa, num_trees) > args.max_matrix_cost:
+        return res
+    sampled_tree_paths = tree_paths[:-len(ref_tree_names)]
+    ref_tree_paths = dict(zip(ref_tree_names, tree_paths[-len(ref_tree_names):]))
+    for storage in ["csv", "npy"]:
+        d_io = DistanceMatrixIO(metrics, ref_tree_names, storage = storage)
+        dist_dir = os.path.join(case_dir, "distances_" + storage)
+
+        def write():
+            # from scratch, write_matrix would otherwise reuse the stored matrix
+            if os.path.isdir(dist_dir):
+                shutil.rmtree(dist_dir)
+            d_io.write_matrix(dist_dir, sampled_tree_paths, ref_tree_paths)
+        (seconds, _) = timed(write, 1)
+        record("write_matrix_" + storage, seconds, num_trees * (num_trees + 1) // 2, "pair")
+        (seconds, dm) = timed(lambda: d_io.read_matrix(dist_dir), args.repeats)
+        record("read_matrix_" + storage, seconds, num_trees * (num_trees + 1) // 2, "pair")
+    condensed = {metric: dm.condensed(metric) for metric in metrics}
+
+    def stats():
+        dm = DistanceMatrix(None, ref_tree_names, metrics, condensed)
+        for metric in metrics:
+            dm.sampled_stats(metric)
+            dm.ref_tree_dist_stats(metric)
+    (seconds, _) = timed(stats, args.repeats)
+    record("matrix_stats", seconds, num_trees, "tree")
+    return res
+
+
+def environment():
+    return {"python": platform.python_version(), "numpy": np.__version__, "platform": platform.platform(),
+            "processor": platform.processor(), "cpus": os.cpu_count(), "time": time.strftime("%Y-%m-%dT%H:%M:%S")}
+
+def key(name, entry):
+    return name + "/taxa=" + str(entry["taxa"]) + "/trees=" + str(entry["trees"])
+
+def run(args):
+    results = {}
+    distances.exe_path = args.qdist_path
+    args.qdist = os.path.isfile(args.qdist_path) and os.access(args.qdist_path, os.X_OK)
+    if not args.qdist:
+        print("qdist not found at " + args.qdist_path + ", skipping qdist_distance")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_taxa in args.taxa:
+            for num_trees in args.trees:
+                print("Benchmarking " + str(num_taxa) + " taxa, " + str(num_trees) + " trees", flush=True)
+                for (name, entry) in run_case(num_taxa, num_trees, args, tmp_dir).items():
+                    results[key(name, entry)] = dict(entry, name = name)
+    return {"environment": environment(), "settings": {"repeats": args.repeats, "pairs": args.pairs, "seed": args.seed},
+            "results": results}
+
+def compare(current, baseline, threshold, min_seconds):
+    # Cases present in both runs whose time per unit grew by more than
+    # threshold, ignoring cases faster than min_seconds in both
+    slowdowns = []
+    print("%-45s %12s %12s %8s" % ("case", "baseline", "current", "ratio"))
+    for (case, entry) in sorted(current["results"].items()):
+        if case not in baseline["results"]:
+            continue
+        base = baseline["results"][case]
+        ratio = entry["per_unit"] / base["per_unit"] if base["per_unit"] > 0 else float("inf")
+        flag = ""
+        if ratio > threshold and max(entry["seconds"], base["seconds"]) >= min_seconds:
+            slowdowns.append(case)
+            flag = " SLOWER"
+        print("%-45s %12.6f %12.6f %8.2f%s" % (case, base["seconds"], entry["seconds"], ratio, flag))
+    return slowdowns
+
+
+def int_list(s):
+    return [int(el) for el in s.split(",")]
+
+parser = argparse.ArgumentParser(prog = "benchmark")
+parser.add_argument("--taxa", type = int_list, default = [10, 50, 100, 200], help = "comma separated numbers of taxa")
+parser.add_argument("--trees", type = int_list, default = [10, 100, 500], help = "comma separated numbers of trees")
+parser.add_argument("--quick", action = "store_true", help = "only 10 and 50 taxa with 10 and 100 trees")
+parser.add_argument("--repeats", type = int, default = 3)
+parser.add_argument("--pairs", type = int, default = 20, help = "tree pairs timed by the pairwise distances")
+parser.add_argument("--qdist-pairs", dest = "qdist_pairs", type = int, default = 5)
+parser.add_argument("--qdist-jobs", dest = "qdist_jobs", type = int, default = os.cpu_count(), help = "concurrent qdist runs of qdist_distances")
+parser.add_argument("--qdist", dest = "qdist_path", default = "./bin/qdist")
+parser.add_argument("--max-matrix-cost", dest = "max_matrix_cost", type = float, default = 1e8,
+    help = "skip matrix I/O for cases with more pairs * taxa^2")
+parser.add_argument("--seed", type = int, default = 0)
+parser.add_argument("--output", default = "benchmark.json")
+parser.add_argument("--input", help = "compare this result file instead of running the benchmarks")
+parser.add_argument("--baseline", help = "result file to compare against")
+parser.add_argument("--threshold", type = float, default = 1.25, help = "flag cases slower than baseline by this factor")
+parser.add_argument("--min-seconds", dest = "min_seconds", type = float, default = 0.001)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.quick:
+        args.taxa = [10, 50]
+        args.trees = [10, 100]
+    if args.input is not None:
+        with open(args.input, "r") as result_file:
+            current = json.load(result_file)
+    else:
+        current = run(args)
+        with open(args.output, "w+") as result_file:
+            json.dump(current, result_file, indent = 1, sort_keys = True)
+        print("Results written to " + args.output)
+    if args.baseline is not None:
+        with open(args.baseline, "r") as baseline_file:
+            baseline = json.load(baseline_file)
+        slowdowns = compare(current, baseline, args.threshold, args.min_seconds)
+        if len(slowdowns) > 0:
+            print(str(len(slowdowns)) + " cases slower than the baseline")
+            sys.exit(1)
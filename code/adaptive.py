@@ -0,0 +1,124 @@
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+
+try:
+    import code.util as util
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    import util
+
+
+# Adaptive sampling infers the sampled MSAs of a dataset in rounds and stops
+# once the bootstrap confidence intervals of the reported statistics are
+# narrower than their tolerance
+tolerances = {
+    "rf_sampled_avg": 0.02,
+    "gqd_sampled_avg": 0.02,
+    "gqd_sampled_median": 0.02,
+    "gqd_sampled_std": 0.02,
+    "difficulty_variance": 0.002
+}
+confidence = 0.95
+num_bootstraps = 1000
+seed = 0
+
+
+def pairwise_avg(dists, idx):
+    # sampled_avg_avg_dist of the trees idx, pairs of a tree drawn twice are
+    # left out
+    sub = dists[np.ix_(idx, idx)]
+    sub[idx[:, None] == idx[None, :]] = float("nan")
+    return np.nanmean(np.nanmean(sub, axis=1))
+
+statistics = {
+    "rf_sampled_avg": ("rf", pairwise_avg),
+    "gqd_sampled_avg": ("gqd", lambda values, idx: np.nanmean(values[idx])),
+    "gqd_sampled_median": ("gqd", lambda values, idx: np.nanmedian(values[idx])),
+    "gqd_sampled_std": ("gqd", lambda values, idx: np.nanstd(values[idx])),
+    "difficulty_variance": ("difficulty", lambda values, idx: np.nanvar(values[idx]))
+}
+
+def sample_values(dm, difficulties):
+    # Per sampled MSA inputs of the statistics: RF distances among the sampled
+    # trees, GQ distances to the Glottolog tree and difficulties
+    return {"rf": dm.sampled_dists("rf"),
+            "gqd": np.array(dm.ref_tree_dist_vector("glottolog", "gq"), dtype=np.float64),
+            "difficulty": np.array(difficulties, dtype=np.float64)}
+
+def intervals(values, names = None):
+    # (value, lower, upper) per statistic, the percentile interval of
+    # num_bootstraps resamples of the sampled MSAs
+    if names is None:
+        names = list(statistics)
+    n = len(values["difficulty"])
+    rng = np.random.default_rng(seed)
+    resamples = rng.integers(0, n, size=(num_bootstraps, n)) if n > 0 else np.zeros((0, 0), dtype=np.int64)
+    alpha = (1 - confidence) / 2
+    res = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        for name in names:
+            (key, statistic) = statistics[name]
+            value = statistic(values[key], np.arange(n)) if n > 0 else float("nan")
+            estimates = np.array([statistic(values[key], idx) for idx in resamples], dtype=np.float64)
+            estimates = estimates[estimates == estimates]
+            if len(estimates) == 0:
+                res[name] = (float(value), float("nan"), float("nan"))
+            else:
+                res[name] = (float(value), float(np.quantile(estimates, alpha)), float(np.quantile(estimates, 1 - alpha)))
+    return res
+
+def converged(intervals, tolerances = tolerances):
+    # Statistics without value, i.e. NaN in every sample like the GQ distances
+    # to a Glottolog tree without butterflies, are left out, a dataset without
+    # any value stops at min_samples. A value without finite interval never
+    # converges
+    for (name, tolerance) in tolerances.items():
+        (value, lower, upper) = intervals[name]
+        if value != value:
+            continue
+        if not np.isfinite([value, lower, upper]).all() or upper - lower > tolerance:
+            return False
+    return True
+
+def next_num_samples(num_samples, available, intervals, min_samples, round_size, tolerances = tolerances):
+    # Samples of the next round, None if the dataset is done
+    if num_samples >= available:
+        return None
+    if num_samples >= min_samples and intervals is not None and converged(intervals, tolerances):
+        return None
+    return min(available, max(min_samples, num_samples + round_size))
+
+
+def counts_path(results_dir):
+    return os.path.join(results_dir, "adaptive_samples.json")
+
+def read_counts(path):
+    if not os.path.isfile(path):
+        return {}
+    with open(path, "r") as counts_file:
+        return json.load(counts_file)
+
+def write_counts(path, counts):
+    d = os.path.dirname(path)
+    if d != "" and not os.path.isdir(d):
+        os.makedirs(d)
+    with open(path + ".tmp", "w+") as counts_file:
+        json.dump(counts, counts_file, indent=0, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def used_samples(df, counts):
+    # df with the sampled MSAs restricted to those used by adaptive sampling
+    df = df.copy()
+    sampled_msa_paths = []
+    for (i, row) in df.iterrows():
+        paths = row["sampled_msa_paths"]
+        record = counts.get(util.dataset_name(row))
+        if record is not None:
+            paths = paths[:record["num_samples"]]
+        sampled_msa_paths.append(paths)
+    df["sampled_msa_paths"] = pd.Series(sampled_msa_paths, index=df.index, dtype=object)
+    return df
@@ -0,0 +1,44 @@
+import os
+import json
+import hashlib
+import pandas as pd
+
+
+def cache_key(config_path):
+    # Hash of the config and the mtimes of its data directories and their
+    # entries, which change whenever lingdata adds or rewrites datasets
+    with open(config_path, "rb") as config_file:
+        content = config_file.read()
+    h = hashlib.sha256(content)
+    config = json.loads(content)
+    for key in ["data_dir", "native_dir"]:
+        d = config.get(key, "")
+        if d == "" or not os.path.isdir(d):
+            continue
+        h.update((key + " " + d + " " + str(os.stat(d).st_mtime_ns) + "\n").encode())
+        for entry in sorted(os.scandir(d), key=lambda entry: entry.name):
+            h.update((entry.name + " " + str(entry.stat().st_mtime_ns) + "\n").encode())
+    return h.hexdigest()
+
+def cache_path(config_path, cache_dir, key):
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    return os.path.join(cache_dir, name + "." + key[:16] + ".pkl")
+
+def data(database, config_path, cache_dir = "data/cache"):
+    # database.data() for the given config, pickled in cache_dir. Outdated
+    # pickles of the same config are removed
+    database.read_config(config_path)
+    key = cache_key(config_path)
+    path = cache_path(config_path, cache_dir, key)
+    if os.path.isfile(path):
+        return pd.read_pickle(path)
+    df = database.data()
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    name = os.path.splitext(os.path.basename(config_path))[0]
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(name + ".") and file_name.endswith(".pkl") and len(file_name) == len(name) + 21:
+            os.remove(os.path.join(cache_dir, file_name))
+    df.to_pickle(path + ".tmp" + str(os.getpid()))
+    os.replace(path + ".tmp" + str(os.getpid()), path)
+    return df
@@ -4,9 +4,35 @@ import numpy as np
 import traceback
 import shutil
 import copy
+import json
+import math
+import warnings
+import multiprocessing
+import itertools
+import hashlib
+import pickle
+
+try:
+    import code.tracing as tracing
+    import code.processes as processes
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    import tracing
+    import processes
 
 
 exe_path = ""
+# Version of the distance semantics, increase it whenever a change to this
+# module changes the distances or the consensus trees, so stored matrices are
+# recomputed; other changes keep it
+ENGINE_VERSION = 1
+# seconds after which a qdist run is stopped, None for no limit
+qdist_timeout = None
+# Prepared reference trees are cached in memory and, if set, the pruned ones
+# in this directory, which may be deleted at any time
+tree_cache_dir = ""
+prepared_cache = {}
+max_prepared_cache = 1000
 
 def rf_distance(t1, t2):
     if t1 is None or t2 is None:
@@ -18,56 +44,710 @@ def rf_distance(t1, t2):
         return float('nan')
     return rf/max_rf
 
-def gq_distance(tree_name1, tree_name2):
+
+popcount_table = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+def popcount(words):
+    words = np.ascontiguousarray(words, dtype=np.uint64)
+    return popcount_table[words.view(np.uint8)].reshape(len(words), -1).sum(axis=1)
+
+def taxon_index(trees):
+    names = set()
+    for tree in trees:
+        if tree is None or tree != tree:
+            continue
+        names.update(leaf.name for leaf in tree.iter_leaves())
+    return {name: i for (i, name) in enumerate(sorted(names))}
+
+def to_words(bits, num_words):
+    return [(bits >> (64 * w)) & 0xFFFFFFFFFFFFFFFF for w in range(num_words)]
+
+
+class Bipartitions:
+
+    # Clades of all trees as fixed-width bitsets over one shared taxon index,
+    # extracted in a single traversal per tree
+    # With given taxa, trees may be any iterable and are visited only once
+    def __init__(self, trees, taxa = None):
+        self.taxa = taxon_index(trees) if taxa is None else taxa
+        self.num_words = max(1, (len(self.taxa) + 63) // 64)
+        valid = []
+        self.leaf_bits = []
+        clades = []
+        owners = []
+        for (i, tree) in enumerate(trees):
+            self.leaf_bits.append(0)
+            valid.append(False)
+            if tree is None or tree != tree:
+                continue
+            node_bits = {}
+            for node in tree.traverse("postorder"):
+                if node.is_leaf():
+                    bits = 1 << self.taxa[node.name]
+                    if bits & self.leaf_bits[i]:
+                        raise ValueError("Duplicated leaf " + node.name + " in tree " + str(i))
+                    self.leaf_bits[i] |= bits
+                else:
+                    bits = 0
+                    for child in node.children:
+                        bits |= node_bits[child]
+                clades.append(to_words(bits, self.num_words))
+                owners.append(i)
+                node_bits[node] = bits
+            valid[i] = True
+        self.num_trees = len(valid)
+        self.valid = np.array(valid, dtype=bool)
+        self.clades = np.array(clades, dtype=np.uint64).reshape(-1, self.num_words)
+        self.owners = np.array(owners, dtype=np.int64)
+
+    def splits(self, tree_indices, leaf_bits):
+        # Nontrivial splits of the given trees restricted to leaf_bits, in
+        # canonical orientation (side without the lowest taxon), as
+        # (owner, split id) pairs without duplicates per tree, and the sides
+        # of all split ids
+        mask = np.array(to_words(leaf_bits, self.num_words), dtype=np.uint64)
+        selected = np.isin(self.owners, tree_indices)
+        sides = self.clades[selected] & mask
+        owners = self.owners[selected]
+        if leaf_bits != 0:
+            lowest = (leaf_bits & -leaf_bits).bit_length() - 1
+            flip = ((sides[:, lowest // 64] >> np.uint64(lowest % 64)) & np.uint64(1)).astype(bool)
+            sides[flip] ^= mask
+        sizes = popcount(sides)
+        nontrivial = (sizes > 1) & (bin(leaf_bits).count("1") - sizes > 1)
+        sides = sides[nontrivial]
+        owners = owners[nontrivial]
+        if len(sides) == 0:
+            return owners, np.zeros(0, dtype=np.int64), sides
+        unique_sides, split_ids = np.unique(sides, axis=0, return_inverse=True)
+        pairs = np.unique(np.stack([owners, split_ids.reshape(-1)], axis=1), axis=0)
+        return pairs[:, 0], pairs[:, 1], unique_sides
+
+    def incidence(self, tree_indices, leaf_bits):
+        owners, split_ids, sides = self.splits(tree_indices, leaf_bits)
+        m = np.zeros((self.num_trees, len(sides)))
+        m[owners, split_ids] = 1.0
+        return m
+
+    def rf_matrix(self):
+        # Symmetric matrix of normalized RF distances, identical to rf_distance
+        # for each pair. Trees sharing a leaf set are compared in one block,
+        # mixed leaf sets are restricted to their common leaves first
+        res = np.full((self.num_trees, self.num_trees), float("nan"))
+        groups = {}
+        for i in np.flatnonzero(self.valid):
+            groups.setdefault(self.leaf_bits[i], []).append(i)
+        groups = list(groups.items())
+        for (g1, (leaf_bits1, indices1)) in enumerate(groups):
+            for (leaf_bits2, indices2) in groups[g1:]:
+                m = self.incidence(indices1 + indices2, leaf_bits1 & leaf_bits2)
+                shared = m @ m.T
+                counts = m.sum(axis=1)
+                block = np.ix_(indices1, indices2)
+                max_rf = counts[indices1][:, None] + counts[indices2][None, :]
+                rf = max_rf - 2 * shared[block]
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    d = np.where(max_rf == 0, float("nan"), rf / max_rf)
+                res[block] = d
+                res[np.ix_(indices2, indices1)] = d.T
+        return res
+
+    def rf_rows(self, rows):
+        # rf_matrix()[rows], computing only the blocks of the given trees
+        res = np.full((len(rows), self.num_trees), float("nan"))
+        position = {row: k for (k, row) in enumerate(rows)}
+        groups = {}
+        for i in np.flatnonzero(self.valid):
+            groups.setdefault(self.leaf_bits[i], []).append(i)
+        for (leaf_bits1, indices1) in groups.items():
+            selected = [i for i in indices1 if i in position]
+            if len(selected) == 0:
+                continue
+            for (leaf_bits2, indices2) in groups.items():
+                m = self.incidence(selected + indices2, leaf_bits1 & leaf_bits2)
+                shared = m[selected] @ m[indices2].T
+                counts = m.sum(axis=1)
+                max_rf = counts[selected][:, None] + counts[indices2][None, :]
+                rf = max_rf - 2 * shared
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    d = np.where(max_rf == 0, float("nan"), rf / max_rf)
+                res[np.ix_([position[i] for i in selected], indices2)] = d
+        return res
+
+    def common_splits(self):
+        # Splits of the valid trees, which must share their leaf set
+        indices = np.flatnonzero(self.valid)
+        leaf_bits = set(self.leaf_bits[i] for i in indices)
+        if len(leaf_bits) > 1:
+            raise ValueError("Trees have different leaf sets")
+        return self.splits(indices, leaf_bits.pop() if len(leaf_bits) > 0 else 0)
+
+    def rf_stats(self):
+        # Mean normalized RF distance over all pairs of valid trees on a common
+        # leaf set, and the mean distance of each tree to all others, from
+        # split frequencies instead of pairwise comparisons. Trees are grouped
+        # by their number of splits k as the normalization 2 / (k_i + k_j)
+        # only depends on those
+        indices = np.flatnonzero(self.valid)
+        per_tree = np.full(self.num_trees, float("nan"))
+        if len(indices) < 2:
+            return float("nan"), per_tree
+        owners, split_ids, sides = self.common_splits()
+        counts = np.bincount(owners, minlength=self.num_trees)[indices]
+        group_counts, groups = np.unique(counts, return_inverse=True)
+        groups = groups.reshape(-1)
+        position = np.full(self.num_trees, -1)
+        position[indices] = np.arange(len(indices))
+        # frequencies[g, s]: trees of group g containing split s
+        frequencies = np.zeros((len(group_counts), len(sides)))
+        np.add.at(frequencies, (groups[position[owners]], split_ids), 1)
+        group_sizes = np.bincount(groups).astype(float)
+        if group_counts[0] == 0 and group_sizes[0] > 1:
+            # two trees without splits
+            return float("nan"), per_tree
+        max_rf = np.maximum(group_counts[:, None] + group_counts[None, :], 1).astype(float)
+        # shared[i, h]: splits tree i shares with trees of group h, itself excluded
+        shared = np.zeros((len(indices), len(group_counts)))
+        np.add.at(shared, position[owners], frequencies[:, split_ids].T)
+        own = groups[:, None] == np.arange(len(group_counts))[None, :]
+        shared -= own * counts[:, None]
+        others = group_sizes[None, :] - own
+        dists = others - 2 * shared / max_rf[groups]
+        per_tree[indices] = dists.sum(axis=1) / (len(indices) - 1)
+        return float(per_tree[indices].mean()), per_tree
+
+    def rf_distribution(self, block_size = 1000):
+        # Distinct pairwise normalized RF distances of valid trees on a common
+        # leaf set with their number of pairs, from the shared split counts of
+        # one block of rows at a time
+        indices = np.flatnonzero(self.valid)
+        owners, split_ids, sides = self.common_splits()
+        position = np.full(self.num_trees, -1)
+        position[indices] = np.arange(len(indices))
+        m = np.zeros((len(indices), len(sides)))
+        m[position[owners], split_ids] = 1.0
+        counts = m.sum(axis=1)
+        values = []
+        for start in range(0, len(indices), block_size):
+            end = min(start + block_size, len(indices))
+            shared = m[start:end] @ m.T
+            max_rf = counts[start:end, None] + counts[None, :]
+            rows, cols = np.nonzero(np.arange(start, end)[:, None] < np.arange(len(indices))[None, :])
+            with np.errstate(divide="ignore", invalid="ignore"):
+                d = (max_rf - 2 * shared) / max_rf
+            values.append(np.where(max_rf == 0, float("nan"), d)[rows, cols])
+        if len(values) == 0:
+            return np.zeros(0), np.zeros(0, dtype=np.int64)
+        return np.unique(np.concatenate(values), return_counts=True)
+
+
+def read_bipartitions(path):
+    # Streams a file with one Newick tree per line, e.g. .raxml.mlTrees. The
+    # taxa are those of the first tree
+    with open(path, "r") as tree_file:
+        lines = (line for line in tree_file if line.strip() != "")
+        first = next(lines, None)
+        if first is None:
+            return Bipartitions([])
+        first_tree = Tree(first)
+        trees = itertools.chain([first_tree], (Tree(line) for line in lines))
+        return Bipartitions(trees, taxon_index([first_tree]))
+
+
+def from_words(words):
+    return sum(int(word) << (64 * w) for (w, word) in enumerate(words))
+
+def compatible(side1, side2):
+    # Both in canonical orientation, so their complements always intersect
+    common = side1 & side2
+    return common == 0 or common == side1 or common == side2
+
+def consensus(trees, extended = False):
+    # Majority-rule consensus of trees on a common leaf set, extended
+    # majority-rule additionally adds compatible splits by decreasing
+    # frequency. trees may be already parsed trees or their Bipartitions.
+    # Returns the Newick string with supports in percent as inner node labels
+    # like raxml-ng --consense writes it, and the consensus splits as
+    # (leaf names, support) pairs
+    b = trees if isinstance(trees, Bipartitions) else Bipartitions(trees)
+    indices = np.flatnonzero(b.valid)
+    if len(indices) == 0:
+        raise ValueError("No trees to build a consensus from")
+    owners, split_ids, sides = b.common_splits()
+    frequencies = np.bincount(split_ids, minlength=len(sides))
+    chosen = []
+    for split_id in sorted(range(len(sides)), key=lambda split_id: (-frequencies[split_id], split_id)):
+        side = from_words(sides[split_id])
+        if 2 * frequencies[split_id] > len(indices):
+            chosen.append((side, float(frequencies[split_id] / len(indices))))
+        elif not extended:
+            break
+        elif all(compatible(side, other) for (other, _) in chosen):
+            chosen.append((side, float(frequencies[split_id] / len(indices))))
+    # Clades of the tree rooted at the lowest taxon, each below the smallest
+    # clade containing it
+    leaf_bits = b.leaf_bits[indices[0]]
+    support = dict(chosen)
+    clades = [leaf_bits] + sorted(support, key=lambda side: -bin(side).count("1"))
+    children = {clade: [] for clade in clades}
+    for (c, clade) in enumerate(clades[1:]):
+        parent = next(other for other in reversed(clades[:c + 1]) if other & clade == clade)
+        children[parent].append(clade)
+    names = {i: name for (name, i) in b.taxa.items()}
+    for i in range(leaf_bits.bit_length()):
+        if (leaf_bits >> i) & 1:
+            parent = next(clade for clade in reversed(clades) if (clade >> i) & 1)
+            children[parent].append(-i - 1)
+
+    def newick(node):
+        if node < 0:
+            return names[-node - 1]
+        subtrees = sorted(children[node], key=lambda child: -child - 1 if child < 0 else (child & -child).bit_length() - 1)
+        label = "" if node == leaf_bits else str(int(100 * support[node] + 0.5))
+        return "(" + ",".join(newick(child) for child in subtrees) + ")" + label
+
+    splits = [(sorted(names[i] for i in range(side.bit_length()) if (side >> i) & 1), value) for (side, value) in chosen]
+    return newick(leaf_bits) + ";", splits
+
+def write_consensus(trees, path, extended = False):
+    newick, splits = consensus(trees, extended)
+    with open(path, "w+") as outfile:
+        outfile.write(newick + "\n")
+    return splits
+
+
+def choose2(x):
+    return x * (x - 1) / 2
+
+class QuartetTree:
+
+    # Butterfly structure of an unrooted tree: the directed edges leaving inner
+    # nodes towards at least two leaves, with their leaf sets, grouped by tail
+    # node. Edges towards single leaves never contribute to quartet counts
+    def __init__(self, tree):
+        self.names = sorted(tree.get_leaf_names())
+        if len(set(self.names)) != len(self.names):
+            raise ValueError("Duplicated leaf names")
+        self.num_leaves = len(self.names)
+        column = {name: i for (i, name) in enumerate(self.names)}
+        clades = {}
+        rows = []
+        degrees = []
+        for node in tree.traverse("postorder"):
+            if node.is_leaf():
+                clade = np.zeros(self.num_leaves, dtype=bool)
+                clade[column[node.name]] = True
+                clades[node] = clade
+                continue
+            clade = np.logical_or.reduce([clades[child] for child in node.children])
+            clades[node] = clade
+            branches = [clades[child] for child in node.children]
+            if not node.is_root():
+                branches.append(~clade)
+            branches = [branch for branch in branches if branch.sum() > 1]
+            if len(branches) > 0:
+                rows += branches
+                degrees.append(len(branches))
+        self.membership = np.array(rows, dtype=float).reshape(-1, self.num_leaves)
+        self.sizes = self.membership.sum(axis=1)
+        self.starts = np.cumsum([0] + degrees)[:-1].astype(np.int64)
+        self.tails = np.repeat(np.arange(len(degrees)), degrees)
+        # Leaf pairs within one branch, summed per node
+        self.node_pairs = self.node_sum(choose2(self.sizes))
+        separated = choose2(self.num_leaves - self.sizes) - self.node_pairs[self.tails] + choose2(self.sizes)
+        self.butterflies = int(round((choose2(self.sizes) * separated).sum() / 2))
+
+    def node_sum(self, a, axis = 0):
+        if len(self.starts) == 0:
+            shape = list(np.shape(a))
+            shape[axis] = 0
+            return np.zeros(shape)
+        return np.add.reduceat(a, self.starts, axis=axis)
+
+    def shared_butterflies(self, other):
+        # Every quartet ab|cd of both trees is counted from both of its
+        # cherries: for directed edges e1 = (v1, w1), e2 = (v2, w2), the
+        # pairs {c, d} below both edges times the pairs {a, b} outside of
+        # both that are separated at v1 and at v2. The latter follow by
+        # inclusion-exclusion from per node pair counts, so only sums over
+        # edge pairs remain
+        n = self.num_leaves
+        s1 = self.sizes[:, None]
+        s2 = other.sizes[None, :]
+        I = self.membership @ other.membership.T
+        below = choose2(I)
+        below_rows = self.node_sum(below)
+        below_cols = other.node_sum(below, axis=1)
+        below_nodes = self.node_sum(below_cols)
+        separated = choose2(n) - self.node_pairs[:, None] - other.node_pairs[None, :] + below_nodes
+        with_e1 = s1 * (n - s1) + other.node_sum(I * (I - s2), axis=1)
+        with_e2 = s2 * (n - s2) + self.node_sum(I * (I - s1))
+        with_both = I * (n - s1 - s2 + I) + (s1 - I) * (s2 - I)
+        res = (separated * below_nodes).sum() - (with_e1 * below_cols).sum() - (with_e2 * below_rows).sum() + (with_both * below).sum()
+        return int(round(res / 2))
+
+    def distance(self, other):
+        if self.names != other.names:
+            return float("nan")
+        butterflies = min(self.butterflies, other.butterflies)
+        if butterflies == 0:
+            return float("nan")
+        shared = self.shared_butterflies(other)
+        # qdist reports the normalized count with six significant digits
+        return 1 - float("%g" % (shared / butterflies))
+
+    def distances(self, others):
+        return [float("nan") if other is None else self.distance(other) for other in others]
+
+
+def quartet_tree(tree):
+    if isinstance(tree, QuartetTree):
+        return tree
+    try:
+        if isinstance(tree, str):
+            tree = Tree(tree)
+        return QuartetTree(tree)
+    except Exception as e:
+        print(e)
+        return None
+
+
+def read_trees(tree_paths):
+    trees = []
+    with tracing.span("parse_trees", tree_paths[0] if len(tree_paths) > 0 else "", trees = len(tree_paths)):
+        for tree_path in tree_paths:
+            try:
+                trees.append(Tree(tree_path))
+            except Exception as e:
+                print(e)
+                trees.append(None)
+    return trees
+
+def lower_triangle(m):
+    return [[float(el) for el in m[i, :i + 1]] for i in range(len(m))]
+
+def gq_distance(t1, t2):
+    if t1 is None or t2 is None:
+        return float('nan')
+    if t1 != t1 or t2 != t2:
+        return float("nan")
+    q1 = quartet_tree(t1)
+    q2 = quartet_tree(t2)
+    if q1 is None or q2 is None:
+        return float('nan')
+    return q1.distance(q2)
+
+def qdist_command(tree_name1, tree_name2):
+    # None if the distance is undefined without running qdist
     if exe_path == "":
         print("Specify exe path of qdist")
-        return float("nan")
+        return None
     if tree_name1 is None or tree_name2 is None:
-        return float('nan')
+        return None
     if tree_name1 != tree_name1 or tree_name2 != tree_name2:
-        return float("nan")
-    os.system(exe_path + " " + tree_name1 + " " + tree_name2 + " >out.txt")
-    lines = open("out.txt").readlines()
-    if len(lines) < 2: #error occurred
+        return None
+    return [exe_path, tree_name1, tree_name2]
+
+def qdist_result(result):
+    lines = result.stdout.splitlines()
+    if not result.ok() or len(lines) < 2: #error occurred
+        if not result.ok():
+            print(result.describe())
         return float('nan')
     res_q = float(lines[1].split("\t")[-3])
-    qdist = 1 - res_q
-    os.remove("out.txt")
-    return qdist
+    return 1 - res_q
+
+def qdist_distance(tree_name1, tree_name2):
+    command = qdist_command(tree_name1, tree_name2)
+    if command is None:
+        return float("nan")
+    return qdist_result(processes.run(command, "qdist", tree_name1, qdist_timeout, True))
+
+def qdist_distances(pairs, max_jobs = None):
+    # qdist of many (tree_name1, tree_name2) pairs, at most max_jobs at once
+    commands = [qdist_command(tree_name1, tree_name2) for (tree_name1, tree_name2) in pairs]
+    jobs = [{"argv": command, "stage": "qdist", "target": command[1], "timeout": qdist_timeout, "capture": True}
+            for command in commands if command is not None]
+    results = iter(processes.run_all(jobs, max_jobs))
+    return [float("nan") if command is None else qdist_result(next(results)) for command in commands]
+
+def num_taxa(tree_paths):
+    for tree_path in tree_paths:
+        if os.path.isfile(tree_path):
+            with open(tree_path, "r") as tree_file:
+                return tree_file.read().count(",") + 1
+    return 0
+
+def row_blocks(num_rows, block_size):
+    # Consecutive rows of the lower triangle with about block_size entries each
+    blocks = []
+    start = 0
+    entries = 0
+    for i in range(num_rows):
+        entries += i + 1
+        if entries >= block_size:
+            blocks.append((start, i + 1))
+            start = i + 1
+            entries = 0
+    if start < num_rows:
+        blocks.append((start, num_rows))
+    return blocks
+
+def fingerprint(path):
+    if not os.path.isfile(path):
+        return ""
+    with open(path, "rb") as tree_file:
+        return hashlib.sha256(tree_file.read()).hexdigest()
+
+def topology_key(tree):
+    # Hash of the unrooted topology, the leaf names and the nontrivial splits
+    # in canonical orientation. Trees with equal keys have equal RF and GQ
+    # distances to all trees
+    if tree is None:
+        return None
+    names = sorted(tree.get_leaf_names())
+    index = {name: i for (i, name) in enumerate(names)}
+    all_bits = (1 << len(names)) - 1
+    node_bits = {}
+    splits = set()
+    for node in tree.traverse("postorder"):
+        if node.is_leaf():
+            bits = 1 << index[node.name]
+        else:
+            bits = 0
+            for child in node.children:
+                bits |= node_bits[child]
+        node_bits[node] = bits
+        side = bits ^ all_bits if bits & 1 else bits
+        size = bin(side).count("1")
+        if size > 1 and len(names) - size > 1:
+            splits.add(side)
+    h = hashlib.sha256()
+    h.update(("\n".join(names) + "\n").encode())
+    h.update(" ".join(hex(split) for split in sorted(splits)).encode())
+    return h.hexdigest()
+
+class TaxonRegistry:
+
+    # Leaf labels of one dataset interned to integer ids, in order of
+    # registration
+    def __init__(self, names = []):
+        self.ids = {}
+        self.names = []
+        for name in names:
+            self.id(name)
+
+    def id(self, name):
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
+
+    def register(self, names):
+        return [self.id(name) for name in names]
+
+
+class PreparedTree:
+
+    # A parsed tree, pruned to the given leaves, with its leaf set and
+    # topology key. The quartet structure is built on first use
+    def __init__(self, tree, leaves = None):
+        if tree is not None and leaves is not None:
+            names = set(tree.get_leaf_names())
+            if not names <= leaves:
+                common = sorted(names & leaves)
+                if len(common) == 0:
+                    tree = None
+                else:
+                    tree = tree.copy()
+                    tree.prune(common, preserve_branch_length=True)
+        self.tree = tree
+        self.leaves = frozenset() if tree is None else frozenset(tree.get_leaf_names())
+        self.key = topology_key(tree)
+        self.quartets = None
+
+    def quartet_tree(self):
+        if self.quartets is None and self.tree is not None:
+            self.quartets = quartet_tree(self.tree)
+        return self.quartets
+
+
+def engine_version(pruned):
+    # ENGINE_VERSION together with the reference trees which are pruned,
+    # stored rows of another version are not reused
+    return str(ENGINE_VERSION) + ":" + ",".join(sorted(pruned))
+
+def tree_cache_path(path, stat, leaf_key):
+    # one file per tree path, file version and leaf set
+    path_hash = hashlib.sha256(os.path.abspath(path).encode()).hexdigest()
+    version_hash = hashlib.sha256((str(stat.st_mtime_ns) + "_" + str(stat.st_size)).encode()).hexdigest()
+    return os.path.join(tree_cache_dir, path_hash + "_" + version_hash[:16] + "_" + leaf_key[:16] + ".pkl")
+
+def prune_tree_cache(cache_path):
+    # removes the entries of older versions of the same tree file
+    (path_hash, version_hash) = os.path.basename(cache_path).split("_")[:2]
+    for file_name in os.listdir(tree_cache_dir):
+        if file_name.startswith(path_hash + "_") and not file_name.startswith(path_hash + "_" + version_hash + "_"):
+            try:
+                os.remove(os.path.join(tree_cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+
+def prepared_tree(path, leaves = None):
+    # PreparedTree of the file, cached per file version and leaf set. Only
+    # pruned trees (the Glottolog trees) are cached on disk, reading them is
+    # the expensive part, the entries of older file versions are removed
+    if not os.path.isfile(path):
+        return PreparedTree(None)
+    stat = os.stat(path)
+    leaf_key = "" if leaves is None else hashlib.sha256("\n".join(sorted(leaves)).encode()).hexdigest()
+    key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size, leaf_key)
+    if key in prepared_cache:
+        return prepared_cache[key]
+    cache_path = ""
+    if tree_cache_dir != "" and leaves is not None:
+        cache_path = tree_cache_path(path, stat, leaf_key)
+    prepared = None
+    if cache_path != "" and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as cache_file:
+                prepared = pickle.load(cache_file)
+        except Exception as e:
+            print("Reading " + cache_path + " failed: " + str(e))
+    if prepared is None:
+        prepared = PreparedTree(read_trees([path])[0], leaves)
+        prepared.quartet_tree()
+        if cache_path != "":
+            os.makedirs(tree_cache_dir, exist_ok=True)
+            with open(cache_path + ".tmp" + str(os.getpid()), "wb") as cache_file:
+                pickle.dump(prepared, cache_file)
+            os.replace(cache_path + ".tmp" + str(os.getpid()), cache_path)
+            prune_tree_cache(cache_path)
+    if len(prepared_cache) >= max_prepared_cache:
+        del prepared_cache[next(iter(prepared_cache))]
+    prepared_cache[key] = prepared
+    return prepared
+
+def unique_topologies(trees):
+    # (one PreparedTree per topology, index of each tree's topology), trees
+    # which could not be read share one entry
+    unique = []
+    indices = {}
+    inverse = []
+    for tree in trees:
+        key = tree.key
+        if key not in indices:
+            indices[key] = len(unique)
+            unique.append(tree)
+        inverse.append(indices[key])
+    return unique, np.array(inverse, dtype=np.int64)
+
+def square(condensed):
+    # Full symmetric matrix of a condensed lower triangle
+    condensed = np.asarray(condensed, dtype=np.float64)
+    n = int((math.isqrt(8 * len(condensed) + 1) - 1) // 2)
+    m = np.empty((n, n))
+    lower = np.tril_indices(n)
+    m[lower] = condensed
+    m.T[lower] = condensed
+    return m
+
+def matrix_block(task):
+    # Rows start to end of the lower triangle, or for an extension the full
+    # rows of the given trees
+    (key, d_io, tree_paths, metric, start, end, rows, dist_dir) = task
+    try:
+        if rows is not None:
+            with tracing.span("distance_rows", dist_dir, metric = metric, rows = len(rows)):
+                return key, d_io.metric_rows(tree_paths, metric, rows)
+        with tracing.span("distance_rows", dist_dir, metric = metric, rows = end - start):
+            return key, d_io.matrix_rows(tree_paths, metric, start, end)
+    except Exception as e:
+        traceback.print_exc()
+        return key, None
 
 
 class DistanceMatrixIO:
 
-    def __init__(self, metrics, ref_tree_names):
+    # Reference trees in pruned, e.g. the Glottolog tree, are cut to the
+    # leaves shared by all other trees
+    def __init__(self, metrics, ref_tree_names, block_size = 2000, storage = "csv", dtype = np.float64, pruned = ["glottolog"]):
         self.metrics = metrics
         self.ref_tree_names = ref_tree_names
+        self.block_size = block_size
+        self.storage = storage
+        self.dtype = dtype
+        self.pruned = pruned
+
+    def load_trees(self, tree_paths):
+        # PreparedTrees of the sampled trees, the reference trees come from
+        # the cache, together with the TaxonRegistry of all their leaves
+        num_sampled = len(tree_paths) - len(self.ref_tree_names)
+        trees = [PreparedTree(tree) for tree in read_trees(tree_paths[:num_sampled])]
+        trees += [prepared_tree(path) for (name, path) in zip(self.ref_tree_names, tree_paths[num_sampled:]) if name not in self.pruned]
+        leaf_sets = [tree.leaves for tree in trees if tree.tree is not None]
+        leaves = frozenset.intersection(*leaf_sets) if len(leaf_sets) > 0 else None
+        ref_trees = iter(trees[num_sampled:])
+        trees = trees[:num_sampled]
+        for (name, path) in zip(self.ref_tree_names, tree_paths[num_sampled:]):
+            trees.append(prepared_tree(path, leaves) if name in self.pruned else next(ref_trees))
+        registry = TaxonRegistry()
+        for tree in trees:
+            registry.register(sorted(tree.leaves))
+        return trees, registry
 
     def matrix(self, tree_paths, metric):
-        distance_matrix = [[0.0 for _ in range(i + 1)] for i in range(len(tree_paths))]
+        return self.matrix_rows(tree_paths, metric, 0, len(tree_paths))
+
+    def matrix_rows(self, tree_paths, metric, start, end):
+        # Distances are computed once per pair of distinct topologies
+        (trees, registry) = self.load_trees(tree_paths)
         if metric ==  "rf":
-            trees = []
-            for tree_path in tree_paths:
-                try:
-                    trees.append(Tree(tree_path))
-                except Exception as e:
-                    print(e)
-                    trees.append(None)
-            for i in range(len(trees)):
-                for j in range(i, len(trees)):
-                    assert(j >= i)
-                    rfd = rf_distance(trees[i], trees[j])
-                    distance_matrix[j][i] = rfd
-            return distance_matrix
+            (unique, inverse) = unique_topologies(trees)
+            m = Bipartitions([tree.tree for tree in unique], registry.ids).rf_matrix()
+            return [[float(el) for el in m[inverse[i], inverse[:i + 1]]] for i in range(start, end)]
         if metric == "gq":
-            for i in range(len(tree_paths)):
-                for j in range(i, len(tree_paths)):
-                    gqd = gq_distance(tree_paths[i], tree_paths[j])
-                    distance_matrix[j][i] = gqd
+            (unique, inverse) = unique_topologies(trees[:end])
+            quartet_trees = [tree.quartet_tree() for tree in unique]
+            cache = {}
+            distance_matrix = []
+            for i in range(start, end):
+                a = inverse[i]
+                if quartet_trees[a] is None:
+                    distance_matrix.append([float("nan") for _ in range(i + 1)])
+                    continue
+                row = []
+                # the distance counts butterflies, so it is symmetric
+                for b in inverse[:i + 1]:
+                    pair = (min(a, b), max(a, b))
+                    if pair not in cache:
+                        cache[pair] = float("nan") if quartet_trees[b] is None else quartet_trees[pair[0]].distance(quartet_trees[pair[1]])
+                    row.append(cache[pair])
+                distance_matrix.append(row)
             return distance_matrix
         else:
             print("Metric " + metric + " not defined")
 
-    def write_matrix(self, dist_dir, sampled_tree_paths, ref_tree_paths):
+    def metric_rows(self, tree_paths, metric, rows):
+        # Distances of the trees at the given indices to all trees, computed
+        # once per pair of distinct topologies
+        (trees, registry) = self.load_trees(tree_paths)
+        (unique, inverse) = unique_topologies(trees)
+        needed = sorted(set(inverse[rows].tolist()))
+        if metric == "rf":
+            res = Bipartitions([tree.tree for tree in unique], registry.ids).rf_rows(needed)
+        elif metric == "gq":
+            quartet_trees = [tree.quartet_tree() for tree in unique]
+            res = np.full((len(needed), len(unique)), float("nan"))
+            for (k, a) in enumerate(needed):
+                if quartet_trees[a] is not None:
+                    res[k] = quartet_trees[a].distances(quartet_trees)
+        else:
+            raise ValueError("Metric " + metric + " not defined")
+        position = {a: k for (k, a) in enumerate(needed)}
+        return res[[position[a] for a in inverse[rows].tolist()]][:, inverse]
+
+    def tree_paths(self, dist_dir, sampled_tree_paths, ref_tree_paths):
         if not os.path.isdir(dist_dir):
             os.makedirs(dist_dir)
         sampled_tree_paths = copy.deepcopy(sampled_tree_paths)
@@ -75,98 +755,450 @@ class DistanceMatrixIO:
             if not ref_tree_name in ref_tree_paths:
                 print("Path for " + ref_tree_name + " missing!")
                 shutil.rmtree(dist_dir)
-                return
+                return None
             sampled_tree_paths.append(ref_tree_paths[ref_tree_name])
+        return sampled_tree_paths
+
+    def write_rows(self, dist_dir, metric, m):
+        if self.storage == "npy":
+            condensed = np.array([el for row in m for el in row], dtype=self.dtype)
+            np.save(os.path.join(dist_dir, "matrix_" + metric + ".npy"), condensed)
+            return
+        matrix_path = os.path.join(dist_dir, "matrix_" + metric + ".csv")
+        with open(matrix_path, "w+") as dm_file:
+            dm_file.write("\n".join([",".join([str(el) for el in row]) for row in m]))
+
+    def write_header(self, dist_dir, num_trees, trees = None, engine = None):
+        # trees: [path, fingerprint, topology] per row, to extend the matrix
+        # later, engine: engine_version of the distances, the current one by
+        # default. The duplication ratio is the number of sampled trees per
+        # distinct sampled topology
+        header = {"ref_tree_names": self.ref_tree_names,
+                  "num_sampled": num_trees - len(self.ref_tree_names),
+                  "metrics": self.metrics,
+                  "dtype": np.dtype(self.dtype).name,
+                  "storage": self.storage,
+                  "engine": engine_version(self.pruned) if engine is None else engine}
+        if trees is not None:
+            header["trees"] = trees
+            topologies = [tree[2] for tree in trees[:header["num_sampled"]] if len(tree) > 2 and tree[2] is not None]
+            if len(topologies) > 0:
+                header["unique_topologies"] = len(set(topologies))
+                header["duplication_ratio"] = len(topologies) / len(set(topologies))
+        with open(os.path.join(dist_dir, "matrix.json"), "w+") as header_file:
+            json.dump(header, header_file)
+        return header
+
+    def tree_entries(self, tree_paths, fingerprints, reuse = None, stored_trees = None):
+        # [path, fingerprint, topology] per tree, topologies of reused trees
+        # are taken from the stored header
+        topologies = [None for _ in tree_paths]
+        if reuse is not None:
+            for (i, j) in enumerate(reuse):
+                if j != -1 and len(stored_trees[j]) > 2:
+                    topologies[i] = stored_trees[j][2]
+        todo = [i for i in range(len(tree_paths)) if topologies[i] is None]
+        for (i, tree) in zip(todo, read_trees([tree_paths[i] for i in todo])):
+            topologies[i] = topology_key(tree)
+        return [[path, fp, topology] for (path, fp, topology) in zip(tree_paths, fingerprints, topologies)]
+
+    def read_header(self, dist_dir):
+        header_path = os.path.join(dist_dir, "matrix.json")
+        if not os.path.isfile(header_path):
+            return None
+        with open(header_path, "r") as header_file:
+            return json.load(header_file)
+
+    def convert(self, dist_dir):
+        # Rewrites the CSV matrices of dist_dir in this instance's storage format
+        header = self.read_header(dist_dir)
+        dm = DistanceMatrix(dist_dir, self.ref_tree_names, self.metrics)
+        for metric in self.metrics:
+            self.write_rows(dist_dir, metric, dm.matrices[metric])
+        if header is None:
+            self.write_header(dist_dir, dm.num_sampled + dm.num_ref_trees, None, "")
+        else:
+            self.write_header(dist_dir, dm.num_sampled + dm.num_ref_trees, header.get("trees"), header.get("engine", ""))
+
+    def stored(self, dist_dir):
+        # The matrix already in dist_dir as ([path, fingerprint, topology]
+        # per row, {metric: full matrix}), None if there is none or it was
+        # computed by another engine_version, e.g. before glottolog pruning
+        header = self.read_header(dist_dir)
+        if header is None or "trees" not in header or header.get("engine") != engine_version(self.pruned):
+            return None
+        storage = header.get("storage", "npy")
+        matrices = {}
+        for metric in self.metrics:
+            path = os.path.join(dist_dir, "matrix_" + metric + "." + storage)
+            if not os.path.isfile(path):
+                return None
+            if storage == "npy":
+                matrices[metric] = square(np.load(path))
+            else:
+                with open(path, "r") as dm_file:
+                    matrices[metric] = square([float(val) for line in dm_file for val in line.split(",")])
+        n = len(matrices[self.metrics[0]])
+        if any(len(m) != n for m in matrices.values()):
+            return None
+        trees = header["trees"]
+        if len(trees) != n:
+            return None
+        return trees, matrices
+
+    def extension(self, dist_dir, tree_paths):
+        # (fingerprints, index of each tree in the stored matrix or -1, stored
+        # matrices, stored trees), None if nothing can be reused
+        fingerprints = [fingerprint(path) for path in tree_paths]
         try:
-            for metric in self.metrics:
-                matrix_path = os.path.join(dist_dir, "matrix_" + metric + ".csv")
-                m = self.matrix(sampled_tree_paths, metric)
-                with open(matrix_path, "w+") as dm_file:
-                    dm_file.write("\n".join([",".join([str(el) for el in row]) for row in m]))
+            stored = self.stored(dist_dir)
+        except Exception as e:
+            traceback.print_exc()
+            return None
+        if stored is None:
+            return None
+        (trees, matrices) = stored
+        old_indices = {}
+        for (j, tree) in enumerate(trees):
+            old_indices.setdefault(tree[0], (j, tree[1]))
+        reuse = []
+        for (path, new_fingerprint) in zip(tree_paths, fingerprints):
+            (j, old_fingerprint) = old_indices.get(path, (-1, None))
+            if old_fingerprint != new_fingerprint:
+                j = -1
+            reuse.append(j)
+        if -1 in reuse:
+            # new trees may change the leaves the pruned trees are pruned to
+            num_sampled = len(tree_paths) - len(self.ref_tree_names)
+            for (i, name) in enumerate(self.ref_tree_names):
+                if name in self.pruned:
+                    reuse[num_sampled + i] = -1
+        if all(j == -1 for j in reuse):
+            return None
+        return fingerprints, reuse, matrices, trees
+
+    def splice(self, matrix, reuse, missing, rows):
+        # Lower triangle of the extended matrix: stored distances among the
+        # reused trees, rows of the missing trees against all trees
+        n = len(reuse)
+        m = np.full((n, n), float("nan"))
+        new = [i for i in range(n) if reuse[i] != -1]
+        old = [reuse[i] for i in new]
+        m[np.ix_(new, new)] = matrix[np.ix_(old, old)]
+        if len(missing) > 0:
+            rows = np.asarray(rows, dtype=np.float64).reshape(len(missing), n)
+            m[missing, :] = rows
+            m[:, missing] = rows.T
+        return lower_triangle(m)
+
+    def write_matrix(self, dist_dir, sampled_tree_paths, ref_tree_paths):
+        with tracing.span("distances", dist_dir) as fields:
+            header = self.write_matrix_rows(dist_dir, sampled_tree_paths, ref_tree_paths)
+            if header is not None:
+                fields["duplication_ratio"] = header.get("duplication_ratio")
+
+    def write_matrix_rows(self, dist_dir, sampled_tree_paths, ref_tree_paths):
+        # Reuses the distances of a matrix already in dist_dir for all trees
+        # whose files are unchanged
+        tree_paths = self.tree_paths(dist_dir, sampled_tree_paths, ref_tree_paths)
+        if tree_paths is None:
+            return
+        try:
+            extension = self.extension(dist_dir, tree_paths)
+            if extension is None:
+                trees = self.tree_entries(tree_paths, [fingerprint(path) for path in tree_paths])
+                for metric in self.metrics:
+                    self.write_rows(dist_dir, metric, self.matrix(tree_paths, metric))
+            else:
+                (fingerprints, reuse, matrices, stored_trees) = extension
+                trees = self.tree_entries(tree_paths, fingerprints, reuse, stored_trees)
+                missing = [i for (i, j) in enumerate(reuse) if j == -1]
+                if reuse != list(range(len(reuse))) or len(matrices[self.metrics[0]]) != len(reuse):
+                    for metric in self.metrics:
+                        rows = self.metric_rows(tree_paths, metric, missing) if len(missing) > 0 else []
+                        self.write_rows(dist_dir, metric, self.splice(matrices[metric], reuse, missing, rows))
+            return self.write_header(dist_dir, len(tree_paths), trees)
         except Exception as e:
             traceback.print_exc()
             shutil.rmtree(dist_dir)
-        return
+        return None
+
+    def write_matrices(self, jobs, processes = 1):
+        # Parallel write_matrix for many (dist_dir, sampled_tree_paths,
+        # ref_tree_paths) jobs, split into (job, metric, row block) tasks which
+        # are started in order of decreasing estimated cost (taxa * trees).
+        # Jobs extending a stored matrix only compute the rows of new trees
+        tasks = []
+        blocks = {}
+        remaining = {}
+        extensions = {}
+        trees = {}
+        for (k, (dist_dir, sampled_tree_paths, ref_tree_paths)) in enumerate(jobs):
+            tree_paths = self.tree_paths(dist_dir, sampled_tree_paths, ref_tree_paths)
+            if tree_paths is None:
+                continue
+            n = len(tree_paths)
+            extension = self.extension(dist_dir, tree_paths)
+            if extension is None:
+                trees[k] = self.tree_entries(tree_paths, [fingerprint(path) for path in tree_paths])
+            else:
+                (fingerprints, reuse, matrices, stored_trees) = extension
+                trees[k] = self.tree_entries(tree_paths, fingerprints, reuse, stored_trees)
+                missing = [i for (i, j) in enumerate(reuse) if j == -1]
+                if reuse == list(range(n)) and len(matrices[self.metrics[0]]) == n:
+                    self.write_header(dist_dir, n, trees[k])
+                    continue
+                extensions[k] = (reuse, missing, matrices)
+            cost = num_taxa(tree_paths) * n
+            blocks[k] = {metric: {} for metric in self.metrics}
+            remaining[k] = 0
+            for metric in self.metrics:
+                if k in extensions:
+                    size = max(1, self.block_size // n)
+                    metric_blocks = [(start, min(len(missing), start + size)) for start in range(0, len(missing), size)]
+                    if metric == "rf" and len(missing) > 0:
+                        metric_blocks = [(0, len(missing))]
+                elif metric == "rf":
+                    metric_blocks = [(0, n)]
+                else:
+                    metric_blocks = row_blocks(n, self.block_size)
+                for (start, end) in metric_blocks:
+                    if k in extensions:
+                        share = (end - start) / n
+                        task = ((k, metric, start), self, tree_paths, metric, start, end, missing[start:end], dist_dir)
+                    else:
+                        share = (end * (end + 1) - start * (start + 1)) / max(1, n * (n + 1))
+                        task = ((k, metric, start), self, tree_paths, metric, start, end, None, dist_dir)
+                    tasks.append((cost * share, task))
+                    remaining[k] += 1
+        tasks = [task for (cost, task) in sorted(tasks, key=lambda t: -t[0])]
+        tracing.plan("distance_rows", len(tasks))
+        failed = set()
+        if processes > 1:
+            # fork, so the top-level experiment scripts are not re-executed in workers
+            pool = multiprocessing.get_context("fork").Pool(processes)
+            results = pool.imap_unordered(matrix_block, tasks)
+        else:
+            pool = None
+            results = map(matrix_block, tasks)
+        for k in [k for k in remaining if remaining[k] == 0]:
+            self.write_job(jobs[k][0], False, blocks.pop(k), extensions.get(k), trees[k])
+        for ((k, metric, start), rows) in results:
+            if rows is None:
+                failed.add(k)
+            blocks[k][metric][start] = rows
+            remaining[k] -= 1
+            if remaining[k] == 0:
+                self.write_job(jobs[k][0], k in failed, blocks.pop(k), extensions.get(k), trees[k])
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    def write_job(self, dist_dir, failed, blocks, extension, trees):
+        if failed:
+            shutil.rmtree(dist_dir)
+            return
+        with tracing.span("distance_write", dist_dir) as fields:
+            fields["duplication_ratio"] = self.write_job_rows(dist_dir, blocks, extension, trees).get("duplication_ratio")
+
+    def write_job_rows(self, dist_dir, blocks, extension, trees):
+        for metric in self.metrics:
+            if extension is None:
+                m = [row for start in sorted(blocks[metric]) for row in blocks[metric][start]]
+            else:
+                (reuse, missing, matrices) = extension
+                rows = [row for start in sorted(blocks[metric]) for row in blocks[metric][start]]
+                m = self.splice(matrices[metric], reuse, missing, rows)
+            self.write_rows(dist_dir, metric, m)
+        return self.write_header(dist_dir, len(trees), trees)
 
     def read_matrix(self, dist_dir):
         return DistanceMatrix(dist_dir, self.ref_tree_names, self.metrics)
 
 
 
+def nan_stats(a):
+    # Row-wise statistics ignoring NaN entries, NaN for rows without values
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return {"mean": np.nanmean(a, axis=1),
+                "max": np.nanmax(a, axis=1) if a.shape[1] > 0 else np.full(len(a), float("nan")),
+                "median": np.nanmedian(a, axis=1),
+                "std": np.nanstd(a, axis=1),
+                "count": (a == a).sum(axis=1)}
+
+
+class Triangle:
+
+    # Lower triangle including the diagonal stored as one condensed array,
+    # e.g. memory-mapped. Entry (i, j) with j <= i is at i * (i + 1) // 2 + j
+    def __init__(self, condensed):
+        self.condensed = condensed
+        self.num_rows = int((math.isqrt(8 * len(condensed) + 1) - 1) // 2)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.num_rows
+        start = i * (i + 1) // 2
+        return self.condensed[start:start + i + 1]
+
+    def __iter__(self):
+        return (self[i] for i in range(self.num_rows))
+
+    def index(self, i, j):
+        if i < 0:
+            i += self.num_rows
+        if j < 0:
+            j += self.num_rows
+        if j > i:
+            (i, j) = (j, i)
+        return i * (i + 1) // 2 + j
+
+    def get(self, i, j):
+        return self.condensed[self.index(i, j)]
+
+    def indices(self, rows, cols):
+        # Condensed positions of the entries (rows[a], cols[b])
+        rows = np.asarray(rows, dtype=np.int64)[:, None]
+        cols = np.asarray(cols, dtype=np.int64)[None, :]
+        high = np.maximum(rows, cols)
+        return high * (high + 1) // 2 + np.minimum(rows, cols)
+
+    def block(self, rows, cols):
+        return np.asarray(self.condensed[self.indices(rows, cols)], dtype=np.float64)
+
+    def leading(self, n):
+        # Full symmetric matrix of the first n rows and columns
+        return square(self.condensed[:n * (n + 1) // 2])
+
+    def upper(self, n):
+        # Entries above the diagonal of the first n rows and columns, in the
+        # row-major order of np.triu_indices
+        (rows, cols) = np.triu_indices(n, 1)
+        return np.asarray(self.condensed[cols * (cols + 1) // 2 + rows], dtype=np.float64)
+
+
 class DistanceMatrix:
 
-    def __init__(self, dist_dir, ref_tree_names, metrics):
+    # Read from dist_dir, or from condensed lower triangles per metric, e.g.
+    # as loaded from a ResultsStore. Each matrix is kept as one condensed
+    # array, converted to dtype if given (e.g. np.float32 to halve memory)
+    def __init__(self, dist_dir, ref_tree_names, metrics, condensed = None, dtype = None):
         self.num_ref_trees = len(ref_tree_names)
+        # position of a reference tree among them, they follow the sampled trees
         self.ref_tree_indices = {}
         for i, ref_tree_name in enumerate(ref_tree_names):
-            self.ref_tree_indices[ref_tree_name] = i - self.num_ref_trees
-        self. matrices = {}
+            self.ref_tree_indices[ref_tree_name] = i
+        self.matrices = {}
+        self.sampled_avg_cache = {}
+        if condensed is None:
+            condensed = self.read_condensed(dist_dir, ref_tree_names, metrics)
         for metric in metrics:
-            path = os.path.join(dist_dir, "matrix_" + metric + ".csv")
-            self.matrices[metric] = self.read_matrix(path)
+            self.matrices[metric] = Triangle(np.asarray(condensed[metric], dtype=dtype))
         self.num_sampled = len(self.matrices[metrics[0]]) - self.num_ref_trees
 
-
+    def read_condensed(self, dist_dir, ref_tree_names, metrics):
+        header_path = os.path.join(dist_dir, "matrix.json")
+        if os.path.isfile(header_path):
+            with open(header_path, "r") as header_file:
+                header = json.load(header_file)
+            if header["ref_tree_names"] != list(ref_tree_names):
+                raise ValueError("Reference trees " + str(header["ref_tree_names"]) + " stored in " + dist_dir)
+        condensed = {}
+        for metric in metrics:
+            path = os.path.join(dist_dir, "matrix_" + metric + ".npy")
+            if os.path.isfile(header_path) and header.get("storage", "npy") == "npy" and os.path.isfile(path):
+                condensed[metric] = np.load(path, mmap_mode="r")
+            else:
+                path = os.path.join(dist_dir, "matrix_" + metric + ".csv")
+                condensed[metric] = self.read_matrix(path)
+        return condensed
 
     def read_matrix(self, path):
-        return [[float(val) for val in row.split(',')] for row in open(path, "r").readlines()]
+        # Condensed lower triangle of a CSV matrix, row i has i + 1 entries
+        values = []
+        with open(path, "r") as matrix_file:
+            for (i, row) in enumerate(matrix_file):
+                row = row.split(",")
+                if len(row) != i + 1:
+                    raise ValueError("Row " + str(i) + " of " + path + " has " + str(len(row)) + " entries")
+                values.extend(float(val) for val in row)
+        return np.array(values, dtype=np.float64)
+
+    def condensed(self, metric):
+        return np.asarray(self.matrices[metric].condensed)
 
 
     def d(self, idx1, idx2, metric):
-        return self.matrices[metric][max(idx1, idx2)][min(idx1, idx2)]
+        return float(self.matrices[metric].get(idx1, idx2))
 
+    def ref_tree_position(self, tree):
+        return self.num_sampled + self.ref_tree_indices[tree]
 
     def ref_tree_dist(self, tree1, tree2, metric):
-        idx1 = self.ref_tree_indices[tree1]
-        idx2 = self.ref_tree_indices[tree2]
-        max_idx = max(idx1, idx2)
-        second_idx = min(idx1, idx2) - (max_idx + 1)
-        return self.matrices[metric][max_idx][second_idx]
+        return float(self.matrices[metric].get(self.ref_tree_position(tree1), self.ref_tree_position(tree2)))
+
+    def array(self, metric):
+        # Full symmetric matrix, built on every call as it takes twice the
+        # memory of the condensed one
+        return self.matrices[metric].leading(len(self.matrices[metric]))
+
+    def ref_tree_positions(self, trees = None):
+        if trees is None:
+            trees = list(self.ref_tree_indices)
+        return [self.ref_tree_position(tree) for tree in trees]
+
+    def ref_tree_dists(self, metric, trees = None):
+        positions = self.ref_tree_positions(trees)
+        return self.matrices[metric].block(positions, positions)
+
+    def ref_tree_dist_vectors(self, metric, trees = None):
+        # One row of distances to all sampled trees per reference tree
+        return self.matrices[metric].block(self.ref_tree_positions(trees), range(self.num_sampled))
+
+    def ref_tree_dist_stats(self, metric, trees = None):
+        return nan_stats(self.ref_tree_dist_vectors(metric, trees))
 
     def ref_tree_dist_vector(self, tree, metric):
-        idx = self.ref_tree_indices[tree]
-        offset = - idx - (self.num_ref_trees + 1)
-        res = self.matrices[metric][idx][:offset]
+        res = self.ref_tree_dist_vectors(metric, [tree])[0].tolist()
         assert(len(res) == self.num_sampled)
         return res
 
     def avg_ref_tree_dist(self, tree, metric):
-        dists = [x for x in self.ref_tree_dist_vector(tree, metric) if x==x]
-        if len(dists) == 0:
-            return float("nan")
-        return sum(dists) / len(dists)
+        return float(self.ref_tree_dist_stats(metric, [tree])["mean"][0])
 
     def max_ref_tree_dist(self, tree, metric):
-        dists = [x for x in self.ref_tree_dist_vector(tree, metric) if x==x]
-        if len(dists) == 0:
-            return float("nan")
-        return max(dists)
+        return float(self.ref_tree_dist_stats(metric, [tree])["max"][0])
+
+    def sampled_dists(self, metric):
+        # Distances among the sampled trees, NaN on the diagonal
+        block = self.matrices[metric].leading(self.num_sampled)
+        np.fill_diagonal(block, float("nan"))
+        return block
+
+    def sampled_avg_dist_array(self, metric):
+        if metric not in self.sampled_avg_cache:
+            self.sampled_avg_cache[metric] = nan_stats(self.sampled_dists(metric))["mean"]
+        return self.sampled_avg_cache[metric]
 
     def sampled_avg_dists(self, metric):
-        avg_dists = []
-        for i in range(self.num_sampled):
-            temp_dists = []
-            for j in range(self.num_sampled):
-                if i == j:
-                    continue
-                x = self.d(i, j, metric)
-                if x == x:
-                    temp_dists.append(x)
-            if len(temp_dists) == 0:
-                avg_dists.append(float("nan"))
-            else:
-                avg_dists.append(sum(temp_dists) / len(temp_dists))
-        return avg_dists
+        return self.sampled_avg_dist_array(metric).tolist()
 
+    def sampled_stats(self, metric):
+        # Summaries of the sampled block: statistics of the per tree average
+        # distances and of all pairwise distances
+        stats = {}
+        for (name, value) in nan_stats(self.sampled_avg_dist_array(metric)[None, :]).items():
+            stats[name + "_avg"] = float(value[0])
+        for (name, value) in nan_stats(self.matrices[metric].upper(self.num_sampled)[None, :]).items():
+            stats[name] = float(value[0])
+        return stats
 
     def sampled_avg_avg_dist(self, metric):
-        avg_dists = [x for x in self.sampled_avg_dists(metric) if x==x]
-        if len(avg_dists) == 0:
-            return float("nan")
-        return sum(avg_dists) / len(avg_dists)
+        return self.sampled_stats(metric)["mean_avg"]
 
     def sampled_max_avg_dist(self, metric):
-        avg_dists = [x for x in self.sampled_avg_dists(metric) if x==x]
-        if len(avg_dists) == 0:
-            return float("nan")
-        return max(avg_dists)
+        return self.sampled_stats(metric)["max_avg"]
@@ -0,0 +1,90 @@
+import warnings
+import numpy as np
+import pandas as pd
+
+try:
+    from code.distances import nan_stats
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    from distances import nan_stats
+
+
+# Features are declared per column as tuples:
+#   ("ref_stat", stat, tree, metric): statistic (mean, max, median, std, count)
+#       of the distances of reference tree to all sampled trees
+#   ("sampled_stat", stat, metric): entry of DistanceMatrix.sampled_stats,
+#       e.g. mean_avg, max_avg or the pairwise mean
+#   ("ref_dist", tree1, tree2, metric): distance of two reference trees
+kinds = ["ref_stat", "sampled_stat", "ref_dist"]
+
+def check(features):
+    for (column, feature) in features.items():
+        if feature[0] not in kinds:
+            raise ValueError("Unknown kind of feature " + column + ": " + str(feature[0]))
+
+def triangle_index(i, j):
+    # Condensed position of (i, j) in a lower triangle, elementwise
+    (i, j) = (np.maximum(i, j), np.minimum(i, j))
+    return i * (i + 1) // 2 + j
+
+def sampled_stats(stacked, num_sampled):
+    # DistanceMatrix.sampled_stats of all stacked triangles at once
+    idx = np.arange(num_sampled)
+    dists = stacked[:, triangle_index(idx[:, None], idx[None, :])]
+    dists[:, idx, idx] = float("nan")
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        avgs = np.nanmean(dists, axis=2)
+    stats = {name + "_avg": values for (name, values) in nan_stats(avgs).items()}
+    (rows, cols) = np.triu_indices(num_sampled, 1)
+    stats.update(nan_stats(stacked[:, cols * (cols + 1) // 2 + rows]))
+    return stats
+
+def group_features(dms, features):
+    # Feature columns of matrices with the same number of sampled and reference
+    # trees, each computed in one pass over their stacked condensed triangles
+    num_sampled = dms[0].num_sampled
+    rows = np.arange(len(dms))[:, None]
+    cols = np.arange(num_sampled)[None, :]
+    metrics = set(feature[-1] for feature in features.values())
+    stacked = {metric: np.stack([np.asarray(dm.condensed(metric), dtype=np.float64) for dm in dms]) for metric in metrics}
+    positions = {}
+    ref_stats = {}
+    sampled = {}
+    res = {}
+    for (column, feature) in features.items():
+        metric = feature[-1]
+        for tree in [feature[2]] if feature[0] == "ref_stat" else feature[1:3] if feature[0] == "ref_dist" else []:
+            if tree not in positions:
+                positions[tree] = np.array([dm.ref_tree_position(tree) for dm in dms], dtype=np.int64)
+        if feature[0] == "ref_stat":
+            key = (feature[2], metric)
+            if key not in ref_stats:
+                r = positions[feature[2]][:, None]
+                ref_stats[key] = nan_stats(stacked[metric][rows, r * (r + 1) // 2 + cols])
+            res[column] = ref_stats[key][feature[1]]
+        elif feature[0] == "sampled_stat":
+            if metric not in sampled:
+                sampled[metric] = sampled_stats(stacked[metric], num_sampled)
+            res[column] = sampled[metric][feature[1]]
+        else:
+            res[column] = stacked[metric][rows[:, 0], triangle_index(positions[feature[1]], positions[feature[2]])]
+    return res
+
+def dataset_features(distance_matrices, features):
+    # DataFrame with one column per feature and one row per DistanceMatrix,
+    # indexed like distance_matrices if it is a Series. The condensed
+    # triangles of all matrices with the same shape are stacked, so every
+    # column takes one vectorized pass per shape instead of one per matrix
+    check(features)
+    index = distance_matrices.index if isinstance(distance_matrices, pd.Series) else None
+    distance_matrices = list(distance_matrices)
+    columns = {column: np.full(len(distance_matrices), float("nan")) for column in features}
+    groups = {}
+    for (i, dm) in enumerate(distance_matrices):
+        if dm is not None:
+            groups.setdefault((dm.num_sampled, len(dm.ref_tree_indices)), []).append(i)
+    for members in groups.values():
+        for (column, values) in group_features([distance_matrices[i] for i in members], features).items():
+            columns[column][members] = values
+    return pd.DataFrame(columns, columns = list(features), index = index, dtype = float)
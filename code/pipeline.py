@@ -0,0 +1,195 @@
+import os
+import json
+import hashlib
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+hash_cache = {}
+
+def file_hash(path):
+    # Content hash, cached per (path, mtime, size)
+    if not os.path.isfile(path):
+        return ""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in hash_cache:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        hash_cache[key] = h.hexdigest()
+    return hash_cache[key]
+
+
+class Node:
+
+    # One unit of work: its key hashes the params, the contents of the input
+    # files (MSAs, binaries, ...) and the outputs of all dependencies.
+    # Outputs are removed before a rerun with a changed key unless clean is
+    # False, e.g. for nodes which extend their previous outputs. A partial
+    # node also runs after dependencies which completed without all their
+    # outputs, e.g. failed predictions which it reports as NaN
+    def __init__(self, name, run, inputs = [], params = [], deps = [], outputs = [], cores = 1, clean = True, partial = False):
+        self.name = name
+        self.run = run
+        self.inputs = inputs
+        self.params = params
+        self.deps = deps
+        self.outputs = outputs
+        self.cores = cores
+        self.clean = clean
+        self.partial = partial
+
+    def key(self, nodes):
+        h = hashlib.sha256()
+        for param in self.params:
+            h.update(("param " + str(param) + "\n").encode())
+        for path in self.inputs:
+            h.update(("input " + path + " " + file_hash(path) + "\n").encode())
+        for dep in self.deps:
+            for path in nodes[dep].outputs:
+                h.update(("dep " + path + " " + file_hash(path) + "\n").encode())
+        return h.hexdigest()
+
+
+class Pipeline:
+
+    def __init__(self, state_path):
+        self.state_path = state_path
+        self.nodes = {}
+        self.lock = threading.Lock()
+
+    def add(self, node):
+        if node.name in self.nodes:
+            raise ValueError("Node " + node.name + " defined twice")
+        self.nodes[node.name] = node
+        return node
+
+    def read_state(self):
+        if not os.path.isfile(self.state_path):
+            return {}
+        with open(self.state_path, "r") as state_file:
+            return json.load(state_file)
+
+    def write_state(self, state):
+        d = os.path.dirname(self.state_path)
+        if d != "" and not os.path.isdir(d):
+            os.makedirs(d)
+        with open(self.state_path + ".tmp", "w+") as state_file:
+            json.dump(state, state_file, indent=0, sort_keys=True)
+        os.replace(self.state_path + ".tmp", self.state_path)
+
+    def order(self):
+        # Dependency order, raises on missing dependencies and cycles
+        res = []
+        marks = {}
+        for name in self.nodes:
+            stack = [(name, False)]
+            while len(stack) > 0:
+                (current, expanded) = stack.pop()
+                if expanded:
+                    marks[current] = "done"
+                    res.append(current)
+                    continue
+                if marks.get(current) == "done":
+                    continue
+                if marks.get(current) == "active":
+                    raise ValueError("Cyclic dependency at " + current)
+                if current not in self.nodes:
+                    raise ValueError("Unknown dependency " + current)
+                marks[current] = "active"
+                stack.append((current, True))
+                for dep in self.nodes[current].deps:
+                    if marks.get(dep) != "done":
+                        stack.append((dep, False))
+        return res
+
+    def run_node(self, node, key, state):
+        # Outputs of a node which never ran under the pipeline, or whose
+        # previous run left some outputs missing, are kept
+        recorded = state.get(node.name)
+        for path in node.outputs:
+            if node.clean and recorded is not None and recorded != key and os.path.isfile(path):
+                os.remove(path)
+        try:
+            node.run()
+        except Exception as e:
+            traceback.print_exc()
+            return "failed"
+        with self.lock:
+            state[node.name] = key
+            self.write_state(state)
+        if not all(os.path.isfile(path) for path in node.outputs):
+            print("Node " + node.name + " did not produce all outputs")
+            return "incomplete"
+        return "done"
+
+    def run(self, cores = None):
+        # Runs the invalidated nodes in dependency order, independent nodes in
+        # parallel as long as their cores fit into the budget. A node is
+        # invalidated if its key changed or one of its outputs is missing.
+        # Outputs of nodes without recorded state, e.g. of runs before the
+        # pipeline existed, are adopted if all exist. Dependents of failed
+        # nodes are skipped, as are those of incomplete nodes unless partial
+        if cores is None:
+            cores = os.cpu_count()
+        order = self.order()
+        state = self.read_state()
+        status = {}
+        missing = {name: len(set(self.nodes[name].deps)) for name in order}
+        dependents = {name: [] for name in order}
+        for name in order:
+            for dep in set(self.nodes[name].deps):
+                dependents[dep].append(name)
+        ready = [name for name in order if missing[name] == 0]
+        waiting = []
+        running = {}
+        free = cores
+
+        def finish(name, s):
+            status[name] = s
+            for dependent in dependents[name]:
+                missing[dependent] -= 1
+                if missing[dependent] == 0:
+                    ready.append(dependent)
+
+        with ThreadPoolExecutor(max_workers=max(1, cores)) as executor:
+            while len(status) < len(order):
+                adopted = False
+                while len(ready) > 0:
+                    name = ready.pop(0)
+                    node = self.nodes[name]
+                    blocking = ["failed", "skipped"] if node.partial else ["failed", "skipped", "incomplete"]
+                    if any(status[dep] in blocking for dep in node.deps):
+                        print("Skipping " + name)
+                        finish(name, "skipped")
+                        continue
+                    key = node.key(self.nodes)
+                    complete = all(os.path.isfile(path) for path in node.outputs)
+                    if complete and state.get(name) is None:
+                        with self.lock:
+                            state[name] = key
+                        adopted = True
+                    if state.get(name) == key and complete:
+                        finish(name, "valid")
+                        continue
+                    waiting.append((name, key))
+                if adopted:
+                    with self.lock:
+                        self.write_state(state)
+                for (name, key) in list(waiting):
+                    node_cores = min(self.nodes[name].cores, cores)
+                    if node_cores <= free:
+                        waiting.remove((name, key))
+                        free -= node_cores
+                        running[executor.submit(self.run_node, self.nodes[name], key, state)] = name
+                if len(running) == 0:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    free += min(self.nodes[name].cores, cores)
+                    finish(name, future.result())
+        return status
@@ -0,0 +1,146 @@
+import os
+import shlex
+import asyncio
+import subprocess
+
+try:
+    import code.tracing as tracing
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    import tracing
+
+
+# External tools run without a shell from an asyncio event loop: run() and
+# run_all() for synchronous callers, run_async() and Manager for coroutines.
+# stderr is always captured, stdout only on request, otherwise it goes to
+# our stdout. A process exceeding its timeout is terminated, and killed
+# after kill_grace seconds
+kill_grace = 5
+# characters of stderr shown in error messages
+max_message = 2000
+
+
+class Result:
+
+    def __init__(self, argv, returncode, stdout, stderr, timed_out = False):
+        self.argv = argv
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.timed_out = timed_out
+
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def describe(self):
+        if self.timed_out:
+            res = "timed out"
+        elif self.returncode is None:
+            res = "could not be started"
+        else:
+            res = "failed with exit status " + str(self.returncode)
+        res = shlex.join(self.argv) + " " + res
+        stderr = self.stderr.strip()
+        if stderr != "":
+            res += ":\n" + (stderr if len(stderr) <= max_message else "..." + stderr[-max_message:])
+        return res
+
+    def check(self):
+        if not self.ok():
+            raise ProcessError(self)
+        return self
+
+
+class ProcessError(Exception):
+
+    def __init__(self, result):
+        super().__init__(result.describe())
+        self.result = result
+
+
+async def read_all(pipe):
+    if pipe is None:
+        return ""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    (transport, _) = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        return (await reader.read()).decode(errors = "replace")
+    finally:
+        transport.close()
+
+async def exited(pid):
+    # Returns once the process exited, without reaping it so tracing can
+    # still read its I/O counters and resource usage
+    loop = asyncio.get_running_loop()
+    try:
+        fd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        while os.waitid(os.P_PID, pid, os.WEXITED | os.WNOWAIT | os.WNOHANG) is None:
+            await asyncio.sleep(0.05)
+        return
+    future = loop.create_future()
+    loop.add_reader(fd, lambda: future.done() or future.set_result(None))
+    try:
+        await future
+    finally:
+        loop.remove_reader(fd)
+        os.close(fd)
+
+async def run_async(argv, stage, target, timeout = None, capture = False, **fields):
+    argv = [str(arg) for arg in argv]
+    try:
+        command = tracing.Command(argv, stage, target, stdout = subprocess.PIPE if capture else None,
+            stderr = subprocess.PIPE, **fields)
+    except OSError as e:
+        return Result(argv, None, "", str(e))
+    readers = [asyncio.ensure_future(read_all(command.process.stdout)), asyncio.ensure_future(read_all(command.process.stderr))]
+    timed_out = False
+    try:
+        await asyncio.wait_for(exited(command.process.pid), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        command.fields["timed_out"] = True
+        command.process.terminate()
+        try:
+            await asyncio.wait_for(exited(command.process.pid), kill_grace)
+        except asyncio.TimeoutError:
+            command.process.kill()
+            await exited(command.process.pid)
+    returncode = command.wait()
+    (stdout, stderr) = await asyncio.gather(*readers)
+    return Result(argv, returncode, stdout, stderr, timed_out)
+
+
+class Manager:
+
+    # At most capacity slots busy at once, a job taking cost of them, e.g.
+    # its threads. Waiting jobs start in submission order as soon as they fit
+    def __init__(self, capacity = None):
+        self.capacity = capacity if capacity is not None else os.cpu_count()
+        self.free = self.capacity
+        self.condition = asyncio.Condition()
+
+    async def run(self, argv, stage, target, cost = 1, **kwargs):
+        cost = min(cost, self.capacity)
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.free >= cost)
+            self.free -= cost
+        try:
+            return await run_async(argv, stage, target, **kwargs)
+        finally:
+            async with self.condition:
+                self.free += cost
+                self.condition.notify_all()
+
+
+def run(argv, stage, target, timeout = None, capture = False, **fields):
+    return asyncio.run(run_async(argv, stage, target, timeout, capture, **fields))
+
+def run_all(jobs, capacity = None):
+    # jobs are dicts of the arguments of Manager.run, the results are in the
+    # same order
+    async def main():
+        manager = Manager(capacity)
+        return await asyncio.gather(*[manager.run(**job) for job in jobs])
+    return asyncio.run(main())
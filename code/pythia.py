@@ -1,7 +1,20 @@
 import os
+import sys
+import tempfile
+import argparse
+import multiprocessing
+
+try:
+    import code.tracing as tracing
+    import code.processes as external_processes
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    import tracing
+    import processes as external_processes
 
 raxmlng_path = ""
 predictor_path = ""
+predictor = None
 
 
 def get_difficulty(prefix):
@@ -13,54 +26,150 @@ def get_difficulty(prefix):
             return float("nan")
         return float(lines[0])
 
+def padding(num_sites):
+    # Pads the last block of 10 columns, a full one gets a new block
+    block_size = num_sites % 10
+    if block_size == 0:
+        return (10, " ----------")
+    return (10 - block_size, "-" * (10 - block_size))
+
+def pad_phylip(infile, outfile):
+    # Streams an interleaved or sequential PHYLIP MSA, only the current block
+    # is buffered as the last one is the one to be padded
+    header = infile.readline()
+    content = header.rstrip("\r\n")
+    header_parts = content.split(" ")
+    num_sites = int(header_parts[-1])
+    (padding_size, append_string) = padding(num_sites)
+    outfile.write(" ".join(header_parts[:-1] + [str(num_sites + padding_size)]) + header[len(content):])
+    block = []
+    blank_lines = []
+    for line in infile:
+        if line.strip() == "":
+            blank_lines.append(line)
+            continue
+        if len(blank_lines) > 0:
+            outfile.writelines(block + blank_lines)
+            block = []
+            blank_lines = []
+        block.append(line)
+    for line in block:
+        content = line.rstrip("\r\n")
+        outfile.write(content + append_string + (line[len(content):] or "\n"))
+    outfile.writelines(blank_lines)
+
 def write_padded_msa(msa_path, outpath):
     with open(msa_path, "r") as msa_file:
-        msa_string = msa_file.read()
-    parts = msa_string.split("\n\n")
-    lines = parts[-1].split("\n")
-    block_size = len(lines[1].split(" ")[-1])
-    if block_size == 10:
-        padding_size = 10
-        append_string = " ----------"
-    else:
-        padding_size = 10 - block_size
-        append_string = "-" * padding_size
-    if len(parts) != 1:
-        msa_string = "\n\n".join(parts[:-1] + ["\n".join([line + append_string for line in lines[:-1]] + [lines[-1]])])
-    else:
-        msa_string = "\n".join([lines[0]] + [line + append_string for line in lines[1:-1]] + [lines[-1]])
-
-    parts = msa_string.split("\n")
-    sub_parts = parts[0].split(" ")
-
-    msa_string = "\n".join([" ".join(sub_parts[:-1] + [str(int(sub_parts[-1]) + padding_size)])] + parts[1:])
-
-    with open(outpath, "w+") as new_msa_file:
-        new_msa_file.write(msa_string)
-
-def run(msa_path, prefix):
-    if os.path.isfile(prefix):
-        print("Files with prefix " + prefix + " already exist")
+        with open(outpath, "w+") as new_msa_file:
+            pad_phylip(msa_file, new_msa_file)
+
+def load_predictor():
+    # Unpickled once per process, forked workers inherit it
+    global predictor
+    if predictor is None:
+        with tracing.span("pythia_startup", predictor_path):
+            from pypythia.predictor import DifficultyPredictor
+            with open(predictor_path, "rb") as predictor_file:
+                predictor = DifficultyPredictor(predictor_file)
+    return predictor
+
+def predict(msa_path, temp_dir):
+    from pypythia.msa import MSA
+    from pypythia.raxmlng import RAxMLNG
+    from pypythia.prediction import get_all_features
+    msa = MSA(msa_path)
+    # same as --removeDuplicates of the pythia CLI
+    if msa.contains_duplicate_sequences():
+        reduced_msa_path = os.path.join(temp_dir, "reduced.phy")
+        msa.save_reduced_alignment(reduced_msa_path)
+        msa = MSA(reduced_msa_path)
+    features = get_all_features(RAxMLNG(raxmlng_path), msa)
+    # rounded to 2 decimals like the output file of the pythia CLI
+    return round(float(load_predictor().predict(features)), 2)
+
+def difficulty(msa_path):
+    if not os.path.isfile(msa_path):
+        print("MSA " + msa_path + " does not exist")
+        return float("nan")
+    with tempfile.TemporaryDirectory() as temp_dir:
+        try:
+            return predict(msa_path, temp_dir)
+        except Exception as e:
+            print("Prediction for " + msa_path + " failed (" + str(e) + "), retrying with padded MSA")
+        padded_msa_path = os.path.join(temp_dir, "padded.phy")
+        write_padded_msa(msa_path, padded_msa_path)
+        try:
+            return predict(padded_msa_path, temp_dir)
+        except Exception as e:
+            print("Prediction for padded " + msa_path + " failed (" + str(e) + ")")
+            return float("nan")
+
+def traced_difficulty(job):
+    (msa_path, target) = job
+    with tracing.span("pythia", target, msa = msa_path):
+        return difficulty(msa_path)
+
+def difficulties(msa_paths, processes = 1, targets = None):
+    # targets name the predictions in the trace, by default the MSA paths
+    load_predictor()
+    jobs = list(zip(msa_paths, msa_paths if targets is None else targets))
+    if processes == 1 or len(msa_paths) < 2:
+        return [traced_difficulty(job) for job in jobs]
+    with multiprocessing.get_context("fork").Pool(min(processes, len(msa_paths))) as pool:
+        return pool.map(traced_difficulty, jobs, chunksize = 1)
+
+def write_difficulty(prefix, d):
+    dir_path = os.path.dirname(prefix)
+    if dir_path != "" and not os.path.isdir(dir_path):
+        os.makedirs(dir_path)
+    with open(prefix, "w+") as outfile:
+        outfile.write(str(d) + "\n")
+
+def run_batch(msa_paths, prefixes, processes = 1):
+    # Predicts the difficulties of all MSAs whose prefix does not exist yet,
+    # failed predictions are not written so they are retried on the next run
+    todo = [(msa_path, prefix) for (msa_path, prefix) in zip(msa_paths, prefixes) if not os.path.isfile(prefix)]
+    if len(todo) == 0:
         return
-    d = "/".join(prefix.split("/")[:-1])
-    if not os.path.isdir(d):
-        os.makedirs(d)
-    command = "pythia -m " + msa_path + " -o " + prefix + " -r " + raxmlng_path + " -p " + predictor_path + " --removeDuplicates -v"
-    print(command)
-    os.system(command)
+    tracing.plan("pythia", len(todo))
+    res = difficulties([msa_path for (msa_path, _) in todo], processes, [prefix for (_, prefix) in todo])
+    for ((msa_path, prefix), d) in zip(todo, res):
+        if d == d:
+            write_difficulty(prefix, d)
 
+def batch_command(msa_paths, prefixes, processes = 1):
+    argv = [sys.executable, os.path.abspath(__file__), "--raxmlng", raxmlng_path, "--predictor", predictor_path, "--processes", processes]
+    if tracing.trace_path != "":
+        argv += ["--trace", tracing.trace_path]
+    for (msa_path, prefix) in zip(msa_paths, prefixes):
+        argv += [msa_path, prefix]
+    return argv
 
-def run_with_padding(msa_path, prefix):
-    run(msa_path, prefix)
-    d = get_difficulty(prefix)
-    if d != d:
-        if not os.path.isfile(msa_path):
-            print("MSA " + msa_path + " does not exist")
-            return
-        os.remove(prefix)
-        write_padded_msa(msa_path, "temp.phy")
-        run("temp.phy", prefix)
-        os.remove("temp.phy")
+def run_batch_process(msa_paths, prefixes, processes = 1):
+    # run_batch in a new process, for callers with threads: the pool of
+    # run_batch forks, which may deadlock on locks held by other threads
+    todo = [(msa_path, prefix) for (msa_path, prefix) in zip(msa_paths, prefixes) if not os.path.isfile(prefix)]
+    if len(todo) == 0:
+        return
+    result = external_processes.run(batch_command([msa_path for (msa_path, _) in todo], [prefix for (_, prefix) in todo], processes),
+        "pythia_batch", todo[0][1], num_msas = len(todo))
+    if not result.ok():
+        print(result.describe())
 
+def run_with_padding(msa_path, prefix):
+    run_batch([msa_path], [prefix])
 
 
+if __name__ == "__main__":
+    # python code/pythia.py [options] msa_path prefix [msa_path prefix ...]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raxmlng", required = True)
+    parser.add_argument("--predictor", required = True)
+    parser.add_argument("--processes", type = int, default = 1)
+    parser.add_argument("--trace", default = "")
+    parser.add_argument("paths", nargs = "+")
+    args = parser.parse_args()
+    raxmlng_path = args.raxmlng
+    predictor_path = args.predictor
+    tracing.trace_path = args.trace
+    run_batch(args.paths[0::2], args.paths[1::2], args.processes)
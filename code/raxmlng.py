@@ -1,8 +1,14 @@
 import os
+import json
+import shlex
 from ete3 import Tree
 import code.distances as distances
+import code.tracing as tracing
+import code.processes as processes
 
 exe_path = ""
+# seconds after which an inference is stopped, None for no limit
+timeout = None
 
 
 def best_tree_path(prefix):
@@ -15,68 +21,202 @@ def avg_ml_tree_dist(prefix):
     path = ml_trees_path(prefix)
     if not os.path.isfile(path):
         return float('nan')
-    trees = [Tree(l) for l in open(path, "r").readlines()]
-    dists = []
-    for (i, tree1) in enumerate(trees):
-        for j in range(i+1, len(trees)):
-            tree2 = trees[j]
-            dists.append(distances.rf_distance(tree1, tree2))
-    return sum(dists) / len(dists)
+    return distances.read_bipartitions(path).rf_stats()[0]
+
+def ml_tree_dist_distribution(prefix):
+    # Distinct pairwise RF distances of the ML trees and their frequencies
+    path = ml_trees_path(prefix)
+    if not os.path.isfile(path):
+        return None
+    return distances.read_bipartitions(path).rf_distribution()
 
 
 def consensus_tree_path(prefix):
     return prefix + ".raxml.consensusTreeMR"
 
+def log_path(prefix):
+    return prefix + ".raxml.log"
+
+def log_cache_path(prefix):
+    return prefix + ".raxml.log.json"
+
+
+class LogRecord:
+
+    # Everything we read from a .raxml.log, model parameters per partition
+    def __init__(self, values = {}):
+        self.model = values.get("model", "")
+        self.sites = values.get("sites", -1)
+        self.patterns = values.get("patterns", -1)
+        self.alphas = values.get("alphas", [])
+        self.base_frequencies = values.get("base_frequencies", [])
+        self.substitution_rates = values.get("substitution_rates", [])
+        self.tree_llhs = values.get("tree_llhs", [])
+        self.llh = values.get("llh", float("nan"))
+        self.aic = values.get("aic", float("nan"))
+        self.aicc = values.get("aicc", float("nan"))
+        self.bic = values.get("bic", float("nan"))
+        self.free_params = values.get("free_params", -1)
+        self.runtime = values.get("runtime", float("nan"))
+
+    def values(self):
+        return dict(self.__dict__)
+
+    def alpha(self):
+        if len(self.alphas) == 0:
+            return float("nan")
+        return self.alphas[0]
+
+    def num_trees(self):
+        return len(self.tree_llhs)
+
+
+def parse_log(path):
+    record = LogRecord()
+    with open(path, "r") as logfile:
+        for line in logfile:
+            try:
+                if line.startswith("   Rate heterogeneity:"):
+                    record.alphas.append(float(line.split(",  ")[1].split(" ")[1]))
+                elif line.startswith("   Base frequencies"):
+                    record.base_frequencies.append([float(part) for part in line.split(": ")[1].split(" ")[:-1]])
+                elif line.startswith("   Substitution rates"):
+                    record.substitution_rates.append([float(part) for part in line.split(": ")[1].split(" ")[:-1]])
+                elif line.startswith("Model: ") and record.model == "":
+                    record.model = line.split(": ")[1].strip()
+                elif line.startswith("Alignment sites / patterns: ") and record.sites == -1:
+                    parts = line.split(": ")[1].split(" / ")
+                    record.sites = int(parts[0])
+                    record.patterns = int(parts[1])
+                elif "ML tree search #" in line:
+                    record.tree_llhs.append(float(line.split("logLikelihood: ")[1].split(",")[0]))
+                elif line.startswith("Final LogLikelihood: "):
+                    record.llh = float(line.split(": ")[1])
+                elif line.startswith("AIC score: "):
+                    parts = line.split(" / ")
+                    record.aic = float(parts[0].split(": ")[1])
+                    record.aicc = float(parts[1].split(": ")[1])
+                    record.bic = float(parts[2].split(": ")[1])
+                elif line.startswith("Free parameters"):
+                    record.free_params = int(line.split(": ")[1])
+                elif line.startswith("Elapsed time: ") or " / Elapsed time: " in line:
+                    record.runtime = float(line.split("Elapsed time: ")[1].split(" ")[0])
+            except (IndexError, ValueError):
+                print("Cannot parse line of " + path + ": " + line.strip())
+    return record
+
+def log_record(prefix):
+    # Parsed once, afterwards read from a sidecar which is valid as long as
+    # mtime and size of the log are unchanged. None if there is no log
+    path = log_path(prefix)
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    cache_path = log_cache_path(prefix)
+    if os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "r") as cache_file:
+                cache = json.load(cache_file)
+            if cache["mtime_ns"] == stat.st_mtime_ns and cache["size"] == stat.st_size:
+                return LogRecord(cache["record"])
+        except (ValueError, KeyError):
+            pass
+    record = parse_log(path)
+    cache = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size, "record": record.values()}
+    with open(cache_path + ".tmp" + str(os.getpid()), "w+") as cache_file:
+        json.dump(cache, cache_file, separators = (",", ":"))
+    os.replace(cache_path + ".tmp" + str(os.getpid()), cache_path)
+    return record
+
 def alpha(prefix):
-    with open(prefix + ".raxml.log", "r") as logfile:
-        lines = logfile.readlines()
-    for line in lines:
-        if line.startswith("   Rate heterogeneity:"):
-            return float(line.split(",  ")[1].split(" ")[1])
-    return float('nan')
+    record = log_record(prefix)
+    if record is None:
+        return float('nan')
+    return record.alpha()
 
 def base_frequencies(prefix):
-    with open(prefix + ".raxml.log", "r") as logfile:
-        lines = logfile.readlines()
-    for line in lines:
-        if line.startswith("   Base frequencies"):
-            parts = line.split(": ")[1].split(" ")[:-1]
-            return [float(part) for part in parts]
-    return []
-
-def consense_tree(prefixes, prefix, args = ""):
-    if not os.path.isfile(consensus_tree_path(prefix)):
-        args = args + " --redo"
-    with open("trees.nw", "w+") as outfile:
-        for p in prefixes:
-            tree_path = best_tree_path(p)
-            if os.path.isfile(tree_path):
-                with open(tree_path, "r") as infile:
-                    outfile.write(infile.read())
-    command = exe_path
-    command += " --consense"
-    command += " --tree trees.nw "
-    command += " --prefix " + prefix
-    os.system(command)
-    os.remove("trees.nw")
-
-
-def run_inference(msa_path, model, prefix, args = ""):
+    record = log_record(prefix)
+    if record is None or len(record.base_frequencies) == 0:
+        return []
+    return record.base_frequencies[0]
+
+def consense_tree(prefixes, prefix, extended = False):
+    # Built in-process from the available best trees, returns the consensus
+    # splits with their supports
+    trees = [tree for tree in distances.read_trees([best_tree_path(p) for p in prefixes if os.path.isfile(best_tree_path(p))]) if tree is not None]
+    if len(trees) == 0:
+        print("No trees for consensus " + prefix)
+        return []
+    path = consensus_tree_path(prefix)
+    if extended:
+        path += "E"
+    d = os.path.dirname(path)
+    if d != "" and not os.path.isdir(d):
+        os.makedirs(d)
+    with tracing.span("consense", prefix, trees = len(trees)):
+        return distances.write_consensus(trees, path, extended)
+
+
+def prepare_inference(msa_path, prefix, args = ""):
+    # Returns the args to run with, None if the inference cannot be run
     if exe_path == "":
         print("Please specify raxmlng.exe_path")
-        return
+        return None
     if not os.path.isfile(msa_path):
         print("MSA " + msa_path + " does not exist")
-        return
+        return None
     prefix_dir = "/".join(prefix.split("/")[:-1])
     if not os.path.isdir(prefix_dir):
         os.makedirs(prefix_dir)
     if not os.path.isfile(best_tree_path(prefix)):
         args = args + " --redo"
-    command = exe_path
-    command += " --msa " + msa_path
-    command += " --model " + model
-    command += " --prefix " + prefix
-    command += " --threads auto --seed 2"
-    command += " " + args
-    os.system(command)
+    return args
+
+def inference_command(msa_path, model, prefix, args = "", threads = "auto"):
+    return [exe_path, "--msa", msa_path, "--model", model, "--prefix", prefix,
+            "--threads", str(threads), "--seed", "2"] + shlex.split(args)
+
+def report_failure(prefix, result):
+    if not result.ok():
+        print("Inference " + prefix + " " + result.describe())
+
+def run_inference(msa_path, model, prefix, args = "", threads = "auto"):
+    args = prepare_inference(msa_path, prefix, args)
+    if args is None:
+        return
+    report_failure(prefix, processes.run(inference_command(msa_path, model, prefix, args, threads), "raxmlng", prefix, timeout, threads = threads))
+
+
+def num_sites(msa_path):
+    # Number of characters from the PHYLIP header, 0 if it cannot be read
+    try:
+        with open(msa_path, "r") as msa_file:
+            return int(msa_file.readline().split()[1])
+    except Exception:
+        return 0
+
+def inference_threads(msa_path, cores, sites_per_thread = 300):
+    # Small MSAs scale poorly beyond a few threads
+    return max(1, min(cores, -(-num_sites(msa_path) // sites_per_thread)))
+
+def run_inferences(jobs, cores = None, sites_per_thread = 300):
+    # Runs (msa_path, model, prefix, args) jobs concurrently with an explicit
+    # thread count per job such that at most cores threads are busy. Jobs
+    # with an existing bestTree are skipped, as raxml-ng without --redo would
+    if cores is None:
+        cores = os.cpu_count()
+    pending = []
+    for (msa_path, model, prefix, args) in jobs:
+        if os.path.isfile(best_tree_path(prefix)):
+            continue
+        job_args = prepare_inference(msa_path, prefix, args)
+        if job_args is None:
+            continue
+        threads = inference_threads(msa_path, cores, sites_per_thread)
+        pending.append((threads, inference_command(msa_path, model, prefix, job_args, threads), prefix))
+    pending.sort(key=lambda job: -job[0])
+    tracing.plan("raxmlng", len(pending))
+    results = processes.run_all([{"argv": command, "stage": "raxmlng", "target": prefix, "cost": threads, "timeout": timeout, "threads": threads}
+        for (threads, command, prefix) in pending], cores)
+    for ((threads, command, prefix), result) in zip(pending, results):
+        report_failure(prefix, result)
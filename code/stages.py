@@ -0,0 +1,232 @@
+import os
+import functools
+import numpy as np
+import pandas as pd
+
+import code.raxmlng as raxmlng
+import code.pythia as pythia
+import code.distances as distances
+from code.distances import DistanceMatrixIO, DistanceMatrix
+import code.adaptive as adaptive
+from code.pipeline import Pipeline, Node
+from code.workqueue import WorkQueue
+import code.util as util
+
+
+results_dir = "data/results"
+num_processes = os.cpu_count()
+
+
+def run_raxml_ng(df):
+    jobs = []
+    for (i, row) in df.iterrows():
+        jobs.append((row["msa_paths"]["bin"], "BIN+G", util.prefix(results_dir, row, "raxmlng", "bin"), ""))
+        jobs.append((row["msa_paths"]["catg_bin"], "BIN+G", util.prefix(results_dir, row, "raxmlng" , "catg_bin"), "--prob-msa on"))
+        jobs.append((row["msa_paths"]["catg_multi"], row["MULTIx_MK"] + "+G", util.prefix(results_dir, row, "raxmlng", "catg_multi"), "--prob-msa on"))
+        for (i, msa_path) in enumerate(row["sampled_msa_paths"]):
+            jobs.append((msa_path, "BIN+G", util.prefix(results_dir, row, "raxmlng", "sampled/sampled" + str(i)), ""))
+    raxmlng.run_inferences(jobs, num_processes)
+
+
+def pythia_runs(row):
+    return [("bin", row["msa_paths"]["bin"])] + [("sampled/sampled" + str(i), msa_path) for (i, msa_path) in enumerate(row["sampled_msa_paths"])]
+
+def run_pythia(df):
+    msa_paths = []
+    prefixes = []
+    for (i, row) in df.iterrows():
+        for (run, msa_path) in pythia_runs(row):
+            msa_paths.append(msa_path)
+            prefixes.append(util.prefix(results_dir, row, "pythia", run))
+    pythia.run_batch(msa_paths, prefixes, num_processes)
+
+def consense_trees(df):
+    for (i, row) in df.iterrows():
+        prefixes = []
+        for (i, msa_path) in enumerate(row["sampled_msa_paths"]):
+            prefixes.append(util.prefix(results_dir, row, "raxmlng", "sampled/sampled" + str(i)))
+        raxmlng.consense_tree(prefixes, util.prefix(results_dir, row, "raxmlng", "sampled_consensus"))
+
+def calculate_distances(df):
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    d_io = DistanceMatrixIO(metrics, ref_tree_names)
+    jobs = []
+    for (i, row) in df.iterrows():
+        dist_dir = util.dist_dir(results_dir, row)
+        ref_tree_paths = {}
+        ref_tree_paths["glottolog"] = row["glottolog_tree_path"]
+        ref_tree_paths["bin"] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", "bin"))
+        ref_tree_paths["catg_bin"] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", "catg_bin"))
+        ref_tree_paths["catg_multi"] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", "catg_multi"))
+        ref_tree_paths["consensus"] = raxmlng.consensus_tree_path(util.prefix(results_dir, row, "raxmlng", "sampled_consensus"))
+        sampled_tree_paths = []
+        for (i, msa_path) in enumerate(row["sampled_msa_paths"]):
+            sampled_tree_paths.append(raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", "sampled/sampled" + str(i))))
+        jobs.append((dist_dir, sampled_tree_paths, ref_tree_paths))
+    d_io.write_matrices(jobs, num_processes)
+
+
+def used_samples(df):
+    # df restricted to the sampled MSAs chosen by run_adaptive, if it ran
+    return adaptive.used_samples(df, adaptive.read_counts(adaptive.counts_path(results_dir)))
+
+def run_adaptive(df, min_samples = 20, round_size = 10, tolerances = adaptive.tolerances):
+    # Infers, predicts and compares the sampled MSAs in rounds, starting with
+    # min_samples per dataset and adding round_size until the statistics of
+    # adaptive.statistics converge or all sampled MSAs are used. The number
+    # of samples per dataset is recorded in adaptive_samples.json
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    counts = adaptive.read_counts(adaptive.counts_path(results_dir))
+    num_samples = {}
+    for (i, row) in df.iterrows():
+        num_samples[i] = adaptive.next_num_samples(0, len(row["sampled_msa_paths"]), None, min_samples, round_size, tolerances)
+    active = [i for i in df.index if num_samples[i] is not None]
+    while len(active) > 0:
+        round_df = df.loc[active].copy()
+        round_df["sampled_msa_paths"] = pd.Series([df.at[i, "sampled_msa_paths"][:num_samples[i]] for i in active], index=active, dtype=object)
+        run_raxml_ng(round_df)
+        run_pythia(round_df)
+        consense_trees(round_df)
+        calculate_distances(round_df)
+        next_active = []
+        for (i, row) in round_df.iterrows():
+            difficulties = [pythia.get_difficulty(util.prefix(results_dir, row, "pythia", "sampled/sampled" + str(j))) for j in range(num_samples[i])]
+            try:
+                dm = DistanceMatrix(util.dist_dir(results_dir, row), ref_tree_names, metrics)
+                intervals = adaptive.intervals(adaptive.sample_values(dm, difficulties))
+            except Exception as e:
+                print("Statistics of " + util.dataset_name(row) + " failed: " + str(e))
+                intervals = None
+            n = adaptive.next_num_samples(num_samples[i], len(df.at[i, "sampled_msa_paths"]), intervals, min_samples, round_size, tolerances)
+            counts[util.dataset_name(row)] = {"num_samples": num_samples[i], "intervals": intervals, "converged": n is None and intervals is not None and adaptive.converged(intervals, tolerances)}
+            if n is not None and intervals is not None:
+                num_samples[i] = n
+                next_active.append(i)
+        adaptive.write_counts(adaptive.counts_path(results_dir), counts)
+        active = next_active
+    return used_samples(df)
+
+
+def build_pipeline(df, merge = False):
+    p = Pipeline(os.path.join(results_dir, "pipeline_state.json"))
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    d_io = DistanceMatrixIO(metrics, ref_tree_names)
+    results_deps = []
+    for (i, row) in df.iterrows():
+        ds_name = util.dataset_name(row)
+        inferences = [("bin", row["msa_paths"]["bin"], "BIN+G", ""),
+                      ("catg_bin", row["msa_paths"]["catg_bin"], "BIN+G", "--prob-msa on"),
+                      ("catg_multi", row["msa_paths"]["catg_multi"], row["MULTIx_MK"] + "+G", "--prob-msa on")]
+        sampled_runs = []
+        for (j, msa_path) in enumerate(row["sampled_msa_paths"]):
+            sampled_runs.append("sampled/sampled" + str(j))
+            inferences.append((sampled_runs[-1], msa_path, "BIN+G", ""))
+        for (run, msa_path, model, args) in inferences:
+            prefix = util.prefix(results_dir, row, "raxmlng", run)
+            threads = raxmlng.inference_threads(msa_path, num_processes)
+            p.add(Node("infer " + ds_name + " " + run,
+                functools.partial(raxmlng.run_inference, msa_path, model, prefix, args, threads),
+                inputs = [msa_path, raxmlng.exe_path], params = [model, args],
+                outputs = [raxmlng.best_tree_path(prefix), prefix + ".raxml.log"], cores = threads))
+
+        sampled_prefixes = [util.prefix(results_dir, row, "raxmlng", run) for run in sampled_runs]
+        consensus_prefix = util.prefix(results_dir, row, "raxmlng", "sampled_consensus")
+        p.add(Node("consense " + ds_name,
+            functools.partial(raxmlng.consense_tree, sampled_prefixes, consensus_prefix),
+            params = [distances.ENGINE_VERSION], deps = ["infer " + ds_name + " " + run for run in sampled_runs],
+            outputs = [raxmlng.consensus_tree_path(consensus_prefix)], partial = True))
+
+        dist_dir = util.dist_dir(results_dir, row)
+        ref_tree_paths = {}
+        ref_tree_paths["glottolog"] = row["glottolog_tree_path"]
+        for run in ["bin", "catg_bin", "catg_multi"]:
+            ref_tree_paths[run] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", run))
+        ref_tree_paths["consensus"] = raxmlng.consensus_tree_path(consensus_prefix)
+        sampled_tree_paths = [raxmlng.best_tree_path(prefix) for prefix in sampled_prefixes]
+        p.add(Node("distances " + ds_name,
+            functools.partial(d_io.write_matrix, dist_dir, sampled_tree_paths, ref_tree_paths),
+            inputs = [row["glottolog_tree_path"]], params = metrics + ref_tree_names + [distances.ENGINE_VERSION],
+            deps = ["infer " + ds_name + " " + run for (run, _, _, _) in inferences] + ["consense " + ds_name],
+            outputs = [os.path.join(dist_dir, "matrix_" + metric + ".csv") for metric in metrics], clean = False, partial = True))
+
+        msa_paths = [msa_path for (run, msa_path) in pythia_runs(row)]
+        prefixes = [util.prefix(results_dir, row, "pythia", run) for (run, msa_path) in pythia_runs(row)]
+        p.add(Node("pythia " + ds_name,
+            functools.partial(pythia.run_batch_process, msa_paths, prefixes, num_processes),
+            inputs = msa_paths + [pythia.predictor_path, pythia.raxmlng_path],
+            outputs = prefixes, cores = num_processes))
+        results_deps.append("pythia " + ds_name)
+        results_deps.append("infer " + ds_name + " bin")
+
+    p.add(Node("results", functools.partial(write_results_df, df, merge), deps = results_deps,
+        outputs = [os.path.join(results_dir, "raxml_pythia_results.csv")], partial = True))
+    return p
+
+
+def enqueue(queue, df):
+    # One unit per dataset and stage, the results unit waits for all datasets
+    results_deps = []
+    for (i, row) in df.iterrows():
+        ds_name = util.dataset_name(row)
+        infer = queue.add("infer", ds_name)
+        consense = queue.add("consense", ds_name, [infer])
+        queue.add("distances", ds_name, [infer, consense])
+        results_deps += [infer, queue.add("pythia", ds_name)]
+    queue.add("results", "all", results_deps)
+
+def queue_handlers(df, merge = False):
+    # The stages applied to the single dataset of a unit
+    names = [util.dataset_name(row) for (i, row) in df.iterrows()]
+
+    def handler(function):
+        return lambda ds_name: function(df.loc[[i for (i, name) in zip(df.index, names) if name == ds_name]])
+    return {"infer": handler(run_raxml_ng), "pythia": handler(run_pythia), "consense": handler(consense_trees),
+            "distances": handler(calculate_distances), "results": lambda _: write_results_df(df, merge)}
+
+def run_worker(df, lease_timeout = 600, heartbeat = 60, merge = False):
+    # Any number of workers, on hosts sharing results_dir, may run this at
+    # once, each claims the units of the queue in results_dir/queue until all
+    # are done. Units of workers which died are retried
+    queue = WorkQueue(os.path.join(results_dir, "queue"), lease_timeout, heartbeat)
+    enqueue(queue, df)
+    count = queue.run(queue_handlers(df, merge))
+    print("Worker " + queue.worker + " ran " + str(count) + " units, queue: " + str(queue.status()))
+
+
+def write_results_df(df, merge = False):
+    # With merge, e.g. for a subset of the datasets, the rows of other
+    # datasets in an existing raxml_pythia_results.csv are kept
+    sampled_difficulties = []
+    for i, row in df.iterrows():
+        record = raxmlng.log_record(util.prefix(results_dir, row, "raxmlng", "bin"))
+        if record is None:
+            record = raxmlng.LogRecord()
+        alpha = record.alpha()
+        df.at[i, "alpha"] = alpha
+        if alpha < 20:
+            df.at[i, "heterogenity"] = 1
+        else:
+            df.at[i, "heterogenity"] = 0
+        df.at[i, "difficulty"] = pythia.get_difficulty(util.prefix(results_dir, row, "pythia", "bin"))
+        sampled_d = []
+        for (j, msa_path) in enumerate(row["sampled_msa_paths"]):
+            sampled_d.append(pythia.get_difficulty(util.prefix(results_dir, row, "pythia", "sampled/sampled" + str(j))))
+        df.at[i, "difficulty_variance"] =  np.var(sampled_d)
+        df.at[i, "num_samples"] = len(sampled_d)
+        df.at[i, "zero_base_frequency_bin"] = record.base_frequencies[0][0] if len(record.base_frequencies) > 0 else float("nan")
+        df.at[i, "llh_bin"] = record.llh
+        df.at[i, "num_trees_bin"] = record.num_trees()
+        df.at[i, "runtime_bin"] = record.runtime
+    print_df = df[["ds_id", "source", "ling_type", "family", "alpha", "heterogenity", "difficulty", "difficulty_variance", "num_samples", "zero_base_frequency_bin", "llh_bin", "num_trees_bin", "runtime_bin"]]
+    print(print_df)
+    path = os.path.join(results_dir, "raxml_pythia_results.csv")
+    if merge and os.path.isfile(path):
+        keys = ["ds_id", "source", "ling_type", "family"]
+        old_df = pd.read_csv(path, sep = ";", index_col = 0, dtype = {key: str for key in keys})
+        new_keys = set(tuple(row) for row in print_df[keys].astype(str).values)
+        old_df = old_df[[tuple(row) not in new_keys for row in old_df[keys].values]]
+        print_df = pd.concat([old_df, print_df], ignore_index = True)
+    print_df.to_csv(path, sep = ";")
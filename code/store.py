@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import numpy as np
+import pandas as pd
+
+try:
+    import code.util as util
+except ImportError:
+    # imported from test/ with code/ on sys.path
+    import util
+
+
+tables = [
+    """CREATE TABLE IF NOT EXISTS datasets (experiment TEXT, ds_name TEXT, ds_id TEXT, source TEXT,
+        ling_type TEXT, family TEXT, metadata TEXT, PRIMARY KEY (experiment, ds_name))""",
+    """CREATE TABLE IF NOT EXISTS trees (experiment TEXT, ds_name TEXT, run TEXT, newick TEXT, PRIMARY KEY (experiment, ds_name, run))""",
+    """CREATE TABLE IF NOT EXISTS matrices (experiment TEXT, ds_name TEXT, metric TEXT, ref_tree_names TEXT,
+        num_sampled INTEGER, dtype TEXT, data BLOB, PRIMARY KEY (experiment, ds_name, metric))""",
+    """CREATE TABLE IF NOT EXISTS logs (experiment TEXT, ds_name TEXT, run TEXT, alpha REAL, llh REAL, runtime REAL,
+        num_trees INTEGER, zero_base_frequency REAL, record TEXT, PRIMARY KEY (experiment, ds_name, run))""",
+    """CREATE TABLE IF NOT EXISTS difficulties (experiment TEXT, ds_name TEXT, run TEXT, difficulty REAL, PRIMARY KEY (experiment, ds_name, run))""",
+    """CREATE TABLE IF NOT EXISTS files (experiment TEXT, path TEXT, mtime_ns INTEGER, size INTEGER, PRIMARY KEY (experiment, path))"""
+]
+
+
+def scalar(value):
+    # JSON compatible value of a scalar dataset column, None for paths dicts,
+    # lists and the like which are not stored
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return (True, value)
+    return (False, None)
+
+def nan_to_none(value):
+    if value is None or value != value:
+        return None
+    return value
+
+
+class ResultsStore:
+
+    # All per dataset results in one SQLite file, keyed by experiment: upserts
+    # replace the rows of one dataset, the files table remembers mtime and
+    # size of every file ingested per experiment so unchanged files are
+    # skipped on the next ingest
+    def __init__(self, path):
+        d = os.path.dirname(path)
+        if d != "" and not os.path.isdir(d):
+            os.makedirs(d)
+        self.connection = sqlite3.connect(path)
+        for table in tables:
+            self.connection.execute(table)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def commit(self):
+        self.connection.commit()
+
+    def changed(self, experiment, path):
+        # True if path exists and was not ingested for experiment in its
+        # current state
+        if not os.path.isfile(path):
+            return False
+        stat = os.stat(path)
+        row = self.connection.execute("SELECT mtime_ns, size FROM files WHERE experiment = ? AND path = ?", (experiment, path)).fetchone()
+        return row is None or row[0] != stat.st_mtime_ns or row[1] != stat.st_size
+
+    def mark(self, experiment, path):
+        stat = os.stat(path)
+        self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", (experiment, path, stat.st_mtime_ns, stat.st_size))
+
+    def drop_runs(self, experiment, ds_name, table, runs):
+        # removes the rows of runs no longer ingested, e.g. sampled MSAs after
+        # adaptive sampling used fewer of them
+        placeholders = ", ".join("?" for _ in runs)
+        self.connection.execute("DELETE FROM " + table + " WHERE experiment = ? AND ds_name = ? AND run NOT IN (" + placeholders + ")",
+            [experiment, ds_name] + list(runs))
+
+    def drop_files(self, experiment, directory, paths):
+        # forgets the files in directory which are not in paths, so they are
+        # ingested again once they are used again
+        directory = os.path.join(directory, "")
+        placeholders = ", ".join("?" for _ in paths)
+        self.connection.execute("DELETE FROM files WHERE experiment = ? AND substr(path, 1, ?) = ? AND path NOT IN (" + placeholders + ")",
+            [experiment, len(directory), directory] + list(paths))
+
+    def put_dataset(self, experiment, row):
+        metadata = {}
+        for (column, value) in row.items():
+            (ok, value) = scalar(value)
+            if ok and column not in ["ds_id", "source", "ling_type", "family"]:
+                metadata[column] = value
+        self.connection.execute("INSERT OR REPLACE INTO datasets VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (experiment, util.dataset_name(row), row["ds_id"], row["source"], row["ling_type"], row["family"], json.dumps(metadata)))
+
+    def put_tree(self, experiment, ds_name, run, newick):
+        self.connection.execute("INSERT OR REPLACE INTO trees VALUES (?, ?, ?, ?)", (experiment, ds_name, run, newick.strip()))
+
+    def put_matrix(self, experiment, ds_name, metric, ref_tree_names, num_sampled, condensed):
+        condensed = np.ascontiguousarray(condensed)
+        self.connection.execute("INSERT OR REPLACE INTO matrices VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (experiment, ds_name, metric, json.dumps(list(ref_tree_names)), num_sampled, condensed.dtype.name, condensed.tobytes()))
+
+    def put_log(self, experiment, ds_name, run, values):
+        # values as in raxmlng.LogRecord
+        alphas = values.get("alphas", [])
+        base_frequencies = values.get("base_frequencies", [])
+        self.connection.execute("INSERT OR REPLACE INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (experiment, ds_name, run, alphas[0] if len(alphas) > 0 else None,
+            nan_to_none(values.get("llh")), nan_to_none(values.get("runtime")), len(values.get("tree_llhs", [])),
+            base_frequencies[0][0] if len(base_frequencies) > 0 else None, json.dumps(values)))
+
+    def put_difficulty(self, experiment, ds_name, run, difficulty):
+        self.connection.execute("INSERT OR REPLACE INTO difficulties VALUES (?, ?, ?, ?)", (experiment, ds_name, run, nan_to_none(difficulty)))
+
+    def datasets(self, experiment):
+        rows = self.connection.execute("SELECT ds_name, ds_id, source, ling_type, family, metadata FROM datasets WHERE experiment = ? ORDER BY ds_name", (experiment, )).fetchall()
+        records = []
+        for (ds_name, ds_id, source, ling_type, family, metadata) in rows:
+            record = {"ds_name": ds_name, "ds_id": ds_id, "source": source, "ling_type": ling_type, "family": family}
+            record.update(json.loads(metadata))
+            records.append(record)
+        return pd.DataFrame(records, columns = None if len(records) > 0 else ["ds_name", "ds_id", "source", "ling_type", "family"])
+
+    def trees(self, experiment, runs = None):
+        df = pd.read_sql_query("SELECT ds_name, run, newick FROM trees WHERE experiment = ?", self.connection, params = (experiment, ))
+        if runs is not None:
+            df = df[df["run"].isin(runs)]
+        return df
+
+    def matrices(self, experiment):
+        # {ds_name: (ref_tree_names, {metric: condensed lower triangle})}
+        res = {}
+        for (ds_name, metric, ref_tree_names, dtype, data) in self.connection.execute(
+                "SELECT ds_name, metric, ref_tree_names, dtype, data FROM matrices WHERE experiment = ?", (experiment, )):
+            if ds_name not in res:
+                res[ds_name] = (json.loads(ref_tree_names), {})
+            res[ds_name][1][metric] = np.frombuffer(data, dtype=dtype)
+        return res
+
+    def logs(self, experiment):
+        df = pd.read_sql_query("SELECT ds_name, run, alpha, llh, runtime, num_trees, zero_base_frequency FROM logs WHERE experiment = ?", self.connection, params = (experiment, ))
+        return df.astype({"alpha": float, "llh": float, "runtime": float, "zero_base_frequency": float})
+
+    def difficulties(self, experiment):
+        df = pd.read_sql_query("SELECT ds_name, run, difficulty FROM difficulties WHERE experiment = ?", self.connection, params = (experiment, ))
+        return df.astype({"difficulty": float})
+
+    def results(self, experiment):
+        # Columns of raxml_pythia_results.csv per dataset, from the bin
+        # inference and the difficulties of the bin and sampled MSAs
+        logs = self.logs(experiment)
+        df = logs[logs["run"] == "bin"].drop(columns=["run"])
+        df = df.rename(columns = {"zero_base_frequency": "zero_base_frequency_bin", "llh": "llh_bin", "num_trees": "num_trees_bin", "runtime": "runtime_bin"})
+        df["heterogenity"] = (df["alpha"] < 20).astype(int)
+        difficulties = self.difficulties(experiment)
+        bin_difficulties = difficulties[difficulties["run"] == "bin"][["ds_name", "difficulty"]]
+        sampled = difficulties[difficulties["run"].str.startswith("sampled/")]
+        variances = sampled.groupby("ds_name")["difficulty"].agg(lambda x: np.var(x.values)).rename("difficulty_variance").reset_index()
+        counts = sampled.groupby("ds_name").size().rename("num_samples").reset_index()
+        df = pd.merge(df, bin_difficulties, how = "outer", on = "ds_name")
+        df = pd.merge(df, variances, how = "left", on = "ds_name")
+        df = pd.merge(df, counts, how = "left", on = "ds_name")
+        return df[["ds_name", "alpha", "heterogenity", "difficulty", "difficulty_variance", "num_samples", "zero_base_frequency_bin", "llh_bin", "num_trees_bin", "runtime_bin"]]
@@ -0,0 +1,201 @@
+import os
+import json
+import time
+import shlex
+import resource
+import subprocess
+import contextlib
+
+
+# Run trace: one JSON line per stage execution with wall and CPU time, peak
+# RSS, exit status and the bytes read and written. Records of external
+# tools are measured on the tool's process alone, records of in-process
+# stages include the subprocesses they waited for. Disabled while trace_path
+# is empty
+trace_path = ""
+stage_dirs = ["raxmlng", "pythia", "distances", "distances_partitioning"]
+
+
+def dataset_name(path):
+    # Dataset of a path in the results layout, e.g.
+    # data/results/raxmlng/<dataset>/sampled/sampled0
+    parts = os.path.normpath(path).split(os.sep)
+    for (i, part) in enumerate(parts[:-1]):
+        if part in stage_dirs:
+            return parts[i + 1]
+    return ""
+
+def io_counters(pid = "self"):
+    # Bytes read and written by the process and its reaped children, None
+    # without /proc
+    try:
+        with open("/proc/" + str(pid) + "/io", "r") as io_file:
+            counters = dict(line.split(": ") for line in io_file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+def write(record):
+    if trace_path == "":
+        return
+    d = os.path.dirname(trace_path)
+    if d != "" and not os.path.isdir(d):
+        os.makedirs(d, exist_ok=True)
+    # one write per line, so records of forked workers do not interleave
+    fd = os.open(trace_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, (json.dumps(record) + "\n").encode())
+    finally:
+        os.close(fd)
+
+def plan(stage, total):
+    # Announces total records of stage, for the progress in report()
+    write({"event": "plan", "stage": stage, "total": total, "start": time.time(), "pid": os.getpid()})
+
+def cpu_time():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextlib.contextmanager
+def span(stage, target, **fields):
+    # Traces the enclosed block. Peak RSS is that of the process (and its
+    # largest child) so far, which the kernel does not report per block
+    if trace_path == "":
+        yield fields
+        return
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = cpu_time()
+    io_start = io_counters()
+    status = 0
+    try:
+        yield fields
+    except BaseException:
+        status = 1
+        raise
+    finally:
+        io_end = io_counters()
+        record = {"event": "span", "stage": stage, "target": target, "dataset": dataset_name(target),
+                  "start": start, "wall": time.perf_counter() - wall_start, "cpu": cpu_time() - cpu_start,
+                  "peak_rss_kb": max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+                  "exit_status": status, "pid": os.getpid()}
+        if io_start is not None and io_end is not None:
+            record["read_bytes"] = io_end[0] - io_start[0]
+            record["write_bytes"] = io_end[1] - io_start[1]
+        record.update(fields)
+        write(record)
+
+
+class Command:
+
+    # External tool, a shell command or an argument list run without shell,
+    # measured with wait4 when it is reaped. poll() and wait() replace those
+    # of subprocess.Popen
+    def __init__(self, command, stage, target, stdout = None, stderr = None, **fields):
+        self.command = command
+        self.stage = stage
+        self.target = target
+        self.fields = fields
+        self.returncode = None
+        self.start = time.time()
+        self.wall_start = time.perf_counter()
+        self.process = subprocess.Popen(command, shell=isinstance(command, str), stdout=stdout, stderr=stderr)
+
+    def poll(self, block = False):
+        if self.returncode is not None:
+            return self.returncode
+        flags = 0 if block else os.WNOHANG
+        # the exited process stays a zombie until wait4, so its I/O counters
+        # can still be read
+        if os.waitid(os.P_PID, self.process.pid, os.WEXITED | os.WNOWAIT | flags) is None:
+            return None
+        io = io_counters(self.process.pid)
+        (pid, status, usage) = os.wait4(self.process.pid, 0)
+        self.returncode = os.waitstatus_to_exitcode(status)
+        self.process.returncode = self.returncode
+        record = {"event": "command", "stage": self.stage, "target": self.target, "dataset": dataset_name(self.target),
+                  "start": self.start, "wall": time.perf_counter() - self.wall_start, "cpu": usage.ru_utime + usage.ru_stime,
+                  "peak_rss_kb": usage.ru_maxrss, "exit_status": self.returncode, "pid": pid,
+                  "command": self.command if isinstance(self.command, str) else shlex.join(self.command)}
+        if io is not None:
+            record["read_bytes"] = io[0]
+            record["write_bytes"] = io[1]
+        record.update(self.fields)
+        write(record)
+        return self.returncode
+
+    def wait(self):
+        return self.poll(True)
+
+def run(command, stage, target, **fields):
+    # os.system replacement, returns the exit status
+    return Command(command, stage, target, **fields).wait()
+
+
+def read(path):
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path, "r") as trace_file:
+        for line in trace_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # line of a run which was killed while writing
+                continue
+    return records
+
+def summary(records, now = None):
+    # Totals per stage and per dataset, and the progress of the stages of
+    # the last plan record each
+    if now is None:
+        now = time.time()
+    stages = {}
+    datasets = {}
+    plans = {}
+    for record in records:
+        if record["event"] == "plan":
+            plans[record["stage"]] = {"total": record["total"], "start": record["start"], "done": 0}
+            continue
+        stage = stages.setdefault(record["stage"], {"count": 0, "wall": 0.0, "cpu": 0.0, "peak_rss_kb": 0, "read_bytes": 0, "write_bytes": 0, "failed": 0})
+        stage["count"] += 1
+        stage["wall"] += record["wall"]
+        stage["cpu"] += record["cpu"]
+        stage["peak_rss_kb"] = max(stage["peak_rss_kb"], record["peak_rss_kb"])
+        stage["read_bytes"] += record.get("read_bytes", 0)
+        stage["write_bytes"] += record.get("write_bytes", 0)
+        stage["failed"] += record["exit_status"] != 0
+        if record["dataset"] != "":
+            dataset = datasets.setdefault(record["dataset"], {"wall": 0.0, "cpu": 0.0, "stages": {}})
+            dataset["wall"] += record["wall"]
+            dataset["cpu"] += record["cpu"]
+            dataset["stages"][record["stage"]] = dataset["stages"].get(record["stage"], 0.0) + record["wall"]
+        p = plans.get(record["stage"])
+        if p is not None and record["start"] >= p["start"]:
+            p["done"] += 1
+    for p in plans.values():
+        p["elapsed"] = now - p["start"]
+        remaining = max(0, p["total"] - p["done"])
+        p["eta"] = p["elapsed"] / p["done"] * remaining if p["done"] > 0 else float("nan")
+    return {"stages": stages, "datasets": datasets, "plans": plans}
+
+def report(path, top = 10):
+    s = summary(read(path))
+    print("Stages by wall time")
+    print("%-20s %8s %12s %12s %10s %12s %12s %7s" % ("stage", "count", "wall [s]", "cpu [s]", "rss [MB]", "read [MB]", "written [MB]", "failed"))
+    for (name, stage) in sorted(s["stages"].items(), key=lambda item: -item[1]["wall"]):
+        print("%-20s %8d %12.1f %12.1f %10.1f %12.1f %12.1f %7d" % (name, stage["count"], stage["wall"], stage["cpu"],
+            stage["peak_rss_kb"] / 1024, stage["read_bytes"] / 2**20, stage["write_bytes"] / 2**20, stage["failed"]))
+    print()
+    print("Hottest datasets")
+    for (name, dataset) in sorted(s["datasets"].items(), key=lambda item: -item[1]["wall"])[:top]:
+        stage = max(dataset["stages"], key=dataset["stages"].get)
+        print("%-50s %12.1f s wall %12.1f s cpu, mostly %s" % (name, dataset["wall"], dataset["cpu"], stage))
+    if len(s["plans"]) > 0:
+        print()
+        print("Progress")
+        for (name, p) in s["plans"].items():
+            eta = "unknown" if p["eta"] != p["eta"] else time.strftime("%H:%M:%S", time.gmtime(p["eta"])) if p["eta"] < 86400 else str(round(p["eta"] / 86400, 1)) + " days"
+            print("%-20s %8d / %-8d elapsed %10.0f s, ETA %s" % (name, p["done"], p["total"], p["elapsed"], eta))
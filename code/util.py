@@ -3,6 +3,16 @@ import os
 def prefix(results_dir, row, experiment, run):
     return os.path.join(results_dir, experiment, "_".join([row["ds_id"], row["source"], row["ling_type"], row["family"]]), run)
 
+def dataset_name(row):
+    return "_".join([row["ds_id"], row["source"], row["ling_type"], row["family"]])
+
+def filter_datasets(df, filters):
+    # filters maps columns, e.g. ds_id or family, to the accepted values
+    for (column, values) in filters.items():
+        if values is not None and len(values) > 0:
+            df = df[df[column].isin(values)]
+    return df
+
 def dist_dir(results_dir, row):
     return os.path.join(results_dir, "distances", "_".join([row["ds_id"], row["source"], row["ling_type"], row["family"]]))
 
@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import random
+import socket
+import threading
+import traceback
+
+
+# Work queue in a directory shared by all workers, e.g. on NFS:
+#   units/<id>.json     stage, dataset and dependencies of a unit
+#   leases/<id>         claim of a running unit, created exclusively and
+#                       touched by its worker every heartbeat seconds
+#   done/<id>.json      finished units
+#   attempts/<id>.*     failed or abandoned runs of a unit
+#   failed/<id>.json    units given up after max_attempts
+# Leases not touched for lease_timeout seconds belong to dead workers and
+# are broken by the next worker looking for work. Ages are measured with
+# the file system's clock, so the clocks of the hosts need not agree
+
+
+def unit_id(stage, dataset):
+    return (stage + "__" + dataset).replace("/", "_").replace(" ", "_")
+
+def write_json(path, data):
+    tmp_path = path + ".tmp" + str(os.getpid()) + "_" + str(threading.get_ident())
+    with open(tmp_path, "w+") as json_file:
+        json.dump(data, json_file)
+    os.replace(tmp_path, path)
+
+def read_json(path):
+    try:
+        with open(path, "r") as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return None
+
+
+class WorkQueue:
+
+    def __init__(self, queue_dir, lease_timeout = 600, heartbeat = 60, max_attempts = 3, poll_interval = 5):
+        self.queue_dir = queue_dir
+        self.lease_timeout = lease_timeout
+        self.heartbeat = heartbeat
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker = socket.gethostname() + "_" + str(os.getpid()) + "_" + str(random.getrandbits(32))
+        for d in ["units", "leases", "done", "attempts", "failed", "clock"]:
+            os.makedirs(self.path(d), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.queue_dir, *parts)
+
+    def add(self, stage, dataset, deps = []):
+        # Idempotent, all workers may enqueue the same units
+        uid = unit_id(stage, dataset)
+        unit = {"id": uid, "stage": stage, "dataset": dataset, "deps": list(deps)}
+        if read_json(self.path("units", uid + ".json")) != unit:
+            write_json(self.path("units", uid + ".json"), unit)
+        return uid
+
+    def units(self):
+        res = {}
+        for file_name in sorted(os.listdir(self.path("units"))):
+            if file_name.endswith(".json"):
+                unit = read_json(self.path("units", file_name))
+                if unit is not None:
+                    res[unit["id"]] = unit
+        return res
+
+    def ids(self, d):
+        return set(file_name[:-5] for file_name in os.listdir(self.path(d)) if file_name.endswith(".json"))
+
+    def attempts(self, uid):
+        return len([file_name for file_name in os.listdir(self.path("attempts")) if file_name.startswith(uid + ".")])
+
+    def record_attempt(self, uid, reason):
+        write_json(self.path("attempts", uid + "." + self.worker + "_" + str(time.time())), {"worker": self.worker, "reason": reason})
+        if self.attempts(uid) >= self.max_attempts:
+            write_json(self.path("failed", uid + ".json"), {"worker": self.worker, "reason": reason})
+
+    def now(self):
+        # Current time of the file system holding the queue
+        clock_path = self.path("clock", self.worker)
+        with open(clock_path, "w+"):
+            pass
+        return os.stat(clock_path).st_mtime
+
+    def claim(self, uid):
+        lease_path = self.path("leases", uid)
+        try:
+            fd = os.open(lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            self.break_stale(uid)
+            return False
+        with os.fdopen(fd, "w") as lease_file:
+            json.dump({"worker": self.worker, "claimed": time.time()}, lease_file)
+        if os.path.isfile(self.path("done", uid + ".json")):
+            # finished between listing and claiming
+            os.remove(lease_path)
+            return False
+        return True
+
+    def break_stale(self, uid):
+        # Moves a lease whose heartbeat stopped out of the way. Another worker
+        # may break it and a third claim the unit between our check and the
+        # rename, so a lease which turns out not to be the one checked is
+        # linked back, which fails if yet another worker claimed the unit
+        lease_path = self.path("leases", uid)
+        try:
+            mtime = os.stat(lease_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        lease = read_json(lease_path)
+        if self.now() - mtime / 1e9 <= self.lease_timeout:
+            return
+        stale_path = self.path("leases", uid + ".stale." + self.worker)
+        try:
+            os.rename(lease_path, stale_path)
+        except FileNotFoundError:
+            return
+        if os.stat(stale_path).st_mtime_ns != mtime or read_json(stale_path) != lease:
+            try:
+                os.link(stale_path, lease_path)
+            except FileExistsError:
+                pass
+            os.remove(stale_path)
+            return
+        os.remove(stale_path)
+        print("Broke lease of " + uid + " held by " + ("unknown" if lease is None else lease["worker"]))
+        self.record_attempt(uid, "lease expired")
+
+    def owns(self, uid):
+        lease = read_json(self.path("leases", uid))
+        return lease is not None and lease["worker"] == self.worker
+
+    def run_unit(self, unit, handlers):
+        uid = unit["id"]
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat):
+                if not self.owns(uid):
+                    return
+                os.utime(self.path("leases", uid))
+        heartbeat_thread = threading.Thread(target=beat, daemon=True)
+        heartbeat_thread.start()
+        try:
+            handlers[unit["stage"]](unit["dataset"])
+            ok = True
+        except Exception:
+            traceback.print_exc()
+            ok = False
+        stop.set()
+        heartbeat_thread.join()
+        if not self.owns(uid):
+            print("Lost lease of " + uid)
+            return
+        if ok:
+            write_json(self.path("done", uid + ".json"), {"worker": self.worker, "finished": time.time()})
+        else:
+            self.record_attempt(uid, "failed")
+        os.remove(self.path("leases", uid))
+
+    def run(self, handlers, max_units = None):
+        # Claims and runs units whose dependencies are done until all units
+        # are done or failed, returns the number of units run
+        count = 0
+        while max_units is None or count < max_units:
+            units = self.units()
+            done = self.ids("done")
+            failed = self.ids("failed")
+            for (uid, unit) in units.items():
+                if uid not in done and uid not in failed and any(dep in failed for dep in unit["deps"]):
+                    write_json(self.path("failed", uid + ".json"), {"worker": self.worker, "reason": "dependency failed"})
+                    failed.add(uid)
+            todo = [unit for (uid, unit) in units.items() if uid not in done and uid not in failed]
+            if len(todo) == 0:
+                break
+            runnable = [unit for unit in todo if all(dep in done for dep in unit["deps"])]
+            # workers starting together should not all race for the same unit
+            random.shuffle(runnable)
+            claimed = None
+            for unit in runnable:
+                if self.claim(unit["id"]):
+                    claimed = unit
+                    break
+            if claimed is None:
+                time.sleep(self.poll_interval)
+                continue
+            self.run_unit(claimed, handlers)
+            count += 1
+        if os.path.isfile(self.path("clock", self.worker)):
+            os.remove(self.path("clock", self.worker))
+        return count
+
+    def status(self):
+        units = self.units()
+        done = self.ids("done")
+        failed = self.ids("failed")
+        leases = set(file_name for file_name in os.listdir(self.path("leases")) if ".stale." not in file_name)
+        return {"units": len(units), "done": len(done & set(units)), "failed": len(failed & set(units)),
+                "running": len(leases & set(units)), "waiting": len(set(units) - done - failed - leases)}
@@ -0,0 +1,19 @@
+import os
+
+from code.distances import DistanceMatrixIO
+
+results_dir = "data/results"
+ref_tree_names = {
+    "distances": ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"],
+    "distances_partitioning": ["glottolog", "bin", "catg_bin", "catg_multi", "bin_BIN+G_2", "bin_BIN+G_x"]
+}
+
+for (dir_name, names) in ref_tree_names.items():
+    d_io = DistanceMatrixIO(["rf", "gq"], names, storage = "npy")
+    dists_dir = os.path.join(results_dir, dir_name)
+    if not os.path.isdir(dists_dir):
+        continue
+    for ds_name in sorted(os.listdir(dists_dir)):
+        dist_dir = os.path.join(dists_dir, ds_name)
+        if os.path.isfile(os.path.join(dist_dir, "matrix_rf.csv")) and os.path.isfile(os.path.join(dist_dir, "matrix_gq.csv")):
+            d_io.convert(dist_dir)
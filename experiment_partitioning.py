@@ -9,28 +9,31 @@ import code.pythia as pythia
 import code.distances as distances
 from code.distances import DistanceMatrixIO
 import code.util as util
+import code.datacache as datacache
+import code.tracing as tracing
 
 
 
 
 
 def run_raxml_ng(df):
+    jobs = []
     for (i, row) in df.iterrows():
-        raxmlng.run_inference(row["msa_paths"]["bin"], "BIN+G", util.prefix(results_dir, row, "raxmlng", "bin"))
+        jobs.append((row["msa_paths"]["bin"], "BIN+G", util.prefix(results_dir, row, "raxmlng", "bin"), ""))
         partition_name = util.partition_name("bin", "BIN", True, "2")
-        raxmlng.run_inference(row["msa_paths"]["bin"], row["partition_paths"][partition_name], util.prefix(results_dir, row, "raxmlng", partition_name))
+        jobs.append((row["msa_paths"]["bin"], row["partition_paths"][partition_name], util.prefix(results_dir, row, "raxmlng", partition_name), ""))
         partition_name = util.partition_name("bin", "BIN", True, "x")
-        raxmlng.run_inference(row["msa_paths"]["bin"], row["partition_paths"][partition_name], util.prefix(results_dir, row, "raxmlng", partition_name))
+        jobs.append((row["msa_paths"]["bin"], row["partition_paths"][partition_name], util.prefix(results_dir, row, "raxmlng", partition_name), ""))
+    raxmlng.run_inferences(jobs, num_processes)
 
 
 def calculate_distances(df):
     metrics = ["rf", "gq"]
     ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "bin_BIN+G_2", "bin_BIN+G_x"]
     d_io = DistanceMatrixIO(metrics, ref_tree_names)
+    jobs = []
     for (i, row) in df.iterrows():
         dist_dir = util.dist_dir_partitioning(results_dir, row)
-        if os.path.isfile(os.path.join(dist_dir, "matrix_rf.csv")) and os.path.isfile(os.path.join(dist_dir, "matrix_gq.csv")):
-            continue
         ref_tree_paths = {}
         ref_tree_paths["glottolog"] = row["glottolog_tree_path"]
         ref_tree_paths["bin"] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", "bin"))
@@ -40,21 +43,28 @@ def calculate_distances(df):
         ref_tree_paths[partition_name] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", partition_name))
         partition_name = util.partition_name("bin", "BIN", True, "x")
         ref_tree_paths[partition_name] = raxmlng.best_tree_path(util.prefix(results_dir, row, "raxmlng", partition_name))
-        d_io.write_matrix(dist_dir, [], ref_tree_paths)
+        jobs.append((dist_dir, [], ref_tree_paths))
+    d_io.write_matrices(jobs, num_processes)
 
 
 def write_results_df(df):
     sampled_difficulties = []
     for i, row in df.iterrows():
-        alpha = raxmlng.alpha(util.prefix(results_dir, row, "raxmlng", "bin"))
+        record = raxmlng.log_record(util.prefix(results_dir, row, "raxmlng", "bin"))
+        if record is None:
+            record = raxmlng.LogRecord()
+        alpha = record.alpha()
         df.at[i, "alpha"] = alpha
         if alpha < 20:
             df.at[i, "heterogenity"] = 1
         else:
             df.at[i, "heterogenity"] = 0
         df.at[i, "difficulty"] = pythia.get_difficulty(util.prefix(results_dir, row, "pythia", "bin"))
-        df.at[i, "zero_base_frequency_bin"] = raxmlng.base_frequencies(util.prefix(results_dir, row, "raxmlng", "bin"))[0]
-    print_df = df[["ds_id", "source", "ling_type", "family", "alpha", "heterogenity", "difficulty", "zero_base_frequency_bin"]]
+        df.at[i, "zero_base_frequency_bin"] = record.base_frequencies[0][0] if len(record.base_frequencies) > 0 else float("nan")
+        df.at[i, "llh_bin"] = record.llh
+        df.at[i, "num_trees_bin"] = record.num_trees()
+        df.at[i, "runtime_bin"] = record.runtime
+    print_df = df[["ds_id", "source", "ling_type", "family", "alpha", "heterogenity", "difficulty", "zero_base_frequency_bin", "llh_bin", "num_trees_bin", "runtime_bin"]]
     print(print_df)
     print_df.to_csv(os.path.join(results_dir, "raxml_pythia_results_partitioning.csv"), sep = ";")
 
@@ -65,14 +75,17 @@ raxmlng.exe_path = "./bin/raxml-ng"
 pythia.raxmlng_path = "./bin/raxml-ng"
 pythia.predictor_path = "predictors/latest.pckl"
 distances.exe_path = "./bin/qdist"
+distances.tree_cache_dir = "data/cache/trees"
 config_path = "synonyms_lingdata_config_partitioning.json"
 results_dir = "data/results"
+num_processes = os.cpu_count()
+tracing.trace_path = os.path.join(results_dir, "trace_partitioning.jsonl")
 
 
 
 database.read_config(config_path)
 #database.compile()
-df = database.data()
+df = datacache.data(database, config_path)
 pd.set_option('display.max_rows', None)
 print(df)
 
@@ -0,0 +1,100 @@
+import os
+
+import lingdata.database as database
+
+import code.raxmlng as raxmlng
+import code.pythia as pythia
+import code.util as util
+import code.datacache as datacache
+import code.adaptive as adaptive
+from code.distances import DistanceMatrix
+from code.store import ResultsStore
+
+
+def raxmlng_runs(experiment, row):
+    runs = ["bin", "catg_bin", "catg_multi"]
+    if experiment == "synonyms":
+        runs += ["sampled/sampled" + str(i) for i in range(len(row["sampled_msa_paths"]))]
+    else:
+        runs += [util.partition_name("bin", "BIN", True, mode) for mode in ["2", "x"]]
+    return runs
+
+def pythia_runs(experiment, row):
+    runs = ["bin"]
+    if experiment == "synonyms":
+        runs += ["sampled/sampled" + str(i) for i in range(len(row["sampled_msa_paths"]))]
+    return runs
+
+def ingest_dataset(store, experiment, row):
+    ds_name = util.dataset_name(row)
+    store.put_dataset(experiment, row)
+    tree_paths = {"glottolog": row["glottolog_tree_path"]}
+    paths = []
+    for run in raxmlng_runs(experiment, row):
+        prefix = util.prefix(results_dir, row, "raxmlng", run)
+        tree_paths[run] = raxmlng.best_tree_path(prefix)
+        paths.append(raxmlng.log_path(prefix))
+        if store.changed(experiment, raxmlng.log_path(prefix)):
+            store.put_log(experiment, ds_name, run, raxmlng.log_record(prefix).values())
+            store.mark(experiment, raxmlng.log_path(prefix))
+    if experiment == "synonyms":
+        tree_paths["consensus"] = raxmlng.consensus_tree_path(util.prefix(results_dir, row, "raxmlng", "sampled_consensus"))
+    for (run, path) in tree_paths.items():
+        paths.append(path)
+        if store.changed(experiment, path):
+            with open(path, "r") as tree_file:
+                store.put_tree(experiment, ds_name, run, tree_file.read())
+            store.mark(experiment, path)
+    for run in pythia_runs(experiment, row):
+        prefix = util.prefix(results_dir, row, "pythia", run)
+        paths.append(prefix)
+        if store.changed(experiment, prefix):
+            store.put_difficulty(experiment, ds_name, run, pythia.get_difficulty(prefix))
+            store.mark(experiment, prefix)
+    # runs of an earlier ingest with more sampled MSAs
+    store.drop_runs(experiment, ds_name, "logs", raxmlng_runs(experiment, row))
+    store.drop_runs(experiment, ds_name, "trees", tree_paths.keys())
+    store.drop_runs(experiment, ds_name, "difficulties", pythia_runs(experiment, row))
+    for tool in ["raxmlng", "pythia"]:
+        store.drop_files(experiment, util.prefix(results_dir, row, tool, ""), paths)
+    dist_dir = dist_dirs[experiment](results_dir, row)
+    matrix_paths = [os.path.join(dist_dir, name) for name in ["matrix.json"] + ["matrix_" + metric + ext for metric in metrics for ext in [".csv", ".npy"]]]
+    if any(store.changed(experiment, path) for path in matrix_paths):
+        dm = DistanceMatrix(dist_dir, ref_tree_names[experiment], metrics)
+        for metric in metrics:
+            store.put_matrix(experiment, ds_name, metric, ref_tree_names[experiment], dm.num_sampled, dm.condensed(metric))
+        for path in matrix_paths:
+            if os.path.isfile(path):
+                store.mark(experiment, path)
+    store.commit()
+
+
+
+results_dir = "data/results"
+store_path = os.path.join(results_dir, "results.sqlite")
+metrics = ["rf", "gq"]
+config_paths = {
+    "synonyms": "synonyms_lingdata_config.json",
+    "partitioning": "synonyms_lingdata_config_partitioning.json"
+}
+ref_tree_names = {
+    "synonyms": ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"],
+    "partitioning": ["glottolog", "bin", "catg_bin", "catg_multi", "bin_BIN+G_2", "bin_BIN+G_x"]
+}
+dist_dirs = {
+    "synonyms": util.dist_dir,
+    "partitioning": util.dist_dir_partitioning
+}
+
+
+store = ResultsStore(store_path)
+for (experiment, config_path) in config_paths.items():
+    df = datacache.data(database, config_path)
+    if experiment == "synonyms":
+        df = adaptive.used_samples(df, adaptive.read_counts(adaptive.counts_path(results_dir)))
+    for (i, row) in df.iterrows():
+        try:
+            ingest_dataset(store, experiment, row)
+        except Exception as e:
+            print("Ingesting " + util.dataset_name(row) + " failed: " + str(e))
+store.close()
@@ -0,0 +1,154 @@
+import argparse
+import os
+
+# Heavy dependencies (lingdata, ete3, matplotlib, scipy, ...) are imported by
+# the subcommands which need them, so --help and light subcommands start fast
+
+
+def filters(args):
+    return {"ds_id": args.ds_id, "source": args.source, "ling_type": args.ling_type, "family": args.family}
+
+def filtered(args):
+    # Stages writing raxml_pythia_results.csv for filtered datasets keep the
+    # rows of the others
+    return any(values is not None and len(values) > 0 for values in filters(args).values())
+
+def trace_path(args):
+    return args.trace if args.trace is not None else os.path.join(args.results_dir, "trace.jsonl")
+
+def datasets(args, all_samples = False):
+    # Restricted to the sampled MSAs chosen by the adaptive subcommand, if it ran
+    import lingdata.database as database
+    import code.datacache as datacache
+    import code.adaptive as adaptive
+    import code.util as util
+    df = datacache.data(database, args.config)
+    df = util.filter_datasets(df, filters(args))
+    if all_samples:
+        return df
+    return adaptive.used_samples(df, adaptive.read_counts(adaptive.counts_path(args.results_dir)))
+
+def stages(args):
+    import code.stages as stages
+    import code.raxmlng as raxmlng
+    import code.pythia as pythia
+    import code.distances as distances
+    import code.tracing as tracing
+    tracing.trace_path = trace_path(args)
+    raxmlng.exe_path = args.raxmlng
+    raxmlng.timeout = args.timeout
+    pythia.raxmlng_path = args.raxmlng
+    pythia.predictor_path = args.predictor
+    distances.exe_path = args.qdist
+    distances.tree_cache_dir = args.tree_cache
+    stages.results_dir = args.results_dir
+    stages.num_processes = args.processes
+    return stages
+
+def infer(args):
+    stages(args).run_raxml_ng(datasets(args))
+
+def consense(args):
+    stages(args).consense_trees(datasets(args))
+
+def distances(args):
+    stages(args).calculate_distances(datasets(args))
+
+def pythia(args):
+    stages(args).run_pythia(datasets(args))
+
+def results(args):
+    stages(args).write_results_df(datasets(args), filtered(args))
+
+def pipeline(args):
+    s = stages(args)
+    s.build_pipeline(datasets(args), filtered(args)).run(args.processes)
+
+def worker(args):
+    stages(args).run_worker(datasets(args), args.lease_timeout, args.heartbeat, filtered(args))
+
+def adaptive_sampling(args):
+    import code.adaptive as adaptive
+    tolerances = dict(adaptive.tolerances)
+    for tolerance in args.tolerance or []:
+        (name, value) = tolerance.split("=")
+        if name not in tolerances:
+            raise ValueError("Unknown statistic " + name + ", expected one of " + ", ".join(tolerances))
+        tolerances[name] = float(value)
+    s = stages(args)
+    df = s.run_adaptive(datasets(args, True), args.min_samples, args.round_size, tolerances)
+    s.write_results_df(df, filtered(args))
+
+def trace_report(args):
+    import code.tracing as tracing
+    tracing.report(trace_path(args), args.top)
+
+def analysis_module(args):
+    if args.partitioning:
+        import analysis_partitioning as analysis
+    else:
+        import analysis
+    analysis.results_dir = args.results_dir
+    if args.float32:
+        import numpy as np
+        analysis.matrix_dtype = np.float32
+    return analysis
+
+def analyze(args):
+    analysis = analysis_module(args)
+    analysis.report(analysis.load(filters(args)))
+
+def plot(args):
+    analysis = analysis_module(args)
+    if not hasattr(analysis, "plot"):
+        print("No plots for this analysis")
+        return
+    analysis.plots_dir = os.path.join(args.results_dir, "plots")
+    analysis.plot(analysis.load(filters(args)))
+
+
+commands = {
+    "infer": (infer, "run the RAxML-NG inferences"),
+    "consense": (consense, "build the consensus trees of the sampled trees"),
+    "distances": (distances, "calculate the RF and GQ distance matrices"),
+    "pythia": (pythia, "predict the difficulties with Pythia"),
+    "results": (results, "write raxml_pythia_results.csv"),
+    "pipeline": (pipeline, "run all stages whose inputs changed"),
+    "worker": (worker, "claim and run units of the work queue shared with other workers"),
+    "adaptive": (adaptive_sampling, "infer sampled MSAs in rounds until the statistics converge"),
+    "trace": (trace_report, "summarize the run trace: hottest stages and datasets, progress"),
+    "analyze": (analyze, "print the evaluation from the results store"),
+    "plot": (plot, "plot the evaluation from the results store")
+}
+
+parser = argparse.ArgumentParser(prog = "synonyms")
+subparsers = parser.add_subparsers(dest = "command", required = True)
+for (name, (function, description)) in commands.items():
+    subparser = subparsers.add_parser(name, help = description)
+    subparser.set_defaults(function = function)
+    subparser.add_argument("--config", default = "synonyms_lingdata_config.json")
+    subparser.add_argument("--results-dir", dest = "results_dir", default = "data/results")
+    subparser.add_argument("--processes", type = int, default = os.cpu_count())
+    subparser.add_argument("--raxmlng", default = "./bin/raxml-ng")
+    subparser.add_argument("--qdist", default = "./bin/qdist")
+    subparser.add_argument("--timeout", type = float, help = "seconds after which a RAxML-NG inference is stopped")
+    subparser.add_argument("--predictor", default = "predictors/latest.pckl")
+    subparser.add_argument("--tree-cache", dest = "tree_cache", default = "data/cache/trees", help = "cache of the prepared reference trees, disabled if empty")
+    subparser.add_argument("--trace", help = "run trace, by default trace.jsonl in the results dir")
+    subparser.add_argument("--partitioning", action = "store_true", help = "evaluate the partitioning experiment (analyze, plot)")
+    subparser.add_argument("--float32", action = "store_true", help = "keep the distance matrices as float32 (analyze, plot)")
+    if name == "adaptive":
+        subparser.add_argument("--min-samples", dest = "min_samples", type = int, default = 20)
+        subparser.add_argument("--round-size", dest = "round_size", type = int, default = 10)
+        subparser.add_argument("--tolerance", action = "append", help = "maximal confidence interval width as statistic=value, e.g. rf_sampled_avg=0.01, may be repeated")
+    if name == "worker":
+        subparser.add_argument("--lease-timeout", dest = "lease_timeout", type = float, default = 600, help = "seconds without heartbeat after which a unit is retried")
+        subparser.add_argument("--heartbeat", type = float, default = 60, help = "seconds between heartbeats")
+    if name == "trace":
+        subparser.add_argument("--top", type = int, default = 10, help = "number of datasets listed")
+    for column in ["ds_id", "source", "ling_type", "family"]:
+        subparser.add_argument("--" + column.replace("_", "-"), dest = column, action = "append", help = "only datasets with this " + column + ", may be repeated")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    args.function(args)
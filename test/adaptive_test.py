@@ -0,0 +1,74 @@
+import sys
+sys.path.append("../code")
+
+import adaptive
+from distances import DistanceMatrix
+
+import numpy as np
+import pandas as pd
+
+def distance_matrix(num_sampled, rng, spread):
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    n = num_sampled + len(ref_tree_names)
+    condensed = {metric: 0.5 + spread * rng.random(n * (n + 1) // 2) for metric in ["rf", "gq"]}
+    return DistanceMatrix(None, ref_tree_names, ["rf", "gq"], condensed)
+
+def test_intervals():
+    rng = np.random.default_rng(2)
+    dm = distance_matrix(30, rng, 0.5)
+    difficulties = 0.3 + 0.2 * rng.random(30)
+    intervals = adaptive.intervals(adaptive.sample_values(dm, difficulties))
+    assert(list(intervals) == list(adaptive.statistics))
+    assert(abs(intervals["rf_sampled_avg"][0] - dm.sampled_avg_avg_dist("rf")) < 1e-12)
+    assert(abs(intervals["gqd_sampled_median"][0] - np.median(dm.ref_tree_dist_vector("glottolog", "gq"))) < 1e-12)
+    assert(abs(intervals["difficulty_variance"][0] - np.var(difficulties)) < 1e-12)
+    for (value, lower, upper) in intervals.values():
+        assert(lower <= upper)
+    assert(not adaptive.converged(intervals))
+    assert(adaptive.next_num_samples(30, 100, intervals, 20, 10) == 40)
+    # identical samples leave no uncertainty
+    dm = distance_matrix(30, rng, 0.0)
+    intervals = adaptive.intervals(adaptive.sample_values(dm, [0.4] * 30))
+    assert(adaptive.converged(intervals))
+    assert(adaptive.next_num_samples(30, 100, intervals, 20, 10) is None)
+    assert(adaptive.next_num_samples(10, 100, intervals, 20, 10) == 20)
+    assert(adaptive.next_num_samples(0, 15, None, 20, 10) == 15)
+    assert(adaptive.next_num_samples(15, 15, None, 20, 10) is None)
+    # statistics which are NaN in every sample are left out
+    intervals = adaptive.intervals(adaptive.sample_values(dm, [float("nan")] * 30))
+    assert(intervals["difficulty_variance"][0] != intervals["difficulty_variance"][0])
+    assert(adaptive.converged(intervals))
+    # values without finite interval do not count as converged
+    intervals["rf_sampled_avg"] = (0.5, float("nan"), float("nan"))
+    assert(not adaptive.converged(intervals))
+    assert(adaptive.next_num_samples(30, 100, intervals, 20, 10) == 40)
+
+def test_no_butterflies():
+    # GQ distances to a Glottolog tree without butterflies are NaN, sampling
+    # stops once the other statistics converge
+    rng = np.random.default_rng(3)
+    dm = distance_matrix(20, rng, 0.0)
+    glottolog = dm.ref_tree_position("glottolog")
+    dm.condensed("gq")[[dm.matrices["gq"].index(glottolog, i) for i in range(dm.num_sampled)]] = float("nan")
+    values = adaptive.sample_values(dm, [0.4] * 20)
+    assert(np.isnan(values["gqd"]).all())
+    intervals = adaptive.intervals(values)
+    assert(adaptive.converged(intervals))
+    assert(adaptive.next_num_samples(20, 100, intervals, 20, 10) is None)
+    # without any statistic the dataset stops at min_samples
+    dm.condensed("rf")[:] = float("nan")
+    intervals = adaptive.intervals(adaptive.sample_values(dm, [float("nan")] * 20))
+    assert(adaptive.next_num_samples(10, 100, intervals, 20, 10) == 20)
+    assert(adaptive.next_num_samples(20, 100, intervals, 20, 10) is None)
+
+def test_used_samples():
+    df = pd.DataFrame({"ds_id": ["a", "b"], "source": ["s", "s"], "ling_type": ["cognate", "cognate"], "family": ["f", "f"],
+        "sampled_msa_paths": [["a0.phy", "a1.phy", "a2.phy"], ["b0.phy", "b1.phy", "b2.phy"]]})
+    used = adaptive.used_samples(df, {"a_s_cognate_f": {"num_samples": 2}})
+    assert(list(used["sampled_msa_paths"]) == [["a0.phy", "a1.phy"], ["b0.phy", "b1.phy", "b2.phy"]])
+    assert(len(df["sampled_msa_paths"][0]) == 3)
+
+
+test_intervals()
+test_no_butterflies()
+test_used_samples()
@@ -0,0 +1,45 @@
+import sys
+sys.path.append("../code")
+
+import datacache
+
+import os
+import json
+import shutil
+import pandas as pd
+
+class Database:
+
+    def __init__(self):
+        self.calls = 0
+
+    def read_config(self, config_path):
+        self.config_path = config_path
+
+    def data(self):
+        self.calls += 1
+        return pd.DataFrame({"ds_id": ["a", "b"], "msa_paths": [{"bin": "a.phy"}, {"bin": "b.phy"}]})
+
+def test_datacache():
+    d = "../test_data/datacache"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(os.path.join(d, "lingdata"))
+    config_path = os.path.join(d, "config.json")
+    with open(config_path, "w+") as config_file:
+        json.dump({"data_dir": os.path.join(d, "lingdata")}, config_file)
+    cache_dir = os.path.join(d, "cache")
+    database = Database()
+    df = datacache.data(database, config_path, cache_dir)
+    assert(database.calls == 1)
+    cached_df = datacache.data(database, config_path, cache_dir)
+    assert(database.calls == 1)
+    assert(cached_df.equals(df) and cached_df["msa_paths"][1] == {"bin": "b.phy"})
+    os.makedirs(os.path.join(d, "lingdata", "new_dataset"))
+    datacache.data(database, config_path, cache_dir)
+    assert(database.calls == 2)
+    assert(len(os.listdir(cache_dir)) == 1)
+    shutil.rmtree(d)
+
+
+test_datacache()
@@ -1,19 +1,20 @@
 import sys
 sys.path.append("../code")
 
-from distances import DistanceMatrixIO
+from distances import DistanceMatrixIO, DistanceMatrix
 import distances as distances
 
 from ete3 import Tree
 import os
+import json
+import shutil
+import tempfile
+import numpy as np
 
-def test_distances():
+def write_bodtkhobwa_matrix(dist_dir):
     metrics = ["rf", "gq"]
     ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
     d_io = DistanceMatrixIO(metrics, ref_tree_names)
-    dist_dir = "../test_data/distances"
-    if not os.path.isdir(dist_dir):
-        os.mkdir(dist_dir)
     sampled_tree_paths = [
         "../test_data/trees/bodtkhobwa/sampled00_bin.raxml.bestTree",
         "../test_data/trees/bodtkhobwa/sampled01_bin.raxml.bestTree",
@@ -27,6 +28,12 @@ def test_distances():
     ref_tree_paths["catg_multi"] = "../test_data/trees/bodtkhobwa/full_catg_multi.raxml.bestTree"
     ref_tree_paths["consensus"] = "../test_data/trees/bodtkhobwa/sampled_consensus.raxml.consensusTreeMR"
     d_io.write_matrix(dist_dir, sampled_tree_paths, ref_tree_paths)
+    return d_io, sampled_tree_paths, ref_tree_paths
+
+def test_distances():
+    d = tempfile.mkdtemp(dir = "../test_data")
+    dist_dir = os.path.join(d, "distances")
+    (d_io, sampled_tree_paths, ref_tree_paths) = write_bodtkhobwa_matrix(dist_dir)
     dm = d_io.read_matrix(dist_dir)
     ref_trees = {}
     for name, path in ref_tree_paths.items():
@@ -62,10 +69,293 @@ def test_distances():
     gq_avg = sum(gq_dists)/len(gq_dists)
     rf_avg2 = dm.sampled_avg_dists("rf")
     gq_avg2 = dm.sampled_avg_dists("gq")
+    shutil.rmtree(d)
+
+
+
+def test_rf_matrix():
+    tree_paths = [os.path.join("../test_data/trees/bodtkhobwa", name) for name in sorted(os.listdir("../test_data/trees/bodtkhobwa"))]
+    trees = [Tree(tree_path) for tree_path in tree_paths] + [None, Tree("((Rupa,Shergaon),Khoina,(Duhumbi,Khispi));")]
+    m = distances.Bipartitions(trees).rf_matrix()
+    for i in range(len(trees)):
+        for j in range(len(trees)):
+            rf = distances.rf_distance(trees[i], trees[j])
+            if rf != rf:
+                assert(m[i][j] != m[i][j])
+            else:
+                assert(m[i][j] == rf)
+
+def test_rf_stats():
+    tree_paths = [os.path.join("../test_data/trees/bodtkhobwa", name) for name in sorted(os.listdir("../test_data/trees/bodtkhobwa")) if name.endswith(".bestTree")]
+    trees = [Tree(tree_path) for tree_path in tree_paths]
+    ml_trees_path = "../test_data/ml_trees.nw"
+    with open(ml_trees_path, "w+") as outfile:
+        for tree_path in tree_paths:
+            outfile.write(open(tree_path).read().strip() + "\n")
+    b = distances.read_bipartitions(ml_trees_path)
+    os.remove(ml_trees_path)
+    dists = [distances.rf_distance(trees[i], trees[j]) for i in range(len(trees)) for j in range(i + 1, len(trees))]
+    mean, per_tree = b.rf_stats()
+    assert(abs(mean - sum(dists) / len(dists)) < 1e-12)
+    for i in range(len(trees)):
+        others = [distances.rf_distance(trees[i], trees[j]) for j in range(len(trees)) if j != i]
+        assert(abs(per_tree[i] - sum(others) / len(others)) < 1e-12)
+    values, counts = b.rf_distribution()
+    assert(sorted(dists) == [v for (v, c) in zip(values, counts) for _ in range(c)])
+
+def test_consensus():
+    tree_dir = "../test_data/trees/bodtkhobwa"
+    trees = [Tree(os.path.join(tree_dir, name)) for name in sorted(os.listdir(tree_dir)) if name.startswith("sampled0")]
+    ref = Tree(os.path.join(tree_dir, "sampled_consensus.raxml.consensusTreeMR"))
+    newick, splits = distances.consensus(trees)
+    consensus_tree = Tree(newick)
+    assert(distances.rf_distance(consensus_tree, ref) == 0)
+    ref_supports = sorted(node.support for node in ref.traverse() if not node.is_leaf() and not node.is_root())
+    assert(sorted(node.support for node in consensus_tree.traverse() if not node.is_leaf() and not node.is_root()) == ref_supports)
+    assert(sorted(100 * support for (names, support) in splits) == ref_supports)
+    newick, splits = distances.consensus(distances.Bipartitions(trees), extended = True)
+    assert(len(splits) == len(trees[0]) - 3)
+    assert(distances.rf_distance(Tree(newick), ref) == 3 / 7)
+
+def test_gq_distance():
+    tree_paths = [os.path.join("../test_data/trees/bodtkhobwa", name) for name in sorted(os.listdir("../test_data/trees/bodtkhobwa"))]
+    quartet_trees = [distances.QuartetTree(Tree(tree_path)) for tree_path in tree_paths]
+    for i, tree_path in enumerate(tree_paths):
+        gq_dists = quartet_trees[i].distances(quartet_trees)
+        for j in range(len(tree_paths)):
+            assert(gq_dists[j] == distances.gq_distance(tree_path, tree_paths[j]))
+            if os.path.isfile(distances.exe_path):
+                assert(gq_dists[j] == distances.qdist_distance(tree_path, tree_paths[j]))
+        if os.path.isfile(distances.exe_path):
+            assert(gq_dists == distances.qdist_distances([(tree_path, other) for other in tree_paths], 4))
+    star_tree = Tree("(Duhumbi,Jerigaon,Khispi,Khoina,Khoitam,Rahung,Rupa,Shergaon);")
+    gqd = distances.gq_distance(star_tree, tree_paths[0])
+    assert(gqd != gqd)
+    pruned_tree = Tree("((Rupa,Shergaon),Khoina,(Duhumbi,Khispi));")
+    gqd = distances.gq_distance(pruned_tree, tree_paths[0])
+    assert(gqd != gqd)
+
+def test_write_matrices():
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    d_io = DistanceMatrixIO(metrics, ref_tree_names, block_size = 7)
+    tree_dir = "../test_data/trees/bodtkhobwa"
+    ref_tree_paths = {}
+    ref_tree_paths["glottolog"] = os.path.join(tree_dir, "glottolog.tre")
+    ref_tree_paths["bin"] = os.path.join(tree_dir, "full_bin.raxml.bestTree")
+    ref_tree_paths["catg_bin"] = os.path.join(tree_dir, "full_catg.raxml.bestTree")
+    ref_tree_paths["catg_multi"] = os.path.join(tree_dir, "full_catg_multi.raxml.bestTree")
+    ref_tree_paths["consensus"] = os.path.join(tree_dir, "sampled_consensus.raxml.consensusTreeMR")
+    sampled_tree_paths = [os.path.join(tree_dir, "sampled0" + str(i) + "_bin.raxml.bestTree") for i in range(5)]
+    jobs = []
+    for i in range(4):
+        jobs.append((os.path.join("../test_data/distances_parallel", str(i)), sampled_tree_paths[i:] + [os.path.join(tree_dir, "missing.raxml.bestTree")], ref_tree_paths))
+    d_io.write_matrices(jobs, 3)
+    for (dist_dir, job_sampled_tree_paths, job_ref_tree_paths) in jobs:
+        for metric in metrics:
+            m = d_io.matrix(d_io.tree_paths(dist_dir, job_sampled_tree_paths, job_ref_tree_paths), metric)
+            with open(os.path.join(dist_dir, "matrix_" + metric + ".csv"), "r") as dm_file:
+                assert(dm_file.read() == "\n".join([",".join([str(el) for el in row]) for row in m]))
+    shutil.rmtree("../test_data/distances_parallel")
+
+def test_extend_matrix():
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    tree_dir = "../test_data/trees/bodtkhobwa"
+    dist_dir = "../test_data/distances_extend"
+    ref_tree_paths = {}
+    ref_tree_paths["glottolog"] = os.path.join(tree_dir, "glottolog.tre")
+    ref_tree_paths["bin"] = os.path.join(tree_dir, "full_bin.raxml.bestTree")
+    ref_tree_paths["catg_bin"] = os.path.join(tree_dir, "full_catg.raxml.bestTree")
+    ref_tree_paths["catg_multi"] = os.path.join(tree_dir, "full_catg_multi.raxml.bestTree")
+    ref_tree_paths["consensus"] = os.path.join(tree_dir, "sampled_consensus.raxml.consensusTreeMR")
+    sampled_tree_paths = [os.path.join(tree_dir, "sampled0" + str(i) + "_bin.raxml.bestTree") for i in range(5)]
+    changed_tree_path = os.path.join("../test_data", "changed.raxml.bestTree")
+    for storage in ["csv", "npy"]:
+        for processes in [1, 2]:
+            if os.path.isdir(dist_dir):
+                shutil.rmtree(dist_dir)
+            shutil.copyfile(sampled_tree_paths[0], changed_tree_path)
+            d_io = DistanceMatrixIO(metrics, ref_tree_names[:3], block_size = 20, storage = storage)
+            d_io.write_matrices([(dist_dir, [changed_tree_path] + sampled_tree_paths[1:3], ref_tree_paths)], processes)
+            shutil.copyfile(sampled_tree_paths[4], changed_tree_path)
+            d_io = DistanceMatrixIO(metrics, ref_tree_names, block_size = 20, storage = storage)
+            job_sampled_tree_paths = [changed_tree_path] + sampled_tree_paths[1:]
+            if processes == 1:
+                d_io.write_matrix(dist_dir, job_sampled_tree_paths, ref_tree_paths)
+            else:
+                d_io.write_matrices([(dist_dir, job_sampled_tree_paths, ref_tree_paths)], processes)
+            dm = d_io.read_matrix(dist_dir)
+            tree_paths = d_io.tree_paths(dist_dir, job_sampled_tree_paths, ref_tree_paths)
+            for metric in metrics:
+                expected = [float(el) for row in d_io.matrix(tree_paths, metric) for el in row]
+                assert(str(dm.condensed(metric).tolist()) == str(expected))
+    # stored rows are only reused if computed by the same engine_version
+    d_io = DistanceMatrixIO(metrics, ref_tree_names)
+    d_io.write_matrix(dist_dir, sampled_tree_paths[:3], ref_tree_paths)
+    tampered = os.path.join(dist_dir, "matrix_rf.csv")
+    with open(tampered, "r") as matrix_file:
+        lines = matrix_file.readlines()
+    lines[1] = "0.5,0.0\n"
+    with open(tampered, "w+") as matrix_file:
+        matrix_file.writelines(lines)
+    d_io.write_matrix(dist_dir, sampled_tree_paths[:4], ref_tree_paths)
+    assert(d_io.read_matrix(dist_dir).d(1, 0, "rf") == 0.5)
+    header = d_io.read_header(dist_dir)
+    header["engine"] = "older"
+    with open(os.path.join(dist_dir, "matrix.json"), "w+") as header_file:
+        json.dump(header, header_file)
+    d_io.write_matrix(dist_dir, sampled_tree_paths, ref_tree_paths)
+    dm = d_io.read_matrix(dist_dir)
+    assert(d_io.read_header(dist_dir)["engine"] == distances.engine_version(["glottolog"]))
+    tree_paths = d_io.tree_paths(dist_dir, sampled_tree_paths, ref_tree_paths)
+    for metric in metrics:
+        expected = [float(el) for row in d_io.matrix(tree_paths, metric) for el in row]
+        assert(str(dm.condensed(metric).tolist()) == str(expected))
+    shutil.rmtree(dist_dir)
+    os.remove(changed_tree_path)
+
+def test_topology_dedup():
+    tree_dir = "../test_data/trees/bodtkhobwa"
+    dist_dir = "../test_data/distances_dedup"
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    os.makedirs(dist_dir)
+    tree = Tree(os.path.join(tree_dir, "sampled00_bin.raxml.bestTree"))
+    rerooted = tree.copy()
+    rerooted.set_outgroup(rerooted.get_leaves()[3])
+    for node in rerooted.traverse():
+        node.dist = 0.5
+    assert(distances.topology_key(tree) == distances.topology_key(rerooted))
+    assert(distances.topology_key(tree) != distances.topology_key(Tree(os.path.join(tree_dir, "sampled01_bin.raxml.bestTree"))))
+    duplicate_path = os.path.join(dist_dir, "rerooted.tre")
+    rerooted.write(outfile = duplicate_path)
+    sampled_tree_paths = [os.path.join(tree_dir, "sampled0" + str(i) + "_bin.raxml.bestTree") for i in [0, 1, 0, 1, 2]] + [duplicate_path]
+    ref_tree_paths = {"glottolog": os.path.join(tree_dir, "glottolog.tre"), "bin": os.path.join(tree_dir, "full_bin.raxml.bestTree")}
+    d_io = DistanceMatrixIO(["rf", "gq"], ["glottolog", "bin"])
+    calls = []
+    distance = distances.QuartetTree.distance
+    distances.QuartetTree.distance = lambda self, other: calls.append(1) or distance(self, other)
+    d_io.write_matrix(dist_dir, sampled_tree_paths, ref_tree_paths)
+    distances.QuartetTree.distance = distance
+    # 5 distinct topologies among the 8 trees, instead of 36 pairs
+    assert(len(calls) == 15)
+    dm = d_io.read_matrix(dist_dir)
+    tree_paths = sampled_tree_paths + [ref_tree_paths["glottolog"], ref_tree_paths["bin"]]
+    trees = [Tree(path) for path in tree_paths]
+    for i in range(len(trees)):
+        for j in range(i + 1):
+            assert(dm.d(i, j, "rf") == distances.rf_distance(trees[i], trees[j]))
+            assert(dm.d(i, j, "gq") == distances.gq_distance(tree_paths[i], tree_paths[j]))
+    header = d_io.read_header(dist_dir)
+    assert(header["unique_topologies"] == 3 and header["duplication_ratio"] == 2.0)
+    shutil.rmtree(dist_dir)
 
+def test_prepared_trees():
+    tree_dir = "../test_data/trees/bodtkhobwa"
+    d = "../test_data/prepared"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    # Glottolog tree with two languages missing in the MSA
+    glottolog = Tree(os.path.join(tree_dir, "glottolog.tre"))
+    leaf = glottolog.get_leaves()[0]
+    leaf.add_child(name = leaf.name)
+    leaf.add_child(name = "extra1")
+    leaf.name = ""
+    glottolog.get_leaves()[-1].up.add_child(name = "extra2")
+    glottolog_path = os.path.join(d, "glottolog.tre")
+    glottolog.write(outfile = glottolog_path, format = 9)
+    sampled_tree_paths = [os.path.join(tree_dir, "sampled0" + str(i) + "_bin.raxml.bestTree") for i in range(3)]
+    ref_tree_paths = {"glottolog": glottolog_path, "bin": os.path.join(tree_dir, "full_bin.raxml.bestTree")}
+    distances.tree_cache_dir = os.path.join(d, "cache")
+    distances.prepared_cache.clear()
+    d_io = DistanceMatrixIO(["rf", "gq"], ["glottolog", "bin"])
+    (trees, registry) = d_io.load_trees(sampled_tree_paths + [glottolog_path, ref_tree_paths["bin"]])
+    assert(trees[3].leaves == trees[0].leaves and len(registry.names) == 8)
+    assert(registry.register(["extra1", registry.names[2]]) == [8, 2])
+    # only the pruned Glottolog tree is cached on disk
+    assert(len(os.listdir(distances.tree_cache_dir)) == 1)
+    distances.prepared_cache.clear()
+    assert(d_io.load_trees(sampled_tree_paths + [glottolog_path, ref_tree_paths["bin"]])[0][3].key == trees[3].key)
+    # a new version of the Glottolog tree replaces the entry of the old one
+    cache_files = os.listdir(distances.tree_cache_dir)
+    os.utime(glottolog_path, ns = (os.stat(glottolog_path).st_atime_ns, os.stat(glottolog_path).st_mtime_ns + 10**9))
+    distances.prepared_cache.clear()
+    assert(d_io.load_trees(sampled_tree_paths + [glottolog_path, ref_tree_paths["bin"]])[0][3].key == trees[3].key)
+    assert(len(os.listdir(distances.tree_cache_dir)) == 1 and os.listdir(distances.tree_cache_dir) != cache_files)
+    dist_dir = os.path.join(d, "distances")
+    d_io.write_matrix(dist_dir, sampled_tree_paths, ref_tree_paths)
+    dm = d_io.read_matrix(dist_dir)
+    pruned = glottolog.copy()
+    pruned.prune(trees[0].tree.get_leaf_names())
+    for (i, sampled_tree_path) in enumerate(sampled_tree_paths):
+        sampled_tree = Tree(sampled_tree_path)
+        assert(dm.ref_tree_dist_vector("glottolog", "gq")[i] == distances.gq_distance(pruned, sampled_tree))
+        assert(dm.ref_tree_dist_vector("glottolog", "rf")[i] == distances.rf_distance(glottolog, sampled_tree))
+    distances.tree_cache_dir = ""
+    distances.prepared_cache.clear()
+    shutil.rmtree(d)
+
+def test_npy_storage():
+    metrics = ["rf", "gq"]
+    ref_tree_names = ["glottolog", "bin", "catg_bin", "catg_multi", "consensus"]
+    d = tempfile.mkdtemp(dir = "../test_data")
+    dm_csv = write_bodtkhobwa_matrix(os.path.join(d, "csv"))[0].read_matrix(os.path.join(d, "csv"))
+    d_io = DistanceMatrixIO(metrics, ref_tree_names, storage = "npy")
+    dist_dir = os.path.join(d, "npy")
+    shutil.copytree(os.path.join(d, "csv"), dist_dir)
+    d_io.convert(dist_dir)
+    dm_npy = d_io.read_matrix(dist_dir)
+    assert(dm_npy.num_sampled == dm_csv.num_sampled)
+    for metric in metrics:
+        assert(len(dm_npy.matrices[metric]) == len(dm_csv.matrices[metric]))
+        for (row_npy, row_csv) in zip(dm_npy.matrices[metric], dm_csv.matrices[metric]):
+            assert(list(row_npy) == list(row_csv))
+        for ref_tree_name in ref_tree_names:
+            assert(list(dm_npy.ref_tree_dist_vector(ref_tree_name, metric)) == dm_csv.ref_tree_dist_vector(ref_tree_name, metric))
+            for ref_tree_name2 in ref_tree_names:
+                assert(dm_npy.ref_tree_dist(ref_tree_name, ref_tree_name2, metric) == dm_csv.ref_tree_dist(ref_tree_name, ref_tree_name2, metric))
+    shutil.rmtree(d)
 
 
+def test_compact_matrix():
+    ref_tree_names = ["glottolog", "bin"]
+    n = 8
+    condensed = np.random.default_rng(0).random(n * (n + 1) // 2)
+    condensed[3] = float("nan")
+    full = distances.square(condensed)
+    dm = DistanceMatrix(None, ref_tree_names, ["rf"], {"rf": condensed})
+    triangle = dm.matrices["rf"]
+    for i in range(n):
+        for j in range(n):
+            assert(triangle.index(i, j) == triangle.index(j, i) == triangle.index(i - n, j - n))
+            assert(str(dm.d(i, j, "rf")) == str(full[i, j]))
+    assert(dm.ref_tree_dist("bin", "glottolog", "rf") == full[7, 6])
+    assert(dm.ref_tree_dist_vector("glottolog", "rf") == full[6, :6].tolist())
+    assert(str(dm.ref_tree_dists("rf").tolist()) == str(full[6:, 6:].tolist()))
+    assert(str(triangle.upper(6).tolist()) == str(full[:6, :6][np.triu_indices(6, 1)].tolist()))
+    dm32 = DistanceMatrix(None, ref_tree_names, ["rf"], {"rf": condensed}, np.float32)
+    assert(dm32.condensed("rf").dtype == np.float32 and dm32.condensed("rf").nbytes * 2 == condensed.nbytes)
+    assert(dm32.d(2, 0, "rf") != dm32.d(2, 0, "rf"))
+    assert(np.allclose(dm32.ref_tree_dist_vector("bin", "rf"), dm.ref_tree_dist_vector("bin", "rf")))
+    for (name, value) in dm.sampled_stats("rf").items():
+        assert(abs(dm32.sampled_stats("rf")[name] - value) < 1e-6)
+    d = tempfile.mkdtemp(dir = "../test_data")
+    dm_csv = write_bodtkhobwa_matrix(d)[0].read_matrix(d)
+    shutil.rmtree(d)
+    assert(isinstance(dm_csv.condensed("rf"), np.ndarray) and dm_csv.condensed("rf").dtype == np.float64)
 
 
 distances.exe_path = "./../bin/qdist"
 test_distances()
+test_rf_matrix()
+test_rf_stats()
+test_consensus()
+test_gq_distance()
+test_write_matrices()
+test_extend_matrix()
+test_topology_dedup()
+test_prepared_trees()
+test_npy_storage()
+test_compact_matrix()
@@ -0,0 +1,45 @@
+import sys
+sys.path.append("../code")
+
+import features
+from distances import DistanceMatrix
+
+import numpy as np
+import pandas as pd
+
+def test_dataset_features():
+    ref_tree_names = ["glottolog", "bin", "catg_bin"]
+    rng = np.random.default_rng(1)
+    dms = []
+    for num_sampled in [4, 7]:
+        n = num_sampled + len(ref_tree_names)
+        condensed = {metric: rng.random(n * (n + 1) // 2) for metric in ["rf", "gq"]}
+        dms.append(DistanceMatrix(None, ref_tree_names, ["rf", "gq"], condensed))
+    feature_list = {
+        "rf_bin_avg": ("ref_stat", "mean", "bin", "rf"),
+        "gq_glottolog_median": ("ref_stat", "median", "glottolog", "gq"),
+        "rf_sampled_max_avg": ("sampled_stat", "max_avg", "rf"),
+        "gq_glottolog_bin": ("ref_dist", "glottolog", "bin", "gq"),
+        "rf_bin_catg_bin": ("ref_dist", "catg_bin", "bin", "rf")
+    }
+    # a third matrix of the same shape as the first is stacked with it
+    n = 4 + len(ref_tree_names)
+    dms.append(DistanceMatrix(None, ref_tree_names, ["rf", "gq"], {metric: rng.random(n * (n + 1) // 2) for metric in ["rf", "gq"]}))
+    series = pd.Series([dms[0], dms[1], None, dms[2]], index = [3, 5, 8, 9])
+    df = features.dataset_features(series, feature_list)
+    assert(list(df.index) == [3, 5, 8, 9] and list(df.columns) == list(feature_list))
+    for (i, dm) in zip([3, 5, 9], dms):
+        assert(df.at[i, "rf_bin_avg"] == dm.avg_ref_tree_dist("bin", "rf"))
+        assert(df.at[i, "gq_glottolog_median"] == np.median(dm.ref_tree_dist_vector("glottolog", "gq")))
+        assert(df.at[i, "rf_sampled_max_avg"] == dm.sampled_max_avg_dist("rf"))
+        assert(df.at[i, "gq_glottolog_bin"] == dm.ref_tree_dist("glottolog", "bin", "gq"))
+        assert(df.at[i, "rf_bin_catg_bin"] == dm.ref_tree_dist("bin", "catg_bin", "rf"))
+    assert(df.loc[8].isna().all())
+    try:
+        features.dataset_features(series, {"x": ("unknown", "rf")})
+        assert(False)
+    except ValueError:
+        pass
+
+
+test_dataset_features()
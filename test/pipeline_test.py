@@ -0,0 +1,85 @@
+import sys
+sys.path.append("../code")
+
+from pipeline import Pipeline, Node
+
+import os
+import shutil
+
+def write_file(path, content):
+    with open(path, "w+") as f:
+        f.write(content)
+
+def concat(inputs, output, runs, name):
+    runs.append(name)
+    write_file(output, "".join([open(path).read() for path in inputs]))
+
+def build(d, runs):
+    p = Pipeline(os.path.join(d, "state.json"))
+    for x in ["a", "b"]:
+        p.add(Node("copy_" + x, lambda x=x: concat([os.path.join(d, x + ".txt")], os.path.join(d, x + ".out"), runs, "copy_" + x),
+            inputs = [os.path.join(d, x + ".txt")], outputs = [os.path.join(d, x + ".out")]))
+    p.add(Node("join", lambda: concat([os.path.join(d, "a.out"), os.path.join(d, "b.out")], os.path.join(d, "ab.out"), runs, "join"),
+        params = ["join"], deps = ["copy_a", "copy_b"], outputs = [os.path.join(d, "ab.out")], cores = 2))
+    return p
+
+def test_pipeline():
+    d = "../test_data/pipeline"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    write_file(os.path.join(d, "a.txt"), "a")
+    write_file(os.path.join(d, "b.txt"), "b")
+    runs = []
+    status = build(d, runs).run(2)
+    assert(sorted(runs) == ["copy_a", "copy_b", "join"])
+    assert(all(s == "done" for s in status.values()))
+    assert(open(os.path.join(d, "ab.out")).read() == "ab")
+    runs = []
+    build(d, runs).run(2)
+    assert(runs == [])
+    write_file(os.path.join(d, "b.txt"), "c")
+    build(d, runs).run(2)
+    assert(runs == ["copy_b", "join"])
+    assert(open(os.path.join(d, "ab.out")).read() == "ac")
+    runs = []
+    os.remove(os.path.join(d, "a.out"))
+    os.remove(os.path.join(d, "a.txt"))
+    status = build(d, runs).run(2)
+    assert(status["copy_a"] == "failed" and status["copy_b"] == "valid" and status["join"] == "skipped")
+    shutil.rmtree(d)
+
+def test_partial_outputs():
+    d = "../test_data/pipeline_partial"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    write_file(os.path.join(d, "a.txt"), "a")
+    write_file(os.path.join(d, "b.out"), "b")
+    # outputs from before the pipeline existed are adopted, not recomputed
+    runs = []
+    p = build(d, runs)
+    p.nodes["copy_b"].run = lambda: runs.append("copy_b")
+    status = p.run(2)
+    assert(sorted(runs) == ["copy_a", "join"] and status["copy_b"] == "valid")
+    assert(open(os.path.join(d, "ab.out")).read() == "ab")
+    # a dependency completing without its output skips its dependents,
+    # unless they are partial
+    os.remove(os.path.join(d, "b.out"))
+    runs = []
+    p = build(d, runs)
+    p.nodes["copy_b"].run = lambda: runs.append("copy_b")
+    p.add(Node("report", lambda: write_file(os.path.join(d, "report.out"), str(os.path.isfile(os.path.join(d, "b.out")))),
+        deps = ["copy_b"], outputs = [os.path.join(d, "report.out")], partial = True))
+    status = p.run(2)
+    assert(status["copy_b"] == "incomplete" and status["join"] == "skipped" and status["report"] == "done")
+    assert(open(os.path.join(d, "report.out")).read() == "False")
+    # incomplete nodes are retried, valid ones are not
+    runs = []
+    p.run(2)
+    assert(runs == ["copy_b"])
+    shutil.rmtree(d)
+
+
+test_pipeline()
+test_partial_outputs()
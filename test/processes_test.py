@@ -0,0 +1,71 @@
+import sys
+sys.path.append("../code")
+
+import processes
+import tracing
+
+import os
+import time
+import shutil
+import asyncio
+
+def test_run():
+    res = processes.run(["sh", "-c", "echo out; echo err >&2"], "test", "", capture = True)
+    assert(res.ok() and res.stdout == "out\n" and res.stderr == "err\n")
+    res = processes.run(["sh", "-c", "echo missing file >&2; exit 3"], "test", "")
+    assert(res.returncode == 3 and not res.ok())
+    assert(res.describe() == "sh -c 'echo missing file >&2; exit 3' failed with exit status 3:\nmissing file")
+    try:
+        res.check()
+        assert(False)
+    except processes.ProcessError as e:
+        assert(e.result is res)
+    res = processes.run(["./does_not_exist"], "test", "")
+    assert(res.returncode is None and "could not be started" in res.describe())
+    # no shell, arguments are passed verbatim
+    assert(processes.run(["echo", "a b", "$HOME"], "test", "", capture = True).stdout == "a b $HOME\n")
+
+def test_timeout():
+    d = "../test_data/processes"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    tracing.trace_path = os.path.join(d, "trace.jsonl")
+    start = time.perf_counter()
+    res = processes.run(["sleep", "10"], "test", "", timeout = 0.2)
+    assert(res.timed_out and not res.ok() and time.perf_counter() - start < 5)
+    processes.kill_grace = 0.2
+    # ignores SIGTERM, so it is killed
+    res = processes.run(["sh", "-c", "trap '' TERM; sleep 10"], "test", "", timeout = 0.2)
+    assert(res.timed_out and res.returncode == -9)
+    processes.kill_grace = 5
+    records = tracing.read(tracing.trace_path)
+    assert([record.get("timed_out") for record in records] == [True, True])
+    assert(records[0]["command"] == "sleep 10")
+    tracing.trace_path = ""
+    shutil.rmtree(d)
+
+def test_manager():
+    # 4 jobs of 0.3 s with 2 slots take 2 rounds, a job of cost 2 runs alone
+    jobs = [{"argv": ["sleep", "0.3"], "stage": "test", "target": ""} for _ in range(4)]
+    start = time.perf_counter()
+    results = processes.run_all(jobs, 2)
+    wall = time.perf_counter() - start
+    assert(all(res.ok() for res in results))
+    assert(0.55 < wall < 1.5)
+    jobs = [{"argv": ["echo", str(i)], "stage": "test", "target": "", "cost": 2 if i == 0 else 1, "capture": True} for i in range(20)]
+    results = processes.run_all(jobs, 2)
+    assert([res.stdout for res in results] == [str(i) + "\n" for i in range(20)])
+
+    async def overlapping():
+        manager = processes.Manager(3)
+        return await asyncio.gather(*[manager.run(["sh", "-c", "sleep 0.3; echo " + str(i)], "test", "", capture = True) for i in range(3)])
+    start = time.perf_counter()
+    results = asyncio.run(overlapping())
+    assert(time.perf_counter() - start < 0.6)
+    assert([res.stdout for res in results] == ["0\n", "1\n", "2\n"])
+
+
+test_run()
+test_timeout()
+test_manager()
@@ -0,0 +1,48 @@
+import sys
+sys.path.append("../code")
+
+import pythia
+
+import io
+import os
+import json
+import shutil
+import tracing
+
+def pad(msa_string):
+    outfile = io.StringIO()
+    pythia.pad_phylip(io.StringIO(msa_string), outfile)
+    return outfile.getvalue()
+
+def test_pad_phylip():
+    interleaved = " 2 23\na         0101010101 0101010101\nb         1111111111 0000000000\n\n010\n1-1\n"
+    assert(pad(interleaved) == " 2 30\na         0101010101 0101010101\nb         1111111111 0000000000\n\n010-------\n1-1-------\n")
+    sequential = " 2 20\na         0101010101 0101010101\nb         1111111111 0000000000\n"
+    assert(pad(sequential) == " 2 30\na         0101010101 0101010101 ----------\nb         1111111111 0000000000 ----------\n")
+
+def test_run_batch_process():
+    # the batch runs in a new process, without predictor it writes nothing
+    d = "../test_data/pythia"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    done = os.path.join(d, "done")
+    with open(done, "w+") as done_file:
+        done_file.write("0.5\n")
+    tracing.trace_path = os.path.join(d, "trace.jsonl")
+    pythia.raxmlng_path = "../bin/raxml-ng"
+    pythia.predictor_path = os.path.join(d, "missing.pckl")
+    argv = pythia.batch_command(["a.phy", "b.phy"], ["a", "b"], 2)
+    assert(argv[-4:] == ["a.phy", "a", "b.phy", "b"] and argv[argv.index("--trace") + 1] == tracing.trace_path)
+    pythia.run_batch_process(["../test_data/msa.phy", "../test_data/msa.phy"], [os.path.join(d, "todo"), done], 2)
+    assert(sorted(os.listdir(d)) == ["done", "trace.jsonl"])
+    with open(tracing.trace_path, "r") as trace_file:
+        records = [json.loads(line) for line in trace_file]
+    batches = [record for record in records if record["stage"] == "pythia_batch"]
+    assert(len(batches) == 1 and batches[0]["exit_status"] != 0 and batches[0]["num_msas"] == 1)
+    tracing.trace_path = ""
+    shutil.rmtree(d)
+
+
+test_pad_phylip()
+test_run_batch_process()
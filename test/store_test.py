@@ -0,0 +1,92 @@
+import sys
+sys.path.append("../code")
+
+from store import ResultsStore
+from distances import DistanceMatrix
+
+import os
+import numpy as np
+
+def test_store():
+    store_path = "../test_data/results.sqlite"
+    if os.path.isfile(store_path):
+        os.remove(store_path)
+    store = ResultsStore(store_path)
+    row = {"ds_id": "bodtkhobwa", "source": "lexibank", "ling_type": "cognate", "family": "Sino-Tibetan", "max_values": 3, "msa_paths": {"bin": "bin.phy"}}
+    store.put_dataset("synonyms", row)
+    store.put_dataset("synonyms", row)
+    ref_tree_names = ["glottolog", "bin"]
+    condensed = np.array([0.0, 0.1, 0.0, 0.2, 0.3, 0.0])
+    store.put_matrix("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "rf", ref_tree_names, 1, condensed)
+    store.put_matrix("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "gq", ref_tree_names, 1, condensed / 2)
+    store.put_log("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "bin", {"alphas": [12.5], "base_frequencies": [[0.6, 0.4]], "tree_llhs": [-10.0, -11.0], "llh": -10.0, "runtime": float("nan")})
+    store.put_difficulty("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "bin", 0.25)
+    store.put_difficulty("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "sampled/sampled0", 0.2)
+    store.put_difficulty("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "sampled/sampled1", 0.4)
+    store.commit()
+    store.close()
+
+    store = ResultsStore(store_path)
+    df = store.datasets("synonyms")
+    assert(len(df) == 1)
+    assert(df["ds_name"][0] == "bodtkhobwa_lexibank_cognate_Sino-Tibetan" and df["max_values"][0] == 3)
+    assert("msa_paths" not in df.columns)
+    matrices = store.matrices("synonyms")
+    (names, condensed_matrices) = matrices["bodtkhobwa_lexibank_cognate_Sino-Tibetan"]
+    assert(names == ref_tree_names)
+    dm = DistanceMatrix(None, names, ["rf", "gq"], condensed_matrices)
+    assert(dm.num_sampled == 1)
+    assert(dm.ref_tree_dist("glottolog", "bin", "rf") == 0.3)
+    assert(dm.ref_tree_dist("glottolog", "bin", "gq") == 0.15)
+    results = store.results("synonyms")
+    assert(len(results) == 1)
+    r = results.iloc[0]
+    assert(r["alpha"] == 12.5 and r["heterogenity"] == 1 and r["difficulty"] == 0.25)
+    assert(abs(r["difficulty_variance"] - 0.01) < 1e-12 and r["num_samples"] == 2)
+    assert(r["zero_base_frequency_bin"] == 0.6 and r["num_trees_bin"] == 2 and r["runtime_bin"] != r["runtime_bin"])
+    # the experiments share result files, but are kept apart
+    assert(len(store.results("partitioning")) == 0)
+    store.put_tree("synonyms", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "bin", "(a,b,c);\n")
+    store.put_tree("partitioning", "bodtkhobwa_lexibank_cognate_Sino-Tibetan", "bin", "(a,c,b);")
+    assert(list(store.trees("synonyms")["newick"]) == ["(a,b,c);"])
+    test_file = "../test_data/trees/bodtkhobwa/glottolog.tre"
+    assert(store.changed("synonyms", test_file))
+    store.mark("synonyms", test_file)
+    assert(not store.changed("synonyms", test_file))
+    assert(store.changed("partitioning", test_file))
+    assert(not store.changed("synonyms", "../test_data/missing.tre"))
+    store.close()
+    os.remove(store_path)
+
+def test_fewer_samples():
+    # ingesting again with fewer sampled MSAs removes the others
+    store_path = "../test_data/results_samples.sqlite"
+    if os.path.isfile(store_path):
+        os.remove(store_path)
+    store = ResultsStore(store_path)
+    ds_name = "bodtkhobwa_lexibank_cognate_Sino-Tibetan"
+    store.put_log("synonyms", ds_name, "bin", {"alphas": [12.5], "llh": -10.0})
+    runs = ["bin"] + ["sampled/sampled" + str(i) for i in range(10)]
+    for (i, run) in enumerate(runs):
+        store.put_difficulty("synonyms", ds_name, run, i / 10)
+        store.put_difficulty("partitioning", ds_name, run, i / 10)
+    store.commit()
+    assert(store.results("synonyms").iloc[0]["num_samples"] == 10)
+    store.drop_runs("synonyms", ds_name, "difficulties", runs[:4])
+    store.commit()
+    r = store.results("synonyms").iloc[0]
+    assert(r["num_samples"] == 3 and abs(r["difficulty_variance"] - np.var([0.1, 0.2, 0.3])) < 1e-12)
+    assert(len(store.difficulties("partitioning")) == 11)
+    # forgotten files are ingested again
+    d = "../test_data/trees/bodtkhobwa"
+    paths = [os.path.join(d, file_name) for file_name in sorted(os.listdir(d))][:3]
+    for path in paths:
+        store.mark("synonyms", path)
+    store.drop_files("synonyms", d, paths[:1])
+    assert([store.changed("synonyms", path) for path in paths] == [False, True, True])
+    store.close()
+    os.remove(store_path)
+
+
+test_store()
+test_fewer_samples()
@@ -0,0 +1,45 @@
+import sys
+sys.path.append("../code")
+
+import tracing
+
+import os
+import shutil
+
+def test_tracing():
+    d = "../test_data/tracing"
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    os.makedirs(d)
+    tracing.trace_path = os.path.join(d, "trace.jsonl")
+    prefix = os.path.join(d, "raxmlng", "ds_a", "sampled", "sampled0")
+    tracing.plan("raxmlng", 3)
+    assert(tracing.run("head -c 100000 /dev/zero > " + os.path.join(d, "out.bin"), "raxmlng", prefix) == 0)
+    assert(tracing.run("exit 3", "raxmlng", os.path.join(d, "raxmlng", "ds_b", "bin")) == 3)
+    with tracing.span("distances", os.path.join(d, "distances", "ds_a"), metric = "rf"):
+        with open(os.path.join(d, "out.bin"), "rb") as f:
+            f.read()
+    try:
+        with tracing.span("distances", os.path.join(d, "distances", "ds_b")):
+            raise ValueError()
+    except ValueError:
+        pass
+    records = tracing.read(tracing.trace_path)
+    assert([record["event"] for record in records] == ["plan", "command", "command", "span", "span"])
+    assert([record["exit_status"] for record in records[1:]] == [0, 3, 0, 1])
+    assert([record["dataset"] for record in records[1:]] == ["ds_a", "ds_b", "ds_a", "ds_b"])
+    assert(records[1]["write_bytes"] >= 100000 and records[3]["read_bytes"] >= 100000)
+    assert(records[3]["metric"] == "rf")
+    for record in records[1:]:
+        assert(record["wall"] >= 0 and record["cpu"] >= 0 and record["peak_rss_kb"] > 0)
+    s = tracing.summary(records, records[0]["start"] + 10)
+    assert(s["stages"]["raxmlng"]["count"] == 2 and s["stages"]["raxmlng"]["failed"] == 1)
+    assert(s["stages"]["distances"]["count"] == 2)
+    assert(s["plans"]["raxmlng"]["done"] == 2 and abs(s["plans"]["raxmlng"]["eta"] - 5) < 1e-6)
+    tracing.trace_path = ""
+    tracing.run("true", "raxmlng", prefix)
+    assert(len(tracing.read(os.path.join(d, "trace.jsonl"))) == 5)
+    shutil.rmtree(d)
+
+
+test_tracing()
@@ -0,0 +1,144 @@
+import sys
+sys.path.append("../code")
+
+from workqueue import WorkQueue
+
+import os
+import time
+import shutil
+import multiprocessing
+
+d = "../test_data/workqueue"
+datasets = ["ds_a", "ds_b", "ds_c", "ds_d"]
+
+def queue(name, **kwargs):
+    return WorkQueue(os.path.join(d, name), lease_timeout = 1, heartbeat = 0.1, poll_interval = 0.05, **kwargs)
+
+def enqueue(q):
+    for ds in datasets:
+        infer = q.add("infer", ds)
+        q.add("distances", ds, [infer])
+    q.add("results", "all", ["distances__" + ds for ds in datasets])
+
+def handlers(name, crash = False):
+    out_dir = os.path.join(d, name, "out")
+    runs_dir = os.path.join(d, name, "runs")
+
+    def run(stage, ds, value):
+        if crash and ds == "ds_b" and stage == "infer" and not os.path.isfile(os.path.join(d, name, "crashed")):
+            # dies holding the lease, without heartbeats
+            open(os.path.join(d, name, "crashed"), "w+").close()
+            os._exit(1)
+        open(os.path.join(runs_dir, stage + "_" + ds + "." + str(os.getpid()) + "_" + str(time.time())), "w+").close()
+        with open(os.path.join(out_dir, stage + "_" + ds), "w+") as out_file:
+            out_file.write(value)
+
+    def read(stage, ds):
+        with open(os.path.join(out_dir, stage + "_" + ds), "r") as out_file:
+            return out_file.read()
+
+    def results(_):
+        run("results", "all", ",".join(read("distances", ds) for ds in datasets))
+    os.makedirs(out_dir, exist_ok = True)
+    os.makedirs(runs_dir, exist_ok = True)
+    return {"infer": lambda ds: run("infer", ds, ds.upper()),
+            "distances": lambda ds: run("distances", ds, read("infer", ds) + "!"),
+            "results": results}
+
+def worker(name, crash):
+    q = queue(name)
+    enqueue(q)
+    q.run(handlers(name, crash))
+
+def outputs(name):
+    out_dir = os.path.join(d, name, "out")
+    res = {}
+    for file_name in sorted(os.listdir(out_dir)):
+        with open(os.path.join(out_dir, file_name), "r") as out_file:
+            res[file_name] = out_file.read()
+    return res
+
+def runs(name):
+    return sorted(file_name.split(".")[0] for file_name in os.listdir(os.path.join(d, name, "runs")))
+
+def run_workers(name, num_workers, crash = False):
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target = worker, args = (name, crash)) for _ in range(num_workers)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join(60)
+    return [process.exitcode for process in processes]
+
+def test_workers():
+    if os.path.isdir(d):
+        shutil.rmtree(d)
+    q = queue("serial")
+    enqueue(q)
+    assert(q.run(handlers("serial")) == 9)
+    assert(q.status() == {"units": 9, "done": 9, "failed": 0, "running": 0, "waiting": 0})
+    assert(q.run(handlers("serial")) == 0)
+    assert(run_workers("parallel", 4) == [0, 0, 0, 0])
+    assert(outputs("parallel") == outputs("serial"))
+    assert(outputs("serial")["results_all"] == "DS_A!,DS_B!,DS_C!,DS_D!")
+    # every unit ran exactly once
+    assert(runs("parallel") == runs("serial"))
+    assert(len(runs("serial")) == 9)
+    # one worker dies, the others wait for its lease to expire and retry
+    exitcodes = run_workers("crash", 3, True)
+    assert(sorted(exitcodes) == [0, 0, 1])
+    assert(outputs("crash") == outputs("serial"))
+    assert(runs("crash") == runs("serial"))
+    assert(queue("crash").attempts("infer__ds_b") == 1)
+
+def test_stale_and_failed_units():
+    name = "failing"
+    q = queue(name, max_attempts = 2)
+    q.add("infer", "ds_a")
+    q.add("infer", "ds_b")
+    q.add("distances", "ds_b", ["infer__ds_b"])
+    # lease left by a dead worker
+    with open(q.path("leases", "infer__ds_a"), "w+") as lease_file:
+        lease_file.write('{"worker": "dead"}')
+    os.utime(q.path("leases", "infer__ds_a"), (time.time() - 10, time.time() - 10))
+    calls = []
+
+    def infer(ds):
+        calls.append(ds)
+        if ds == "ds_b":
+            raise ValueError()
+    assert(q.run({"infer": infer, "distances": lambda ds: calls.append("distances")}) == 3)
+    assert(sorted(calls) == ["ds_a", "ds_b", "ds_b"])
+    assert(q.status() == {"units": 3, "done": 1, "failed": 2, "running": 0, "waiting": 0})
+    assert(q.attempts("infer__ds_a") == 1 and q.attempts("infer__ds_b") == 2)
+    shutil.rmtree(d)
+
+def test_break_and_claim():
+    # b breaks the stale lease and c claims the unit while a is between its
+    # check and its rename of the stale lease
+    (a, b, c) = (queue("race"), queue("race"), queue("race"))
+    a.add("infer", "ds_a")
+    lease_path = a.path("leases", "infer__ds_a")
+    with open(lease_path, "w+") as lease_file:
+        lease_file.write('{"worker": "dead"}')
+    os.utime(lease_path, (time.time() - 10, time.time() - 10))
+    rename = os.rename
+
+    def interleaved(src, dst):
+        os.rename = rename
+        b.break_stale("infer__ds_a")
+        assert(c.claim("infer__ds_a"))
+        rename(src, dst)
+    os.rename = interleaved
+    a.break_stale("infer__ds_a")
+    os.rename = rename
+    assert(c.owns("infer__ds_a"))
+    assert(os.listdir(a.path("leases")) == ["infer__ds_a"])
+    assert(a.attempts("infer__ds_a") == 1)
+    assert(not a.claim("infer__ds_a"))
+    shutil.rmtree(d)
+
+
+test_workers()
+test_stale_and_failed_units()
+test_break_and_claim()